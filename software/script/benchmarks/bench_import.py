@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+"""
+Import time and import side effects of the stn2120 package
+
+Every sample is a fresh interpreter (python -c "import <module>") run in an
+empty temporary directory; the time reported is the median wall time minus
+the one of a bare interpreter, in milliseconds. A separate run of every
+module checks that importing it has no side effects: no DNS resolution,
+no logging configuration, no file created and none of the optional
+subsystems (redis, netcom, protocols) loaded.
+
+    python bench_import.py [--runs 20] [--budget stn2120=15,stn2120.stn2120=30]
+
+The exit status is 1 when a module goes over its budget or has a side
+effect, so the benchmark can hold the import time in CI.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# module -> budget in ms over a bare interpreter
+BUDGETS = {
+    'stn2120'         : 15.0,
+    'stn2120.stn2120' : 30.0,
+}
+
+# loaded on first use only
+LAZY = ['redis', 'stn2120.network.netcom', 'stn2120.protocols']
+
+# run in the child: import the module, report what it did
+PROBE = r"""
+import os, sys, json, socket, logging
+resolved = []
+for name in ('gethostbyname', 'gethostbyname_ex', 'getaddrinfo'):
+    def probe(*args, _name=name, _orig=getattr(socket, name)):
+        resolved.append(_name)
+        return _orig(*args)
+    setattr(socket, name, probe)
+import %s
+print(json.dumps({
+    'resolved' : resolved,
+    'handlers' : [ type(h).__name__ for h in logging.getLogger().handlers ],
+    'loaded'   : [ m for m in %r if m in sys.modules ],
+    'files'    : os.listdir('.'),
+}))
+"""
+
+
+def child_env():
+    # the package is imported from the source tree next to this script
+    env = dict(os.environ)
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stn2120-pck')
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (os.path.abspath(src), env.get('PYTHONPATH')) if p)
+    env.pop('PYTHONSTARTUP', None)
+    return env
+
+
+def time_import(statement, runs, cwd, env):
+    """ median wall time in seconds of `python -c statement` """
+    samples = []
+    for _ in range(runs):
+        t = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], cwd=cwd, env=env, check=True)
+        samples.append(time.perf_counter() - t)
+    return statistics.median(samples)
+
+
+def side_effects(module, env):
+    """ list of side effects of importing `module`, empty when there is none """
+    with tempfile.TemporaryDirectory() as cwd:
+        out = subprocess.run([sys.executable, '-c', PROBE % (module, LAZY)], cwd=cwd,
+                             env=env, check=True, stdout=subprocess.PIPE).stdout
+    report = json.loads(out.decode().splitlines()[-1])
+    problems = []
+    if report['resolved']:
+        problems.append("DNS lookup (%s)" % ", ".join(report['resolved']))
+    if report['handlers']:
+        problems.append("root logger configured (%s)" % ", ".join(report['handlers']))
+    if report['files']:
+        problems.append("files created (%s)" % ", ".join(report['files']))
+    if report['loaded']:
+        problems.append("loaded eagerly (%s)" % ", ".join(report['loaded']))
+    return problems
+
+
+def parse_budgets(text):
+    budgets = dict(BUDGETS)
+    for item in text.split(',') if text else []:
+        module, ms = item.split('=')
+        budgets[module.strip()] = float(ms)
+    return budgets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget', help="module=ms pairs, default %s" %
+                        ",".join("%s=%g" % b for b in sorted(BUDGETS.items())))
+    parser.add_argument('--output', help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    budgets = parse_budgets(args.budget)
+    env = child_env()
+    results = {}
+    failed = False
+    with tempfile.TemporaryDirectory() as cwd:
+        bare = time_import('pass', args.runs, cwd, env)
+        print("%-18s %8.1f ms" % ('(interpreter)', 1e3 * bare))
+        for module, budget in sorted(budgets.items()):
+            ms = 1e3 * (time_import('import ' + module, args.runs, cwd, env) - bare)
+            problems = side_effects(module, env)
+            over = ms > budget
+            failed = failed or over or bool(problems)
+            results[module] = {'ms': ms, 'budget_ms': budget, 'side_effects': problems}
+            print("%-18s %8.1f ms  (budget %5.1f)%s" %
+                  (module, ms, budget, '  OVER BUDGET' if over else ''))
+            for p in problems:
+                print("%-18s side effect: %s" % ('', p))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'bare_ms': 1e3 * bare,
+                       'results': results}, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
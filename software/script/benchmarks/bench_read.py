@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+"""
+Microbenchmark of the command read path (STN2120.__read)
+
+Compares the bulk, prompt aware reader against the former readline() loop
+using a pyserial loopback port, the adapter response is written to the
+port right before every read so each iteration is a full command round trip.
+
+    python bench_read.py [--seconds 2]
+"""
+
+import re
+import sys
+import time
+import argparse
+
+import serial
+
+from stn2120.reader import PromptReader
+
+RESPONSE = b'ATE0\rOK\r\n\r\n>'
+
+
+def readline_read(port, prompt=b'>'):
+    """ former STN2120.__read() implementation, kept as baseline """
+    buffer = bytearray()
+    while True:
+        data = port.readline()
+        buffer.extend(data)
+        if prompt in buffer:
+            break
+    buffer = re.sub(b"\x00", b"", buffer)
+    if buffer.endswith(prompt):
+        buffer = buffer[:-1]
+    string = buffer.decode("utf-8", "ignore")
+    return [ s.strip() for s in re.split("[\r\n]", string) if bool(s) ]
+
+
+def run(name, read, port, seconds):
+    count = 0
+    t_end = time.perf_counter() + seconds
+    t_start = time.perf_counter()
+    while time.perf_counter() < t_end:
+        port.write(RESPONSE)
+        lines = read()
+        assert lines == ['ATE0', 'OK'], lines
+        count += 1
+    elapsed = time.perf_counter() - t_start
+    print("%-10s %8d cmds  %10.1f cmds/s  %8.1f us/cmd" %
+          (name, count, count / elapsed, 1e6 * elapsed / count))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--url', default='loop://')
+    args = parser.parse_args(argv)
+
+    port = serial.serial_for_url(args.url, timeout=0.1)
+    reader = PromptReader(port)
+
+    run('readline', lambda: readline_read(port), port, args.seconds)
+    run('bulk', reader.read_lines, port, args.seconds)
+    port.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+"""
+End-to-end throughput and latency benchmarks of STN2120
+
+Drives the library paths used in production against emulated adapters
+(stn2120.emulator) and reports frames/s, p50/p99 latency and CPU time per
+frame. Every benchmark runs in its own process and the emulated adapters
+in another one, so the CPU time measured is the library's only. Monitor
+frames carry the host monotonic time of their emission in the payload,
+which gives the bus -> host latency.
+
+    python bench_suite.py [--seconds 2] [--rate 2000] [--only monitor,bridge]
+                          [--output results.json] [--baseline previous.json]
+
+With --baseline every metric is compared with a previous run and the exit
+status is 1 when one of them got worse by more than --tolerance.
+"""
+
+import io
+import sys
+import json
+import time
+import queue
+import socket
+import logging
+import platform
+import argparse
+import threading
+import contextlib
+import multiprocessing
+from datetime import datetime
+
+import serial
+
+from stn2120.decoder import CanFrame, decode_line
+from stn2120.emulator import emulate_pair
+
+# time.monotonic_ns() is python 3.7+
+_now_ns = getattr(time, 'monotonic_ns', lambda: int(time.monotonic() * 1e9))
+
+BENCHMARKS = ['protocol', 'command', 'transmit', 'monitor', 'bridge']
+
+# (metric, True when higher is better) compared against the baseline
+METRICS = [('frames_s', True), ('p50_us', False), ('p99_us', False), ('cpu_us_frame', False)]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def summary(frames, elapsed, cpu, latencies, **extra):
+    """ latencies in seconds """
+    result = {
+        'frames'       : frames,
+        'frames_s'     : frames / elapsed if elapsed > 0 else 0.0,
+        'p50_us'       : 1e6 * percentile(latencies, 50),
+        'p99_us'       : 1e6 * percentile(latencies, 99),
+        'cpu_us_frame' : 1e6 * cpu / frames if frames else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def timed_traffic(can_id=0x412):
+    """ monitor frames whose payload is the monotonic time they are printed at """
+    while True:
+        yield CanFrame(can_id, 8, _now_ns().to_bytes(8, 'big'))
+
+
+def frame_latency(line):
+    """ seconds since a timed_traffic() frame was printed, None for other lines """
+    frame = decode_line(line)
+    if frame is None or frame.dlc != 8:
+        return None
+    return (_now_ns() - int.from_bytes(frame.data, 'big')) / 1e9
+
+
+# ---------------------------------------------------------------- emulator
+
+def _emulator_process(conn, pairs, rate):
+    nodes = []
+    for i in range(pairs):
+        # only the first pair sees traffic on its bus
+        if i == 0 and rate > 0:
+            _, pair = emulate_pair(rate, timed_traffic())
+        else:
+            _, pair = emulate_pair()
+        nodes += pair
+    conn.send([ n.port for n in nodes ])
+    conn.recv()
+    conn.send([ n.stats() for n in nodes ])
+    for n in nodes:
+        n.close()
+
+
+class Emulator(object):
+    """ emulated adapters running in a child process """
+
+    def __init__(self, pairs=1, rate=0.0):
+        self.__conn, child = multiprocessing.Pipe()
+        self.__process = multiprocessing.Process(target=_emulator_process,
+                                                 args=(child, pairs, rate), daemon=True)
+        self.ports = []
+        self.stats = []
+
+    def __enter__(self):
+        self.__process.start()
+        self.ports = self.__conn.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.__conn.send('stop')
+        self.stats = self.__conn.recv()
+        self.__process.join(2)
+
+
+def open_device(ports):
+    from stn2120.ic_config import STN2120
+    # STN2120 prints its initialization steps
+    with contextlib.redirect_stdout(io.StringIO()):
+        return STN2120(ports, None, '31', 'clt_car', 0.1)
+
+
+def _quiet_port_errors(args):
+    # the monitor loops have no stop, they end when the port goes away
+    if not issubclass(args.exc_type, (serial.SerialException, OSError, TypeError)):
+        sys.__excepthook__(args.exc_type, args.exc_value, args.exc_traceback)
+
+
+# -------------------------------------------------------------- benchmarks
+
+def bench_protocol(args):
+    """ Protocol.__call__ on batches of CAN response lines """
+    from stn2120.protocols import ISO_15765_4_11bit_500k
+    protocol = ISO_15765_4_11bit_500k([])
+    batch = [ "7E8 06 41 00 BE 7F B8 13", "7E9 06 41 00 98 18 80 13",
+              "7E8 10 14 49 02 01 31 44 34", "7E8 21 47 50 30 30 52 35 35" ] * 16
+
+    latencies = []
+    t_end = time.perf_counter() + args.seconds
+    cpu0, t0 = time.process_time(), time.perf_counter()
+    while time.perf_counter() < t_end:
+        t = time.perf_counter()
+        protocol(batch)
+        latencies.append(time.perf_counter() - t)
+    elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    frames = len(latencies) * len(batch)
+    return summary(frames, elapsed, cpu, latencies, batch=len(batch))
+
+
+def bench_command(args):
+    """ send_and_parse() round trips (STI) on the 'w' node """
+    with Emulator() as emu:
+        dev = open_device(emu.ports)
+        latencies = []
+        t_end = time.perf_counter() + args.seconds
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        while time.perf_counter() < t_end:
+            t = time.perf_counter()
+            dev.send_and_parse(b'STI', 'w')
+            latencies.append(time.perf_counter() - t)
+        elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+        dev.close()
+    return summary(len(latencies), elapsed, cpu, latencies)
+
+
+def bench_transmit(args):
+    """ STPX frames through __write2_bus (pipelined TransmitEngine) """
+    with Emulator() as emu:
+        dev = open_device(emu.ports)
+        write = dev._STN2120__write2_bus
+        latencies = []
+
+        def acked(f, t_sent):
+            if f.exception() is None:
+                latencies.append(time.perf_counter() - t_sent)
+
+        t_end = time.perf_counter() + args.seconds
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        while time.perf_counter() < t_end:
+            t = time.perf_counter()
+            write(b'h:7DF,d:02 01 00 ').add_done_callback(lambda f, t=t: acked(f, t))
+        dev.transmit_engine().drain(1.0)
+        elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+        stats = dev.transmit_engine().stats()
+        dev.close()
+    return summary(len(latencies), elapsed, cpu, latencies,
+                   errors=stats['errors'], timeouts=stats['timeouts'])
+
+
+def _consume(q, seconds):
+    latencies = []
+    t_end = time.perf_counter() + seconds
+    while time.perf_counter() < t_end:
+        try:
+            line = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        latency = frame_latency(line)
+        if latency is not None:
+            latencies.append(latency)
+    return latencies
+
+
+def bench_monitor(args):
+    """ STMA frames read by read_frames_2_queue(), bus -> queue latency """
+    with Emulator(rate=args.rate) as emu:
+        dev = open_device(emu.ports)
+        q = queue.Queue()
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        threading.Thread(target=dev.read_frames_2_queue, args=(q,), daemon=True).start()
+        latencies = _consume(q, args.seconds)
+        elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+    return summary(len(latencies), elapsed, cpu, latencies,
+                   offered_s=args.rate, buffer_full=emu.stats[0]['overflows'])
+
+
+def bench_bridge(args):
+    """
+        _diagnosis() forwarding: car monitor -> read_frames_from_bus ->
+        netcom TCP -> process_read_from_server -> STPX on the diagnosis
+        side, latency measured from bus to bus
+    """
+    from stn2120.echo import EchoSuppressor
+    from stn2120.network import netcom
+
+    with Emulator(pairs=2, rate=args.rate) as emu:
+        car  = open_device(emu.ports[0:2])
+        diag = open_device(emu.ports[2:4])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            srv = netcom.ThreadedServer('127.0.0.1', 0)
+            # connections wait in the backlog until listen() accepts them
+            srv.sock.listen(5)
+            accept = threading.Thread(target=srv.listen)
+            accept.start()
+            clt = netcom.socket_clients(srv.sock.getsockname())
+            accept.join()
+
+        if args.batch_delay:
+            clt.enable_batching(args.batch_frames, args.batch_delay)
+        q = queue.Queue()
+        cpu0, t0 = time.process_time(), time.perf_counter()
+        # the far bus is watched through the 'r' node of the diagnosis side
+        threading.Thread(target=diag.read_frames_2_queue, args=(q,), daemon=True).start()
+        threading.Thread(target=diag.process_read_from_server,
+                         args=([], srv, EchoSuppressor(), args.wire), daemon=True).start()
+        threading.Thread(target=car.read_frames_from_bus,
+                         args=([], clt, EchoSuppressor(), 'r', args.wire), daemon=True).start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies = _consume(q, args.seconds)
+        elapsed, cpu = time.perf_counter() - t0, time.process_time() - cpu0
+        clt.close_client()
+        srv.client.close()
+    monitored = emu.stats[0]['monitored']
+    return summary(len(latencies), elapsed, cpu, latencies,
+                   offered_s=args.rate, wire=args.wire,
+                   sends=clt.metrics['sends'].value,
+                   delivered=len(latencies) / monitored if monitored else 0.0)
+
+
+def _run_child(conn, name, args):
+    threading.excepthook = _quiet_port_errors
+    logging.getLogger('stn2120').addHandler(logging.NullHandler())
+    try:
+        conn.send(globals()['bench_' + name](args))
+    except Exception as e:
+        conn.send({'error': repr(e)})
+
+
+def run_isolated(name, args):
+    conn, child = multiprocessing.Pipe()
+    p = multiprocessing.Process(target=_run_child, args=(child, name, args))
+    p.start()
+    result = conn.recv()
+    p.join(5)
+    if p.is_alive():
+        p.terminate()
+    return result
+
+
+# ----------------------------------------------------------------- reports
+
+def print_result(name, r):
+    if 'error' in r:
+        print("%-10s ERROR %s" % (name, r['error']))
+        return
+    print("%-10s %10.1f frames/s  p50 %9.1f us  p99 %9.1f us  cpu %7.1f us/frame" %
+          (name, r['frames_s'], r['p50_us'], r['p99_us'], r['cpu_us_frame']))
+
+
+def compare(results, baseline, tolerance):
+    """ prints the change of every metric, returns the regressions """
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get('results', {}).get(name)
+        if not b or 'error' in r or 'error' in b:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = b.get(metric), r.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions.append((name, metric))
+            print("%-10s %-13s %12.1f -> %12.1f  %+6.1f%%%s" %
+                  (name, metric, old, new, 100 * change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--rate', type=float, default=2000.0,
+                        help="monitor frames/s offered by the emulated bus")
+    parser.add_argument('--wire', default='binary', choices=['binary', 'delta', 'text'],
+                        help="bridge wire format")
+    parser.add_argument('--batch-delay', type=float, default=0.001,
+                        help="bridge send batching window in s, 0 sends every frame")
+    parser.add_argument('--batch-frames', type=int, default=64)
+    parser.add_argument('--only', help="comma separated subset of: " + ", ".join(BENCHMARKS))
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="JSON of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    names = args.only.split(',') if args.only else BENCHMARKS
+    results = {}
+    for name in names:
+        results[name] = run_isolated(name, args)
+        print_result(name, results[name])
+
+    report = {
+        'date'     : datetime.now().isoformat(),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'host'     : socket.gethostname(),
+        'args'     : vars(args),
+        'results'  : results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
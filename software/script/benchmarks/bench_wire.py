@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+"""
+Throughput of the bridge wire formats (stn2120.network.netcom)
+
+Encodes monitor frames the way read_frames_from_bus() sends them and
+decodes the stream the way process_read_from_server() reads it, cut in
+recv() sized chunks: the former text format (b'fr:<line>', split on b'fr:')
+against the binary records (FrameEncoder / FrameDecoder) and the delta
+compressed ones (DeltaEncoder). Frames cut in two by a chunk boundary are
+lost or corrupted with the text format, they are counted as errors.
+
+    python bench_wire.py [--frames 200000] [--chunk 1024] [--socket]
+                         [--traffic random|cyclic]
+
+--traffic cyclic replays a set of IDs whose payloads rarely change, as on a
+real bus, random payloads are the worst case of the delta compression.
+
+With --socket the stream goes through a local socketpair instead of
+in-memory chunks.
+
+A loss check follows: delta records with every --loss-th record dropped, as
+over UDP, must never decode to a wrong payload (deltas after a gap wait for
+the next keyframe); the exit status is 1 when one does.
+"""
+
+import sys
+import time
+import socket
+import random
+import argparse
+import threading
+from collections import Counter
+
+from stn2120.decoder import CanFrame, decode_line
+from stn2120.network.netcom import FrameEncoder, FrameDecoder, DeltaEncoder
+
+
+def sample_lines(n):
+    """ monitor lines of 11 and 29 bit frames with random payloads """
+    rnd = random.Random(1)
+    lines = []
+    for i in range(n):
+        dlc = rnd.randint(1, 8)
+        data = b''.join(b' %02X' % rnd.randrange(256) for _ in range(dlc))
+        if i % 4 == 3:
+            lines.append(b'18 DA F1 %02X' % rnd.randrange(256) + data)
+        else:
+            lines.append(b'%03X' % rnd.randrange(0x800) + data)
+    return lines
+
+
+def cyclic_lines(n, ids=40, change=0.2):
+    """ `ids` CAN IDs in turn, one payload byte changes with probability `change` """
+    rnd = random.Random(1)
+    table = []
+    for i in range(ids):
+        can_id = b'18 DA F1 %02X' % i if i % 8 == 7 else b'%03X' % (0x100 + 16 * i)
+        table.append((can_id, [ rnd.randrange(256) for _ in range(rnd.randint(2, 8)) ]))
+    lines = []
+    for i in range(n):
+        can_id, data = table[i % ids]
+        if rnd.random() < change:
+            data[rnd.randrange(len(data))] = rnd.randrange(256)
+        lines.append(can_id + b''.join(b' %02X' % b for b in data))
+    return lines
+
+
+TRAFFIC = {
+    'random' : sample_lines,
+    'cyclic' : cyclic_lines,
+}
+
+
+# ------------------------------------------------------------------ formats
+
+# the monitor line is decoded by the sender with both formats (echo check),
+# so encoding starts from the line and its CanFrame
+
+def text_encode(lines, frames):
+    return [ b'fr:' + line for line in lines ]
+
+
+def text_decoder():
+    """ process_read_from_server() text path, one recv() at a time """
+    def feed(data):
+        if data.count(b'fr:') > 1:
+            parts = data.split(b'fr:')[1:]
+        else:
+            parts = [data[3:]]
+        return [ decode_line(p) for p in parts ]
+    return feed
+
+
+def binary_encode(lines, frames):
+    encoder = FrameEncoder()
+    return [ encoder.encode(frame) for frame in frames ]
+
+
+def binary_decoder():
+    return FrameDecoder().feed
+
+
+def delta_encode(lines, frames):
+    encoder = DeltaEncoder()
+    return [ encoder.encode(frame) for frame in frames ]
+
+
+FORMATS = {
+    'text'   : (text_encode, text_decoder),
+    'binary' : (binary_encode, binary_decoder),
+    'delta'  : (delta_encode, binary_decoder),
+}
+
+
+# ------------------------------------------------------------------ streams
+
+def chunks(stream, size):
+    return [ stream[i:i + size] for i in range(0, len(stream), size) ]
+
+
+def through_socket(stream, size):
+    """ the recv() results of `stream` sent through a socketpair """
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=lambda: (a.sendall(stream), a.close()))
+    sender.start()
+    received = []
+    while True:
+        data = b.recv(size)
+        if not data:
+            break
+        received.append(data)
+    sender.join()
+    b.close()
+    return received
+
+
+def bench(name, lines, frames, expected, args):
+    encode, decoder = FORMATS[name]
+
+    t0 = time.perf_counter()
+    records = encode(lines, frames)
+    t_encode = time.perf_counter() - t0
+
+    stream = b''.join(records)
+    reads = through_socket(stream, args.chunk) if args.socket else chunks(stream, args.chunk)
+
+    feed = decoder()
+    decoded = []
+    t0 = time.perf_counter()
+    for data in reads:
+        decoded.extend(feed(data))
+    t_decode = time.perf_counter() - t0
+
+    # frames missing or wrong, whatever the order
+    received = Counter(f.key() for f in decoded if f is not None)
+    matched = sum(min(c, received[k]) for k, c in expected.items())
+    n = len(lines)
+    return {
+        'bytes_frame' : len(stream) / n,
+        'encode_s'    : n / t_encode,
+        'decode_s'    : n / t_decode,
+        'errors'      : n - matched,
+    }
+
+
+def loss_check(n, every, ids=8, interval=0.05):
+    """ wrong, decoded, unsynced frames of a delta stream missing every `every`-th record """
+    # a frame counter in every payload: each frame is unique, a stale
+    # payload shows as a frame that was never sent
+    frames = [ CanFrame(0x100 + i % ids, 8, bytes([i >> 8 & 0xFF, i & 0xFF, 0, 0, 0, 0, 0, 0]))
+               for i in range(n) ]
+    now = [0.0]
+    encoder = DeltaEncoder(keyframe_interval=interval, clock=lambda: now[0])
+    records = []
+    for i, frame in enumerate(frames):
+        now[0] = i * 1e-3
+        records.append(encoder.encode(frame))
+    kept = set(f.key() for i, f in enumerate(frames) if (i + 1) % every)
+    stream = b''.join(r for i, r in enumerate(records) if (i + 1) % every)
+
+    decoder = FrameDecoder()
+    decoded = []
+    for data in chunks(stream, 1024):
+        decoded.extend(decoder.feed(data))
+    wrong = sum(1 for f in decoded if f.key() not in kept)
+    return wrong, len(decoded), decoder.unsynced
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frames', type=int, default=200000)
+    parser.add_argument('--chunk', type=int, default=1024, help="recv() size")
+    parser.add_argument('--socket', action='store_true', help="go through a socketpair")
+    parser.add_argument('--traffic', default='random', choices=sorted(TRAFFIC))
+    parser.add_argument('--loss', type=int, default=100,
+                        help="loss check: drop one delta stream record in LOSS")
+    args = parser.parse_args(argv)
+
+    lines = TRAFFIC[args.traffic](args.frames)
+    frames = [ decode_line(line) for line in lines ]
+    expected = Counter(f.key() for f in frames)
+    print("%-7s %10s %14s %14s %8s" % ('format', 'bytes/frame', 'encode fr/s', 'decode fr/s', 'errors'))
+    for name in FORMATS:
+        r = bench(name, lines, frames, expected, args)
+        print("%-7s %10.1f %14.0f %14.0f %8d" %
+              (name, r['bytes_frame'], r['encode_s'], r['decode_s'], r['errors']))
+
+    wrong, decoded, unsynced = loss_check(min(args.frames, 20000), args.loss)
+    print("loss 1/%d: %d decoded, %d unsynced, %d wrong" % (args.loss, decoded, unsynced, wrong))
+    return 1 if wrong else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4 @@
+import logging
+
+# the application decides where the library logs go
+logging.getLogger(__name__).addHandler(logging.NullHandler())
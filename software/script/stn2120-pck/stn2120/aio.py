@@ -0,0 +1,302 @@
+########################################################################
+#
+# aio.py
+#
+# asyncio transport and API for the STN2120
+#
+########################################################################
+
+import asyncio
+import logging
+
+import serial
+
+from .reader import split_lines
+from .utils import OBDStatus
+
+logger = logging.getLogger(__name__)
+
+
+class SerialTransport(object):
+    """
+        Feeds the bytes received on a pyserial port into an
+        asyncio.StreamReader.
+
+        The port file descriptor is registered with loop.add_reader(),
+        so no thread is needed per stream. URL handlers without a file
+        descriptor (loop://, socket://, ...) are polled instead.
+    """
+
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, port, loop=None):
+        self.port   = port
+        self.loop   = loop or asyncio.get_event_loop()
+        self.reader = asyncio.StreamReader(loop=self.loop)
+        self.__fd   = None
+        self.__poll = None
+
+        port.timeout = 0 # reads never block the event loop
+        try:
+            self.__fd = port.fileno()
+        except (AttributeError, NotImplementedError, serial.SerialException):
+            self.__fd = None
+
+        if self.__fd is not None:
+            self.loop.add_reader(self.__fd, self.__on_readable)
+        else:
+            self.__poll = self.loop.call_soon(self.__on_poll)
+
+    def __on_readable(self):
+        try:
+            data = self.port.read(self.port.in_waiting or 1)
+        except serial.SerialException as e:
+            logger.error(str(e))
+            self.close()
+            self.reader.set_exception(e)
+            return
+        if data:
+            self.reader.feed_data(data)
+
+    def __on_poll(self):
+        if self.port.in_waiting:
+            self.__on_readable()
+        if self.__poll is not None:
+            self.__poll = self.loop.call_later(self.POLL_INTERVAL, self.__on_poll)
+
+    def write(self, data):
+        self.port.write(data)
+
+    def discard(self):
+        """
+            drops everything received and not yet consumed: `reader` is
+            replaced by an empty one, the old one gets EOF so that a
+            coroutine still reading it sees the end of its stream
+        """
+        self.port.reset_input_buffer()
+        old = self.reader
+        self.reader = asyncio.StreamReader(loop=self.loop)
+        old.feed_eof()
+
+    def close(self):
+        if self.__fd is not None:
+            self.loop.remove_reader(self.__fd)
+            self.__fd = None
+        if self.__poll is not None:
+            self.__poll.cancel()
+            self.__poll = None
+        self.reader.feed_eof()
+
+
+class AsyncSTN2120(object):
+    """
+        asyncio version of ic_config.STN2120
+
+        Commands on the same node are serialized with a lock, several
+        boards (and the TCP bridge) can share a single event loop. The
+        lock is only held to start monitor(), a command sent on a node
+        being monitored stops STMA first and ends the monitor generator.
+    """
+
+    STN_PROMPT = b'>'
+
+    CMD_TIMEOUT   = 1.0
+    RESET_TIMEOUT = 2.0
+
+    # same sequence as STN2120.__initialize_node
+    _INIT_SEQUENCE = [
+        b"ATZ",
+        b"ATE0",
+        b"ATH1",
+        b"ATL1",
+        None,        # STP <protocol>
+        b"STPO",
+        b"STCMM 1",
+        b"ATAT 0",
+        b"ATCAF0",
+        b"ATV0",
+        b"ATR0",
+    ]
+
+    def __init__(self, ports, role, loop=None):
+        """ ports: {'r': serial port, 'w': serial port} already opened """
+        if role not in ('clt_diag', 'clt_car'):
+            raise AttributeError("Role error, options: clt_diag or clt_car")
+        self.loop   = loop or asyncio.get_event_loop()
+        self.__role = role
+        self.__status = OBDStatus.NOT_CONNECTED
+        self.__transport = {}
+        self.__lock = {}
+        self.__monitoring = {}
+        for node, port in ports.items():
+            self.__transport[node] = SerialTransport(port, self.loop)
+            self.__lock[node] = asyncio.Lock()
+            self.__monitoring[node] = False
+
+    @classmethod
+    async def open(cls, portdev, baudrate=2000000, protocol="31", role=None, loop=None):
+        """ opens the 'r' and 'w' ports and initializes both in parallel """
+        ports = {}
+        for node, path in zip(('r', 'w'), portdev):
+            ports[node] = serial.serial_for_url(path, baudrate,
+                                                parity   = serial.PARITY_NONE,
+                                                stopbits = 1,
+                                                bytesize = 8,
+                                                timeout  = 0)
+        device = cls(ports, role, loop)
+        await device.initialize(protocol)
+        return device
+
+    async def initialize(self, protocol):
+        results = await asyncio.gather(*[self.__initialize_node(protocol, node)
+                                         for node in self.__transport])
+        if all(results):
+            self.__status = OBDStatus.CAR_CONNECTED
+        return self.__status
+
+    async def __initialize_node(self, protocol, node):
+        for cmd in self._INIT_SEQUENCE:
+            if cmd is None:
+                cmd = b"STP" + protocol.encode()
+            timeout = self.RESET_TIMEOUT if cmd == b"ATZ" else self.CMD_TIMEOUT
+            r = await self.send(cmd, node, timeout)
+            if cmd in (b"ATH1", b"ATL1", b"STPO") and r != ['OK']:
+                logger.error("%s did not return 'OK' on node %s" % (cmd.decode(), node))
+                return False
+        return True
+
+    def status(self):
+        return self.__status
+
+    async def send(self, cmd, node='w', timeout=None):
+        """
+            sends an AT/ST command and returns the response lines,
+            as soon as the prompt arrives
+        """
+        transport = self.__transport[node]
+        async with self.__lock[node]:
+            await self.__stop_monitor(node)
+            transport.discard()
+            transport.write(cmd + b"\r\n")
+            try:
+                raw = await asyncio.wait_for(
+                    transport.reader.readuntil(self.STN_PROMPT),
+                    timeout or self.CMD_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Failed to read port: prompt not received")
+                return []
+        lines = []
+        for line in split_lines(raw[:-1]):
+            s = str(line, "utf-8", "ignore").replace('\x00', '').strip()
+            if s:
+                lines.append(s)
+        return lines
+
+    async def __stop_monitor(self, node):
+        """ stops STMA on `node` when it runs, the node lock is held """
+        if not self.__monitoring[node]:
+            return
+        self.__monitoring[node] = False
+        transport = self.__transport[node]
+        transport.discard()      # ends the monitor() generator
+        transport.write(b'\r')   # any character stops the monitor
+        try:
+            await asyncio.wait_for(transport.reader.readuntil(self.STN_PROMPT), self.CMD_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            logger.warning("no prompt after stopping the monitor on node %s" % node)
+
+    async def stop_monitor(self, node='r'):
+        """ stops STMA on `node`, its monitor() generator ends """
+        async with self.__lock[node]:
+            await self.__stop_monitor(node)
+
+    async def monitor(self, node='r'):
+        """
+            async generator of the lines (bytes, terminator removed)
+            printed by STMA, restarts the monitor on BUFFER FULL. Ends on
+            stop_monitor() or when a command is sent on the node; a
+            generator left unfinished keeps the adapter monitoring until
+            then
+        """
+        transport = self.__transport[node]
+        cmd = b'STMA\r'
+        async with self.__lock[node]:
+            await self.__stop_monitor(node)
+            transport.discard()
+            transport.write(cmd)
+            reader = transport.reader
+            self.__monitoring[node] = True
+        while True:
+            try:
+                line = await reader.readuntil(b'\r')
+            except asyncio.IncompleteReadError:
+                return
+            line = line.strip()
+            if not line:
+                continue
+            if line == b'BUFFER FULL':
+                async with self.__lock[node]:
+                    if reader is not transport.reader:
+                        return   # stopped meanwhile
+                    transport.discard()
+                    transport.write(cmd)
+                    reader = transport.reader
+                continue
+            yield line
+
+    async def transmit(self, frame, timeout=None):
+        """
+            transmits a frame b'h:<ID>,d:<DATA>' with STPX on the 'w'
+            node, returns the adapter reply lines
+        """
+        return await self.send(b'STPX ' + frame + b' , t:1', 'w', timeout)
+
+    def close(self):
+        self.__status = OBDStatus.NOT_CONNECTED
+        for transport in self.__transport.values():
+            transport.close()
+            transport.port.close()
+        self.__transport = {}
+
+
+class AsyncBoard(object):
+    """
+        asyncio counterpart of stn2120.Board
+
+            board = await AsyncBoard.open(['/dev/ttyUSB0', '/dev/ttyUSB1'], role='clt_car')
+            async for frame in board.monitor():
+                ...
+    """
+
+    def __init__(self, device, role):
+        self.device = device
+        self.role   = role
+
+    @classmethod
+    async def open(cls, portdev, baudrate=2000000, protocol="31", role=None, loop=None):
+        if role is None:
+            raise AttributeError("Role error, options: clt_diag or clt_car")
+        device = await AsyncSTN2120.open(portdev, baudrate, protocol, role, loop)
+        return cls(device, role)
+
+    async def send(self, cmd, node='w'):
+        return await self.device.send(cmd.encode('utf-8') if isinstance(cmd, str) else cmd, node)
+
+    def monitor(self):
+        return self.device.monitor()
+
+    async def stop_monitor(self):
+        return await self.device.stop_monitor()
+
+    async def transmit(self, frame):
+        return await self.device.transmit(frame)
+
+    def status(self):
+        if self.device is None:
+            return OBDStatus.NOT_CONNECTED
+        return self.device.status()
+
+    def close(self):
+        if self.device is not None:
+            self.device.close()
+            self.device = None
@@ -0,0 +1,195 @@
+########################################################################
+#
+# baud.py
+#
+# UART baud rate detection and upgrade (STBR / STBRT / STWBR)
+#
+########################################################################
+
+import time
+import logging
+
+from .reader import PromptReader
+from .cache import DeviceCache
+
+logger = logging.getLogger(__name__)
+
+
+class BaudNegotiator(object):
+    """
+        Finds the current UART baud rate of the adapter and steps up to the
+        highest rate that passes an integrity and throughput test.
+
+        STBR handshake: the adapter answers OK at the old rate, switches,
+        prints its firmware ID at the new rate and waits STBRT ms for a CR
+        from the host, reverting to the old rate when it does not get it.
+
+        An STBR rate is lost on ATZ (the adapter restarts at its NVM rate)
+        unless STWBR saved it: reset() resets the adapter and does the
+        handshake again.
+    """
+
+    # tried from the highest
+    UPGRADE_BAUDS = [ 2000000, 1000000, 500000, 230400, 115200 ]
+
+    # STBRT: ms the adapter waits for the host at the new baud rate
+    SWITCH_TIMEOUT_MS = 200
+
+    # integrity test: commands that must all return the same ID string
+    TEST_ROUNDS = 20
+    # minimum accepted STI round trips per second
+    MIN_ROUNDS_S = 50
+
+    def __init__(self, port, try_bauds, cache=None):
+        self.port      = port
+        self.try_bauds = try_bauds
+        self.cache     = cache if cache is not None else DeviceCache()
+        self.reader    = PromptReader(port)
+        self.serial    = None
+        self.firmware  = None
+        self.results   = {} # baud -> (passed, round trips/s)
+        self.boot      = None   # rate the adapter restarts at after ATZ
+
+    def __command(self, cmd, timeout=0.5):
+        self.port.reset_input_buffer()
+        self.reader.reset()
+        self.port.write(cmd + b"\r")
+        return self.reader.read_lines(timeout)
+
+    def probe(self):
+        """ returns the baud rate the adapter currently answers at, or None """
+        cached = [ e.get('baud') for _, e in self.cache.items() if e.get('baud') ]
+        order = []
+        for baud in cached + list(self.try_bauds):
+            if baud not in order:
+                order.append(baud)
+
+        for baud in order:
+            self.port.baudrate = baud
+            # never a bare CR, the adapter would repeat its last command (a
+            # stale STPX on the 'w' port): STI is read only. Bytes garbled
+            # at a wrong rate can still be in the adapter input and turn
+            # the first STI into '?', so a prompt without the ID gets a
+            # second try
+            for _ in range(2):
+                self.port.reset_input_buffer()
+                self.reader.reset()
+                self.port.write(b"STI\r")
+                response = self.reader.read_until_prompt(0.1)
+                if response is None:
+                    break
+                if b"STN" in response:
+                    logger.info("adapter answers at %d baud" % baud)
+                    return baud
+        return None
+
+    def identify(self):
+        """ STI / STSN of the adapter, serial number is the cache key """
+        r = self.__command(b"STI")
+        self.firmware = r[-1] if r else None
+        r = self.__command(b"STSN")
+        self.serial = r[-1] if r else None
+        return self.serial
+
+    def test(self, rounds=None):
+        """ integrity and throughput test at the current baud rate """
+        rounds = rounds or self.TEST_ROUNDS
+        t0 = time.monotonic()
+        for _ in range(rounds):
+            r = self.__command(b"STI")
+            if not r or r[-1] != self.firmware:
+                return False, 0.0
+        rate = rounds / (time.monotonic() - t0)
+        return rate >= self.MIN_ROUNDS_S, rate
+
+    def switch(self, baud):
+        """ STBR handshake, returns True when the adapter runs at `baud` """
+        old = self.port.baudrate
+        self.__command(b"STBRT %d" % self.SWITCH_TIMEOUT_MS)
+        self.port.reset_input_buffer()
+        self.reader.reset()
+        self.port.write(b"STBR %d\r" % baud)
+        ok = self.port.read_until(b"OK")
+        if not ok.endswith(b"OK"):
+            return False
+        time.sleep(0.005) # let the "OK\r" leave the adapter at the old rate
+        self.port.baudrate = baud
+        self.port.reset_input_buffer()
+        banner = self.port.read_until(b"\r")
+        if self.firmware and self.firmware.encode() not in banner:
+            # no valid ID at the new rate, the adapter reverts on its own
+            time.sleep(self.SWITCH_TIMEOUT_MS / 1000.0)
+            self.port.baudrate = old
+            return False
+        self.port.write(b"\r")
+        if self.reader.read_until_prompt(0.5) is None:
+            self.port.baudrate = old
+            return False
+        return True
+
+    def connect(self, save=False):
+        """
+            returns the baud rate left configured on the port: the cached
+            rate for this board when it still works, otherwise the highest
+            rate that passes test(). save=True writes it to NVM (STWBR).
+        """
+        current = self.probe()
+        if current is None:
+            logger.warning("adapter not answering at any baud rate")
+            return None
+        self.identify()
+
+        cached = self.cache.get(self.serial, 'baud') if self.serial else None
+        candidates = [ b for b in self.UPGRADE_BAUDS if b > current ]
+        if cached and cached >= current:
+            candidates = [cached] + [ b for b in candidates if b != cached ]
+
+        chosen = current
+        for baud in candidates:
+            if baud == current:
+                break
+            if not self.switch(baud):
+                self.results[baud] = (False, 0.0)
+                continue
+            passed, rate = self.test()
+            self.results[baud] = (passed, rate)
+            if passed:
+                chosen = baud
+                break
+            # unstable: go back to the rate we came from
+            if not self.switch(current):
+                self.probe()
+
+        self.boot = current
+        if save and chosen != current:
+            r = self.__command(b"STWBR")
+            if r != ['OK']:
+                logger.warning("STWBR did not return 'OK'")
+            else:
+                self.boot = chosen
+        if self.serial:
+            self.cache.update(self.serial, baud=chosen)
+        logger.info("UART baud rate %d (tested: %s)" % (chosen, self.results))
+        return chosen
+
+    def reset(self, timeout=2.0):
+        """
+            ATZ keeping the rate left by connect(): the adapter answers at
+            its boot rate, the STBR handshake is then done again. Returns
+            the rate the port is left at, None when the adapter is lost.
+        """
+        chosen = self.port.baudrate
+        self.port.reset_input_buffer()
+        self.reader.reset()
+        self.port.write(b"ATZ\r")
+        self.port.flush()
+        if self.boot is not None:
+            self.port.baudrate = self.boot
+        if self.reader.read_until_prompt(timeout) is None:
+            # not at the expected rate (an STBR left by a previous run)
+            if self.probe() is None:
+                logger.warning("adapter not answering after ATZ")
+                return None
+        if self.port.baudrate != chosen and not self.switch(chosen):
+            logger.warning("UART stays at %d baud after ATZ" % self.port.baudrate)
+        return self.port.baudrate
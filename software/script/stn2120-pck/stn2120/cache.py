@@ -0,0 +1,80 @@
+########################################################################
+#
+# cache.py
+#
+# On disk cache of what we learned about every board (by serial number)
+#
+########################################################################
+
+import os
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".stn2120", "devices.json")
+
+
+class DeviceCache(object):
+    """
+        {serial number: {field: value}} stored as JSON, e.g.
+        {"110012345678": {"baud": 2000000, "port": "/dev/ttyUSB1", "role": "r"}}
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("STN2120_CACHE", DEFAULT_PATH)
+        self.__lock = threading.Lock()
+        self.__data = None
+
+    def __load(self):
+        if self.__data is None:
+            try:
+                with open(self.path) as f:
+                    self.__data = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.__data = {}
+        return self.__data
+
+    def get(self, serial, field=None, default=None):
+        with self.__lock:
+            entry = self.__load().get(serial, {})
+        if field is None:
+            return dict(entry)
+        return entry.get(field, default)
+
+    def items(self):
+        with self.__lock:
+            return [ (k, dict(v)) for k, v in self.__load().items() ]
+
+    def update(self, serial, **fields):
+        """ merges the fields into the entry of `serial` and saves the file """
+        with self.__lock:
+            data = self.__load()
+            data.setdefault(serial, {}).update(fields)
+            self.__save(data)
+
+    def update_unique(self, serial, field, value, **fields):
+        """
+            update() of `serial` with `field` = `value`, removing that field
+            from every other entry holding the same value (e.g. a role
+            taken over by a new board)
+        """
+        with self.__lock:
+            data = self.__load()
+            for other, entry in data.items():
+                if other != serial and entry.get(field) == value:
+                    del entry[field]
+            fields[field] = value
+            data.setdefault(serial, {}).update(fields)
+            self.__save(data)
+
+    def __save(self, data):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("cannot write device cache %s: %s" % (self.path, e))
@@ -0,0 +1,230 @@
+########################################################################
+#
+# decoder.py
+#
+# Allocation free decoder of STMA monitor lines into compact records
+#
+########################################################################
+
+from array import array
+
+# hex digit value of every byte, -1 when it is not a hex digit
+_HEX = [-1] * 256
+for _c in b"0123456789ABCDEF":
+    _HEX[_c] = int(chr(_c), 16)
+for _c in b"abcdef":
+    _HEX[_c] = int(chr(_c), 16)
+
+# 2 hex digits (hi << 8 | lo) -> byte value, -1 when not hex
+_PAIR = [-1] * 65536
+for _hi in range(256):
+    if _HEX[_hi] >= 0:
+        for _lo in range(256):
+            if _HEX[_lo] >= 0:
+                _PAIR[_hi << 8 | _lo] = _HEX[_hi] << 4 | _HEX[_lo]
+
+_SPACE = 0x20
+_CR    = 0x0D
+_LF    = 0x0A
+
+# CanFrame.flags
+EXTENDED = 0x01   # 29 bit identifier
+PADDED   = 0x02   # dlc < 8, payload padded with zeros
+
+
+class CanFrame(object):
+    """ one CAN frame, payload always 8 bytes long (see dlc) """
+
+    __slots__ = ('can_id', 'dlc', 'data', 'flags', 'timestamp')
+
+    def __init__(self, can_id, dlc, data, flags=0, timestamp=None):
+        self.can_id    = can_id
+        self.dlc       = dlc
+        self.data      = data
+        self.flags     = flags
+        self.timestamp = timestamp
+
+    @property
+    def payload(self):
+        """ the dlc bytes actually on the bus """
+        return self.data[:self.dlc]
+
+    def key(self):
+        """
+            (id, dlc, payload, extended) hashable key, the padded payload
+            alone would make a 2 byte frame equal to its 8 byte version
+        """
+        return (self.can_id, self.dlc, self.data, self.flags & EXTENDED)
+
+    def stpx(self):
+        """ b'h:<ID>,d:<DATA> ' as used by TransmitEngine / STPX """
+        if self.flags & EXTENDED:
+            header = b'h:%08X,d:' % self.can_id
+        else:
+            header = b'h:%03X,d:' % self.can_id
+        return header + b''.join(b'%02X ' % b for b in self.data[:self.dlc])
+
+    def line(self):
+        """ STMA text form, b'412 10 00 00 06 00 FF 00 00' """
+        if self.flags & EXTENDED:
+            header = b'%02X %02X %02X %02X' % tuple(self.can_id.to_bytes(4, 'big'))
+        else:
+            header = b'%03X' % self.can_id
+        return header + b''.join(b' %02X' % b for b in self.data[:self.dlc])
+
+    def __eq__(self, other):
+        return (isinstance(other, CanFrame) and self.can_id == other.can_id
+                and self.dlc == other.dlc and self.data == other.data
+                and self.flags == other.flags)
+
+    def __repr__(self):
+        return "CanFrame(%s)" % self.line().decode()
+
+
+def _parse(buf, start, end, out, base=0):
+    """
+        parses one monitor line buf[start:end] (terminator excluded),
+        writes the payload into out[base:base + 8] (zero padded) and returns
+        (can_id, dlc, flags), or None when the line is not a frame
+    """
+    hexv = _HEX
+    pair = _PAIR
+    while start < end and buf[start] == _SPACE:
+        start += 1
+    while end > start and (buf[end - 1] == _SPACE or buf[end - 1] == _CR):
+        end -= 1
+    if end - start < 3:
+        return None
+
+    flags = 0
+    if end - start > 3 and buf[start + 2] == _SPACE:
+        # 29 bit header printed as 4 bytes: 18 DA F1 10
+        can_id = 0
+        i = start
+        for _ in range(4):
+            if i + 2 > end:
+                return None
+            v = pair[buf[i] << 8 | buf[i + 1]]
+            if v < 0:
+                return None
+            can_id = can_id << 8 | v
+            i += 3
+        flags = EXTENDED
+        i -= 1
+    elif end - start >= 8 and buf[start + 3] != _SPACE and (
+            end - start == 8 or buf[start + 8] == _SPACE or not (end - start) & 1):
+        # 29 bit header without spaces (ATS0): 18DAF110, told from an 11
+        # bit one by its length when the data is not spaced either, an 11
+        # bit line (3 + 2 * dlc digits) is always odd
+        can_id = 0
+        for i in range(start, start + 8):
+            v = hexv[buf[i]]
+            if v < 0:
+                return None
+            can_id = can_id << 4 | v
+        flags = EXTENDED
+        i = start + 8
+    else:
+        a = hexv[buf[start]]
+        b = hexv[buf[start + 1]]
+        c = hexv[buf[start + 2]]
+        if a < 0 or b < 0 or c < 0:
+            return None
+        can_id = a << 8 | b << 4 | c
+        i = start + 3
+
+    dlc = 0
+    while i < end:
+        if buf[i] == _SPACE:
+            i += 1
+            continue
+        if i + 1 >= end or dlc == 8:
+            return None
+        v = pair[buf[i] << 8 | buf[i + 1]]
+        if v < 0:
+            return None
+        out[base + dlc] = v
+        dlc += 1
+        i += 2
+    for k in range(base + dlc, base + 8):
+        out[k] = 0
+    if dlc < 8:
+        flags |= PADDED
+    return can_id, dlc, flags
+
+
+def decode_line(buf, start=0, end=None):
+    """
+        decodes one monitor line (bytes, bytearray or memoryview, with or
+        without terminator) into a CanFrame, None if it is not a frame.
+        Headers and data can be spaced or not (ATS1 / ATS0): 7E8 02 41 0C,
+        7E802410C, 18 DA F1 10 02 41 0C, 18DAF110 02 41 0C, 18DAF11002410C
+    """
+    if end is None:
+        end = len(buf)
+    while end > start and (buf[end - 1] == _LF or buf[end - 1] == _CR):
+        end -= 1
+    out = bytearray(8)
+    r = _parse(buf, start, end, out)
+    if r is None:
+        return None
+    return CanFrame(r[0], r[1], bytes(out), r[2])
+
+
+class FrameColumns(object):
+    """
+        array backed columns filled by decode_batch(), one row per frame:
+        ids (uint32), dlc (uint8), flags (uint8), data (8 bytes per row)
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.ids   = array('I', bytes(4 * capacity))
+        self.dlc   = array('B', bytes(capacity))
+        self.flags = array('B', bytes(capacity))
+        self.data  = bytearray(8 * capacity)
+        self.__data_view = memoryview(self.data)
+        self.count = 0
+
+    def clear(self):
+        self.count = 0
+
+    def full(self):
+        return self.count == self.capacity
+
+    def payload(self, row):
+        return self.__data_view[8 * row:8 * row + self.dlc[row]]
+
+    def frame(self, row):
+        return CanFrame(self.ids[row], self.dlc[row],
+                        bytes(self.__data_view[8 * row:8 * row + 8]), self.flags[row])
+
+
+def decode_batch(buf, columns, start=0, end=None):
+    """
+        decodes every complete line of buf[start:end] into `columns`,
+        stops when the columns are full. Returns the offset of the first
+        byte not consumed (start of a partial line, or of the line that
+        did not fit). Lines that are not frames are skipped.
+    """
+    if end is None:
+        end = len(buf)
+    find = buf.find if hasattr(buf, 'find') else bytes(buf).find
+    i = start
+    while i < end and not columns.full():
+        # lines end with CRLF (ATL1), CR alone when linefeeds are off
+        eol = find(b'\n', i, end)
+        if eol < 0:
+            eol = find(b'\r', i, end)
+            if eol < 0:
+                break
+        if eol > i:
+            row = columns.count
+            r = _parse(buf, i, eol, columns.data, 8 * row)
+            if r is not None:
+                columns.ids[row]   = r[0]
+                columns.dlc[row]   = r[1]
+                columns.flags[row] = r[2]
+                columns.count = row + 1
+        i = eol + 1
+    return i
@@ -0,0 +1,80 @@
+########################################################################
+#
+# dedupe.py
+#
+# Per (CAN ID, DLC, payload) duplicate suppression with a time window
+#
+########################################################################
+
+import time
+import logging
+from collections import OrderedDict
+
+from .decoder import decode_line
+
+logger = logging.getLogger(__name__)
+
+
+class FrameDeduplicator(object):
+    """
+        Drops a frame when the same (CAN ID, DLC, payload) already passed less
+        than `window` seconds ago.
+
+        Keys live in an insertion ordered hash table: lookups are O(1),
+        expired keys are evicted from the oldest end and at most
+        `max_entries` keys are kept. The window is measured from the frame
+        that passed, so a frame repeated forever still passes once per
+        window.
+    """
+
+    def __init__(self, window=0.1, max_entries=4096, clock=time.monotonic):
+        self.window      = window
+        self.max_entries = max_entries
+        self.clock       = clock
+        self.__seen      = OrderedDict() # key -> time it last passed
+        self.passed      = 0
+        self.suppressed  = 0
+        self.evicted     = 0
+
+    def check(self, key, now=None):
+        """ True when the frame must be forwarded, False when it is a repeat """
+        if now is None:
+            now = self.clock()
+        seen = self.__seen
+
+        t = seen.get(key)
+        if t is not None and now - t < self.window:
+            self.suppressed += 1
+            return False
+
+        seen[key] = now
+        seen.move_to_end(key)
+        # evict what fell out of the window, then enforce the size bound
+        while seen:
+            oldest = next(iter(seen.values()))
+            if now - oldest < self.window:
+                break
+            seen.popitem(last=False)
+        if len(seen) > self.max_entries:
+            seen.popitem(last=False)
+            self.evicted += 1
+        self.passed += 1
+        return True
+
+    def check_line(self, line, now=None):
+        """ check() for a raw monitor line, lines that are not frames pass """
+        frame = decode_line(line)
+        if frame is None:
+            return True
+        return self.check(frame.key(), now)
+
+    def check_frame(self, frame, now=None):
+        return self.check(frame.key(), now)
+
+    def stats(self):
+        return {
+            'passed'     : self.passed,
+            'suppressed' : self.suppressed,
+            'evicted'    : self.evicted,
+            'entries'    : len(self.__seen),
+        }
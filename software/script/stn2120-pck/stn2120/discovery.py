@@ -0,0 +1,107 @@
+########################################################################
+#
+# discovery.py
+#
+# Parallel STN2120 port discovery with a cached serial -> port/role map
+#
+########################################################################
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+
+from .baud import BaudNegotiator
+from .cache import DeviceCache
+from .utils import possible_ports
+
+logger = logging.getLogger(__name__)
+
+# STN2120.__port roles, in the order they are returned
+ROLES = ('r', 'w')
+
+
+def identify_port(path, bauds, cache=None):
+    """
+        opens `path`, finds the baud rate the adapter answers at and asks
+        it for STI / STSN (BaudNegotiator.probe() / identify(), the rates
+        cached for known boards are tried first), returns {'port', 'baud',
+        'firmware', 'serial'} or None when nothing answers
+    """
+    try:
+        port = serial.serial_for_url(path, bauds[0], timeout=0.05)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    negotiator = BaudNegotiator(port, bauds, cache)
+    try:
+        baud = negotiator.probe()
+        if baud is not None:
+            negotiator.identify()
+            return {
+                'port'     : path,
+                'baud'     : baud,
+                'firmware' : negotiator.firmware,
+                'serial'   : negotiator.serial or path,
+            }
+    except (serial.SerialException, OSError) as e:
+        logger.debug("%s: %s" % (path, e))
+    finally:
+        port.close()
+    return None
+
+
+def _probe_all(paths, bauds, cache, workers):
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        found = pool.map(lambda p: identify_port(p, bauds, cache), paths)
+    return [ f for f in found if f is not None ]
+
+
+def discover(bauds, cache=None, workers=8):
+    """
+        returns [port of role 'r', port of role 'w']
+
+        The ports cached for both roles are checked first (one STSN each,
+        in parallel), when they still belong to the same boards nothing
+        else is probed. Otherwise every candidate port is probed at once
+        and roles are kept per serial number, so the same physical board
+        always gets the same role whatever the device node order is.
+    """
+    cache = cache if cache is not None else DeviceCache()
+
+    known = dict((e['role'], (serial_no, e)) for serial_no, e in cache.items()
+                 if e.get('role') in ROLES and e.get('port'))
+    if len(known) == len(ROLES) and all(os.path.exists(known[r][1]['port']) for r in ROLES):
+        check_bauds = []
+        for baud in [ known[r][1].get('baud') for r in ROLES ] + list(bauds):
+            if baud and baud not in check_bauds:
+                check_bauds.append(baud)
+        checks = _probe_all([ known[r][1]['port'] for r in ROLES ], check_bauds, cache, workers)
+        expected = dict((known[r][1]['port'], known[r][0]) for r in ROLES)
+        if len(checks) == len(ROLES) and all(expected[c['port']] == c['serial'] for c in checks):
+            logger.info("ports from cache: %s" % [ known[r][1]['port'] for r in ROLES ])
+            return [ known[r][1]['port'] for r in ROLES ]
+
+    found = _probe_all(possible_ports(), bauds, cache, workers)
+    logger.info("STN2120 found: %s" % found)
+
+    roles = {}
+    free = list(ROLES)
+    # boards seen before keep their role
+    for f in found:
+        role = cache.get(f['serial'], 'role')
+        if role in free:
+            roles[role] = f
+            free.remove(role)
+    # new boards get the remaining roles by serial number, not by port order
+    for f in sorted(found, key=lambda f: f['serial']):
+        if f in roles.values() or not free:
+            continue
+        roles[free.pop(0)] = f
+
+    # a role belongs to one board only, a swapped out board loses it
+    for role, f in roles.items():
+        cache.update_unique(f['serial'], 'role', role, port=f['port'], firmware=f['firmware'])
+    return [ roles[r]['port'] for r in ROLES if r in roles ]
@@ -0,0 +1,203 @@
+########################################################################
+#
+# echo.py
+#
+# Suppression of our own written frames echoed back by the monitor node
+#
+########################################################################
+
+import os
+import time
+import threading
+import logging
+from collections import deque
+
+from .decoder import CanFrame, decode_line
+
+logger = logging.getLogger(__name__)
+
+
+def echo_key(line):
+    """
+        CanFrame.key() of a frame line or CanFrame, the stripped line when
+        it is not a frame
+    """
+    if isinstance(line, CanFrame):
+        return line.key()
+    frame = decode_line(line)
+    if frame is None:
+        return bytes(line).strip()
+    return frame.key()
+
+
+class EchoSuppressor(object):
+    """
+        Bounded multiset of the frames recently written to the bus.
+
+        Every frame the bridge writes with the 'w' node is seen again by
+        the 'r' node monitor; add() records it and consume() removes one
+        occurrence when it comes back, so it is not sent back to the
+        remote side. Both are O(1). An occurrence that never comes back
+        expires after `ttl` seconds, and at most `max_entries` occurrences
+        are kept (the oldest is evicted first).
+    """
+
+    def __init__(self, ttl=1.0, max_entries=1024, clock=time.monotonic):
+        self.ttl         = ttl
+        self.max_entries = max_entries
+        self.clock       = clock
+
+        self.__lock    = threading.Lock()
+        self.__pending = {}      # key -> deque of expiry times, oldest first
+        self.__order   = deque() # (expiry, key) in insertion order
+        self.__size    = 0
+
+        self.added      = 0
+        self.suppressed = 0
+        self.expired    = 0
+        self.evicted    = 0
+
+    def __drop_oldest(self):
+        """ pops the oldest order entry, True when it was still pending """
+        expires, key = self.__order.popleft()
+        times = self.__pending.get(key)
+        # consumed occurrences leave their order entry behind
+        if not times or times[0] > expires:
+            return False
+        times.popleft()
+        if not times:
+            del self.__pending[key]
+        self.__size -= 1
+        return True
+
+    def __expire(self, now):
+        order = self.__order
+        while order and order[0][0] <= now:
+            if self.__drop_oldest():
+                self.expired += 1
+
+    def add(self, line, now=None):
+        """ records a frame written to the bus """
+        key = echo_key(line)
+        if now is None:
+            now = self.clock()
+        expires = now + self.ttl
+        with self.__lock:
+            self.__expire(now)
+            times = self.__pending.get(key)
+            if times is None:
+                times = self.__pending[key] = deque()
+            times.append(expires)
+            self.__order.append((expires, key))
+            self.__size += 1
+            self.added  += 1
+            while self.__size > self.max_entries:
+                if self.__drop_oldest():
+                    self.evicted += 1
+
+    def consume(self, line, now=None):
+        """ True (and one occurrence removed) when `line` is our own echo """
+        key = echo_key(line)
+        if now is None:
+            now = self.clock()
+        with self.__lock:
+            self.__expire(now)
+            times = self.__pending.get(key)
+            if not times:
+                return False
+            times.popleft()
+            if not times:
+                del self.__pending[key]
+            self.__size -= 1
+            self.suppressed += 1
+            return True
+
+    def clear(self):
+        with self.__lock:
+            self.__pending.clear()
+            self.__order.clear()
+            self.__size = 0
+
+    def stats(self):
+        return {
+            'added'      : self.added,
+            'suppressed' : self.suppressed,
+            'expired'    : self.expired,
+            'evicted'    : self.evicted,
+            'pending'    : self.__size,
+        }
+
+
+class RedisEchoSuppressor(object):
+    """
+        EchoSuppressor interface on Redis, for setups where the written
+        frames must be shared with other processes. Needs the optional
+        `redis` package (and Redis >= 5.0 for ZPOPMIN), imported only when
+        this class is used.
+
+        Every frame line has its own sorted set `<name>:<line>`, one member
+        per occurrence scored by its expiry time: occurrences expire one by
+        one after `ttl` seconds, as with EchoSuppressor, whatever the rate
+        of the writes. `clock` must be shared by the processes (wall time).
+        Each frame costs a round trip to the server.
+    """
+
+    def __init__(self, name, ttl=1.0, clock=time.time, **redis_args):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("RedisEchoSuppressor needs the 'redis' package")
+        self.name  = name
+        self.ttl   = ttl
+        self.clock = clock
+        self.__db  = redis.Redis(**redis_args)
+        # members are unique across the processes sharing `name`
+        self.__uid = os.urandom(4).hex()
+        self.added      = 0
+        self.suppressed = 0
+        self.clear()
+
+    def __key(self, line):
+        if isinstance(line, CanFrame):
+            line = line.line()
+        return self.name.encode() + b":" + bytes(line).strip()
+
+    def add(self, line, now=None):
+        if now is None:
+            now = self.clock()
+        key = self.__key(line)
+        pipe = self.__db.pipeline()
+        # a set written faster than its echoes come back stays bounded
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zadd(key, {"%s-%d" % (self.__uid, self.added): now + self.ttl})
+        # the set itself goes away with its last occurrence
+        pipe.pexpire(key, int(1000 * self.ttl) + 1)
+        pipe.execute()
+        self.added += 1
+
+    def consume(self, line, now=None):
+        if now is None:
+            now = self.clock()
+        key = self.__key(line)
+        pipe = self.__db.pipeline()
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zpopmin(key)
+        _, popped = pipe.execute()
+        if popped:
+            self.suppressed += 1
+            return True
+        return False
+
+    def __keys(self):
+        return self.__db.scan_iter(match=self.name.encode() + b":*")
+
+    def clear(self):
+        for key in self.__keys():
+            self.__db.delete(key)
+
+    def stats(self):
+        return {
+            'added'      : self.added,
+            'suppressed' : self.suppressed,
+            'pending'    : sum(self.__db.zcount(key, self.clock(), "+inf") for key in self.__keys()),
+        }
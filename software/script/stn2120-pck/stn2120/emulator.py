@@ -0,0 +1,430 @@
+########################################################################
+#
+# emulator.py
+#
+# pty backed STN2120 emulator for tests and benchmarks without hardware
+#
+########################################################################
+
+import os
+import re
+import sys
+import tty
+import time
+import errno
+import select
+import itertools
+import threading
+import logging
+from collections import deque
+
+from .decoder import CanFrame, decode_line, EXTENDED, PADDED
+
+logger = logging.getLogger(__name__)
+
+# STPX h:<ID>,d:<DATA>[,t:<ms>][,r:<n>]
+_STPX = re.compile(r'^STPX\s*H:([0-9A-F]{1,8})\s*,\s*D:([0-9A-F ]*?)\s*(,.*)?$')
+
+# STFPA / STFBA <pattern>, <mask>
+_FILTER = re.compile(r'^ST(FPA|FBA)\s*([0-9A-F]{1,8})\s*,\s*([0-9A-F]{1,8})$')
+
+# ATPP <pp> SV <value> / ATPP <pp> ON / ATPP <pp> OFF
+_PP = re.compile(r'^ATPP\s*([0-9A-F]{2})\s*(SV\s*([0-9A-F]{2})|ON|OFF)$')
+
+# commands that only have to be acknowledged
+_ACK = ('ATAL', 'ATAT', 'ATCAF', 'ATV', 'ATR', 'ATST', 'ATD', 'STPO', 'STPC',
+        'STCMM', 'STPTO', 'STPTOT', 'STPTRQ', 'STBRT', 'STWBR', 'STSBR', 'STCSM')
+
+_serials = itertools.count(1)
+
+
+def synthetic_traffic(ids=(0x412, 0x7DF, 0x18DAF110), dlc=8):
+    """ endless CanFrames cycling over `ids`, the payload is a counter """
+    for n in itertools.count():
+        can_id = ids[n % len(ids)]
+        data = (n // len(ids)).to_bytes(8, 'big')[8 - dlc:] + bytes(8 - dlc)
+        flags = (EXTENDED if can_id > 0x7FF else 0) | (PADDED if dlc < 8 else 0)
+        yield CanFrame(can_id, dlc, data, flags)
+
+
+def capture_traffic(path, loop=True):
+    """ CanFrames played back from a capture of STMA output (one frame per line) """
+    with open(path, 'rb') as f:
+        frames = [ fr for fr in (decode_line(l) for l in f) if fr is not None ]
+    if not frames:
+        raise ValueError("no frames in %s" % path)
+    while True:
+        for fr in frames:
+            yield fr
+        if not loop:
+            return
+
+
+class VirtualBus(object):
+    """ CAN bus shared by emulated adapters, STPX frames reach every other monitor """
+
+    def __init__(self):
+        self.__lock  = threading.Lock()
+        self.__nodes = []
+
+    def attach(self, node):
+        with self.__lock:
+            self.__nodes.append(node)
+
+    def detach(self, node):
+        with self.__lock:
+            if node in self.__nodes:
+                self.__nodes.remove(node)
+
+    def publish(self, sender, frame):
+        with self.__lock:
+            nodes = list(self.__nodes)
+        for n in nodes:
+            if n is not sender:
+                n.receive(frame)
+
+
+class EmulatedSTN2120(object):
+    """
+        Answers the AT/ST command set used by this package on a pseudo
+        terminal: open `port` with serial.serial_for_url() like a real
+        adapter.
+
+        In STMA monitor mode the adapter prints frames from `traffic` (an
+        iterable of decoder.CanFrame, see synthetic_traffic() and
+        capture_traffic()) at `rate` frames/s, plus the frames other nodes
+        of the same VirtualBus transmit with STPX. Any byte from the host
+        stops the monitor. When the host does not read fast enough the
+        output buffer fills and the monitor stops with BUFFER FULL, like
+        the adapter does.
+    """
+
+    FIRMWARE = "STN2120 v5.6.5"
+    DEVICE   = "OBDLink r1.7"
+    ELM_ID   = "ELM327 v1.4b"
+
+    # bytes of monitor output buffered before BUFFER FULL
+    OUTPUT_BUFFER = 8192
+    # frames printed per scheduling round at most
+    MAX_BURST = 256
+
+    def __init__(self, serial_no=None, bus=None, traffic=None, rate=0.0, clock_drift_ppm=0.0):
+        self.serial_no = serial_no or "EMU%06d" % next(_serials)
+        self.bus       = bus
+        self.traffic   = iter(traffic) if traffic is not None else None
+        self.rate      = rate
+        self.clock_rate = 1.0 + clock_drift_ppm * 1e-6
+        self.__t_boot   = time.monotonic()
+
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        os.set_blocking(self.__master, False)
+        self.port = os.ttyname(self.__slave)
+
+        self.__lock     = threading.Lock()
+        self.__rx       = deque(maxlen=4096) # frames from the bus
+        self.__input    = bytearray()
+        self.__output   = bytearray()
+        self.__at1      = self.DEVICE
+        self.__pp       = {}                 # pp -> (value, enabled), kept over ATZ
+        self.__running  = True
+        self.__reset()
+
+        self.commands    = 0
+        self.monitored   = 0
+        self.transmitted = 0
+        self.overflows   = 0
+
+        if bus is not None:
+            bus.attach(self)
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    # ------------------------------------------------------------- state
+
+    def __reset(self):
+        pp = dict((k, v) for k, (v, on) in self.__pp.items() if on)
+        self.echo      = pp.get(0x09, 0x00) != 0xFF
+        self.headers   = pp.get(0x01, 0xFF) == 0x00
+        self.linefeeds = False
+        self.cr        = pp.get(0x0D, 0x0D)   # carriage return character
+        self.spaces    = True
+        self.timestamps = False
+        self.protocol  = "0"
+        self.filters   = {'FPA': [], 'FBA': []}
+        self.monitoring   = False
+        self.__await_cr   = False
+        self.__t_monitor  = 0.0
+        self.__monitor_n  = 0
+
+    def __eol(self):
+        return bytes([self.cr]) + (b"\n" if self.linefeeds else b"")
+
+    def __passes(self, can_id):
+        if any(can_id & m == p & m for p, m in self.filters['FBA']):
+            return False
+        if self.filters['FPA']:
+            return any(can_id & m == p & m for p, m in self.filters['FPA'])
+        return True
+
+    def __format(self, frame):
+        line = frame.line()
+        if not self.headers:
+            line = line[12 if frame.flags & EXTENDED else 4:]
+        if not self.spaces:
+            line = line.replace(b" ", b"")
+        if self.timestamps:
+            # ms counter of the adapter clock, 16 bits
+            ticks = int((time.monotonic() - self.__t_boot) * self.clock_rate * 1000)
+            line = b"%04X " % (ticks & 0xFFFF) + line
+        return line
+
+    # ---------------------------------------------------------- commands
+
+    def __command(self, raw):
+        """ returns the response lines, None when no prompt must follow """
+        cmd = raw.decode('ascii', 'ignore').strip().upper()
+        text = raw.decode('ascii', 'ignore').strip()
+        key = cmd.replace(" ", "")
+        self.commands += 1
+
+        if self.__await_cr or not key:
+            # STBR: the host confirms the new baud rate with a CR
+            self.__await_cr = False
+            return []
+        if key in ("ATZ", "ATWS"):
+            self.__reset()
+            return ["", self.ELM_ID]
+        if key == "ATI":
+            return [self.ELM_ID]
+        if key == "AT@1":
+            return [self.__at1]
+        if key == "ATRV":
+            return ["12.6V"]
+        if key == "STI":
+            return [self.FIRMWARE]
+        if key == "STDI":
+            return [self.DEVICE]
+        if key == "STSN":
+            return [self.serial_no]
+        if key == "STPR":
+            return [self.protocol]
+        if cmd.startswith("STS@1"):
+            self.__at1 = text[5:].strip()
+            return ["OK"]
+        for flag, attr in (("ATE", "echo"), ("ATH", "headers"), ("ATL", "linefeeds"),
+                           ("ATS", "spaces"), ("STTS", "timestamps")):
+            if key in (flag + "0", flag + "1"):
+                setattr(self, attr, key[-1] == "1")
+                return ["OK"]
+        if key.startswith("ATPP"):
+            m = _PP.match(cmd)
+            if not m:
+                return ["?"]
+            pp = int(m.group(1), 16)
+            value, on = self.__pp.get(pp, (0xFF, False))
+            if m.group(3):
+                value = int(m.group(3), 16)
+            else:
+                on = m.group(2) == "ON"
+            self.__pp[pp] = (value, on)
+            return ["OK"]
+        if key in ("STMA", "ATMA"):
+            self.monitoring  = True
+            self.__t_monitor = time.monotonic()
+            self.__monitor_n = 0
+            return None
+        if key.startswith("STPX"):
+            return self.__stpx(cmd)
+        if key.startswith("STBR") and key[4:].isdigit():
+            self.__await_cr = True
+            self.__write(b"OK" + self.__eol() + self.FIRMWARE.encode() + self.__eol())
+            return None
+        if key in ("STFAC", "STFPC", "STFBC"):
+            if key != "STFBC":
+                self.filters['FPA'] = []
+            if key != "STFPC":
+                self.filters['FBA'] = []
+            return ["OK"]
+        if key.startswith("STFPA") or key.startswith("STFBA"):
+            m = _FILTER.match(cmd)
+            if not m:
+                return ["?"]
+            self.filters[m.group(1)].append((int(m.group(2), 16), int(m.group(3), 16)))
+            return ["OK"]
+        if key.startswith(_ACK):
+            return ["OK"]
+        if key.startswith("STP") and key[3:].isalnum():
+            self.protocol = key[3:]
+            return ["OK"]
+        return ["?"]
+
+    def __stpx(self, cmd):
+        m = _STPX.match(cmd)
+        if not m:
+            return ["?"]
+        data = bytes.fromhex(m.group(2).replace(" ", ""))
+        if len(data) > 8:
+            return ["?"]
+        can_id = int(m.group(1), 16)
+        flags = (EXTENDED if len(m.group(1)) > 3 else 0) | (PADDED if len(data) < 8 else 0)
+        frame = CanFrame(can_id, len(data), data + bytes(8 - len(data)), flags)
+        self.transmitted += 1
+        if self.bus is not None:
+            self.bus.publish(self, frame)
+        return ["OK"]
+
+    def receive(self, frame):
+        """ a frame transmitted by another node of the bus """
+        self.__rx.append(frame)
+
+    # ------------------------------------------------------------ output
+
+    def __write(self, data):
+        self.__output += data
+
+    def __respond(self, raw):
+        if self.echo:
+            self.__write(raw + self.__eol())
+        lines = self.__command(raw)
+        if lines is None:
+            return
+        # ATL may just have changed the line terminator
+        eol = self.__eol()
+        for line in lines:
+            self.__write(line.encode() + eol)
+        self.__write(b">")
+
+    def __monitor(self, now):
+        eol = self.__eol()
+        out = []
+        while self.__rx:
+            out.append(self.__rx.popleft())
+        if self.traffic is not None and self.rate > 0:
+            due = int((now - self.__t_monitor) * self.rate) - self.__monitor_n
+            due = min(due, self.MAX_BURST)
+            for frame in itertools.islice(self.traffic, due):
+                out.append(frame)
+            self.__monitor_n += due
+        for frame in out:
+            if self.__passes(frame.can_id):
+                self.__write(self.__format(frame) + eol)
+                self.monitored += 1
+        if len(self.__output) > self.OUTPUT_BUFFER:
+            self.overflows += 1
+            self.monitoring = False
+            self.__write(b"BUFFER FULL" + eol + b">")
+
+    def __flush(self):
+        if not self.__output:
+            return
+        try:
+            n = os.write(self.__master, self.__output)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EIO):
+                raise
+            return
+        del self.__output[:n]
+
+    # -------------------------------------------------------------- loop
+
+    def __run(self):
+        while self.__running:
+            wait = 0.001 if self.monitoring or self.__output else 0.05
+            try:
+                readable, _, _ = select.select([self.__master], [], [], wait)
+            except (OSError, ValueError):
+                break
+            if readable:
+                try:
+                    data = os.read(self.__master, 4096)
+                except OSError as e:
+                    if e.errno in (errno.EAGAIN, errno.EIO):
+                        continue
+                    break
+                with self.__lock:
+                    self.__feed(data)
+            with self.__lock:
+                if self.monitoring:
+                    self.__monitor(time.monotonic())
+                self.__flush()
+
+    def __feed(self, data):
+        for b in data:
+            if b in (0x0A, 0x00):
+                # linefeeds and NULs are ignored, "STMA\r\n" keeps monitoring
+                continue
+            if self.monitoring:
+                # any other character stops the monitor, it is discarded
+                self.monitoring = False
+                self.__write(self.__eol() + b">")
+                continue
+            if b == 0x0D:
+                raw = bytes(self.__input)
+                del self.__input[:]
+                self.__respond(raw)
+            elif b != 0x7F:
+                self.__input.append(b)
+
+    def stats(self):
+        return {
+            'commands'    : self.commands,
+            'monitored'   : self.monitored,
+            'transmitted' : self.transmitted,
+            'overflows'   : self.overflows,
+        }
+
+    def close(self):
+        self.__running = False
+        self.__thread.join(1)
+        if self.bus is not None:
+            self.bus.detach(self)
+        for fd in (self.__master, self.__slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def emulate_pair(rate=0.0, traffic=None):
+    """
+        two adapters on the same VirtualBus, the 'r' node prints `traffic`
+        at `rate` frames/s. Returns (bus, [node r, node w]), pass
+        [n.port for n in nodes] as STN2120 portdev.
+    """
+    bus = VirtualBus()
+    if traffic is None and rate > 0:
+        traffic = synthetic_traffic()
+    return bus, [ EmulatedSTN2120(bus=bus, traffic=traffic, rate=rate),
+                  EmulatedSTN2120(bus=bus) ]
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="STN2120 emulator on pseudo terminals")
+    parser.add_argument('--rate', type=float, default=100.0, help="monitor frames/s")
+    parser.add_argument('--capture', help="STMA capture to play back instead of synthetic frames")
+    args = parser.parse_args(argv)
+
+    traffic = capture_traffic(args.capture) if args.capture else None
+    bus, nodes = emulate_pair(args.rate, traffic)
+    for role, n in zip(('r', 'w'), nodes):
+        print("%s: %s (%s)" % (role, n.port, n.serial_no))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for n in nodes:
+        print(n.serial_no, n.stats())
+        n.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,243 @@
+########################################################################
+#
+# filters.py
+#
+# Compiles a set of CAN IDs / ID ranges into STFPA pattern-mask filters
+#
+########################################################################
+
+import heapq
+import logging
+
+logger = logging.getLogger(__name__)
+
+# slots available for pass filters on the adapter
+MAX_PASS_FILTERS = 10
+
+
+def line_length(dlc, width=11):
+    """ b'412 10 00 00 06 00 FF 00 00 \r\n': ID, space, 3 chars per byte, CRLF """
+    return (3 if width == 11 else 8) + 1 + 3 * dlc + 2
+
+
+class CANFilter(object):
+    """ one pattern/mask pair, an ID passes when id & mask == pattern """
+
+    def __init__(self, pattern, mask):
+        self.pattern = pattern & mask
+        self.mask    = mask
+
+    def matches(self, can_id):
+        return can_id & self.mask == self.pattern
+
+    def size(self, width):
+        """ number of IDs accepted by the filter """
+        return 1 << (width - bin(self.mask & ((1 << width) - 1)).count('1'))
+
+    def merge(self, other):
+        """ smallest single filter accepting both """
+        mask = self.mask & other.mask & ~(self.pattern ^ other.pattern)
+        return CANFilter(self.pattern, mask)
+
+    def covers(self, other):
+        return self.mask & other.mask == self.mask and other.pattern & self.mask == self.pattern
+
+    def command(self, width=11):
+        if (self.pattern | self.mask) >> width:
+            raise ValueError("%r wider than %d bits" % (self, width))
+        digits = 3 if width == 11 else 8
+        return b"STFPA %0*X, %0*X" % (digits, self.pattern, digits, self.mask)
+
+    def __repr__(self):
+        return "CANFilter(0x%X, 0x%X)" % (self.pattern, self.mask)
+
+
+class _WantedSet(object):
+    """
+        binary trie of the wanted IDs built from their exact cover, counts
+        the wanted IDs a filter accepts without walking the ID space
+    """
+
+    def __init__(self, blocks, width):
+        self.width = width
+        self.__cache = {}
+        # node: [child 0, child 1, wanted IDs below, every ID below wanted]
+        self.root = [None, None, 0, False]
+        for block in blocks:
+            size = block.size(width)
+            node = self.root
+            node[2] += size
+            for bit in range(width - 1, size.bit_length() - 2, -1):
+                k = (block.pattern >> bit) & 1
+                if node[k] is None:
+                    node[k] = [None, None, 0, False]
+                node = node[k]
+                node[2] += size
+            node[3] = True
+
+    def count(self, f):
+        """ number of wanted IDs accepted by `f` """
+        key = (f.pattern, f.mask)
+        count = self.__cache.get(key)
+        if count is None:
+            count = self.__cache[key] = self.__count(self.root, self.width - 1, f.pattern, f.mask)
+        return count
+
+    def bound(self, f):
+        """ upper bound of count(f), the wanted IDs under the fixed top bits of `f` """
+        node = self.root
+        for bit in range(self.width - 1, -1, -1):
+            if node[3] or not f.mask >> bit & 1:
+                break
+            node = node[f.pattern >> bit & 1]
+            if node is None:
+                return 0
+        return node[2]
+
+    def __count(self, node, bit, pattern, mask):
+        low = (1 << (bit + 1)) - 1
+        if not mask & low:
+            # no constraint left below this node
+            return node[2]
+        if node[3]:
+            return 1 << (bit + 1 - bin(mask & low).count('1'))
+        if mask >> bit & 1:
+            child = node[pattern >> bit & 1]
+            return self.__count(child, bit - 1, pattern, mask) if child is not None else 0
+        count = 0
+        for child in node[:2]:
+            if child is not None:
+                count += self.__count(child, bit - 1, pattern, mask)
+        return count
+
+
+def _intervals(ids, ranges, width):
+    """
+        sorted, disjoint [lo, hi] intervals of every wanted ID, ValueError
+        for an ID that does not fit in `width` bits or a reversed range
+    """
+    if width not in (11, 29):
+        raise ValueError("width must be 11 or 29, not %r" % (width,))
+    top = (1 << width) - 1
+    spans = [ (i, i) for i in ids ] + [ tuple(r) for r in ranges ]
+    for lo, hi in spans:
+        if lo > hi:
+            raise ValueError("range 0x%X-0x%X: first ID after the last one" % (lo, hi))
+        if lo < 0 or hi > top:
+            span = "%#x" % lo if lo == hi else "%#x-%#x" % (lo, hi)
+            raise ValueError("CAN ID %s out of the %d bit range" % (span, width))
+    spans.sort()
+    merged = []
+    for lo, hi in spans:
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return merged
+
+
+def _blocks(lo, hi, width):
+    """ exact decomposition of [lo, hi] into aligned pattern/mask blocks """
+    full = (1 << width) - 1
+    while lo <= hi:
+        size = lo & -lo if lo else 1 << width
+        while size > hi - lo + 1:
+            size >>= 1
+        yield CANFilter(lo, full & ~(size - 1))
+        lo += size
+
+
+def compile_filters(ids=(), ranges=(), max_filters=MAX_PASS_FILTERS, width=11):
+    """
+        returns the pass filters accepting every wanted ID
+
+        ids: iterable of CAN IDs, ranges: iterable of (first, last) IDs.
+        ValueError when there is none (no pass filter at all lets every
+        ID through), for an ID out of `width` bits or a reversed range.
+        The exact cover is built first, then the pair of filters whose
+        merge lets through the fewest unwanted IDs is merged until the
+        set fits in `max_filters` slots. The merge costs are kept in a
+        heap, only the pairs of the new filter are computed after a merge.
+    """
+    intervals = _intervals(ids, ranges, width)
+    if not intervals:
+        raise ValueError("no CAN ID to pass")
+    filters = []
+    for lo, hi in intervals:
+        filters.extend(_blocks(lo, hi, width))
+    if len(filters) <= max_filters:
+        return filters
+
+    wanted = _WantedSet(filters, width)
+    # filters still in the set by creation order, ties are broken on it
+    alive = dict(enumerate(filters))
+
+    # (unwanted IDs let through, i, j, merged filter, exact): pairs enter
+    # with a cheap lower bound and are only counted exactly when on top
+    heap = []
+    for i in alive:
+        for j in range(i + 1, len(filters)):
+            m = alive[i].merge(alive[j])
+            heap.append((m.size(width) - wanted.bound(m), i, j, m, False))
+    heapq.heapify(heap)
+
+    seq = len(filters)
+    while len(alive) > max_filters:
+        extra, i, j, m, exact = heapq.heappop(heap)
+        if i not in alive or j not in alive:
+            continue
+        if not exact:
+            heapq.heappush(heap, (m.size(width) - wanted.count(m), i, j, m, True))
+            continue
+        del alive[i], alive[j]
+        for k in [ k for k, f in alive.items() if m.covers(f) ]:
+            del alive[k]
+        for k in alive:
+            n = alive[k].merge(m)
+            heapq.heappush(heap, (n.size(width) - wanted.bound(n), k, seq, n, False))
+        alive[seq] = m
+        seq += 1
+
+    return list(alive.values())
+
+
+def false_positives(filters, ids=(), ranges=(), width=11):
+    """
+        number of unwanted IDs accepted by the filter set, exact for 11 bit
+        IDs, an upper bound (overlaps counted twice) for 29 bit IDs
+    """
+    wanted = sum(hi - lo + 1 for lo, hi in _intervals(ids, ranges, width))
+    if width == 11:
+        accepted = sum(1 for can_id in range(1 << width)
+                       if any(f.matches(can_id) for f in filters))
+    else:
+        accepted = sum(f.size(width) for f in filters)
+    return accepted - wanted
+
+
+def uart_report(filters, rates, width=11):
+    """
+        expected UART load with and without the filters
+
+        rates: {CAN ID: frames/s} or {CAN ID: (frames/s, dlc)} as measured
+        on the bus (see STN2120.sample_bus_rates())
+    """
+    before = 0.0
+    after  = 0.0
+    for can_id, rate in rates.items():
+        fps, dlc = rate if isinstance(rate, tuple) else (rate, 8)
+        load = fps * line_length(dlc, width)
+        before += load
+        if any(f.matches(can_id) for f in filters):
+            after += load
+    return {
+        'filters'        : [ f.command(width).decode() for f in filters ],
+        'bytes_s_before' : before,
+        'bytes_s_after'  : after,
+        'reduction'      : 1 - after / before if before else 0.0,
+    }
+
+
+def filter_commands(filters, width=11):
+    """ commands loading the filter set on the adapter """
+    return [b"STFAC"] + [ f.command(width) for f in filters ]
@@ -8,15 +8,24 @@ import serial
 import time
 import sys
 import glob
+import zlib
 
-import redis
-
-from .protocols import *
 from .utils import OBDStatus
-from .network.netcom import socket_clients
+from .reader import PromptReader
+from .transmit import TransmitEngine, TransmitError
+from .scheduler import CyclicScheduler
+from . import filters
+from .baud import BaudNegotiator
+from . import discovery
+from .profiles import NODE_PROFILES, format_marker, parse_marker
+from .decoder import CanFrame, decode_line
+from .echo import EchoSuppressor
+from .timing import split_timestamp, ClockModel, LatencyHistogram
+from .metrics import REGISTRY
+from . import trace
+from .trace import TRACER
 from datetime import datetime
 from  stn2120.frames import frames
-from stn2120.network import netcom
 
 from queue import Queue
 from threading import Thread
@@ -32,17 +41,18 @@ class STN2120:
 
     STN_PROMPT = b'>'
 
+    # protocol classes by name, the protocols package is imported on use
     _SUPPORTED_PROTOCOLS = {
-        "1" : SAE_J1850_PWM,
-        "2" : SAE_J1850_VPW,
-        "3" : ISO_9141_2,
-        "4" : ISO_14230_4_5baud,
-        "5" : ISO_14230_4_fast,
-        "31" : ISO_15765_4_11bit_500k, # CAN
-        "7" : ISO_15765_4_29bit_500k, # CAN
-        "8" : ISO_15765_4_11bit_250k, # CAN
-        "9" : ISO_15765_4_29bit_250k, # CAN
-        "A" : SAE_J1939,              # CAN
+        "1" : 'SAE_J1850_PWM',
+        "2" : 'SAE_J1850_VPW',
+        "3" : 'ISO_9141_2',
+        "4" : 'ISO_14230_4_5baud',
+        "5" : 'ISO_14230_4_fast',
+        "31" : 'ISO_15765_4_11bit_500k',  # CAN
+        "7" : 'ISO_15765_4_29bit_500k',  # CAN
+        "8" : 'ISO_15765_4_11bit_250k',  # CAN
+        "9" : 'ISO_15765_4_29bit_250k',  # CAN
+        "A" : 'SAE_J1939',               # CAN
         #"B" : None, # user defined 1
         #"C" : None, # user defined 2
     }
@@ -63,16 +73,85 @@ class STN2120:
 
     _TRY_BAUDS = [ 2000000, 38400, 9600, 230400, 115200, 57600, 19200 ]
 
-    def __init__(self, portdev, baudrate, protocol, role, timeout):
+    # commands return as soon as the prompt arrives, these are only the
+    # fallback when the prompt never shows up
+    CMD_TIMEOUT   = 1.0
+    RESET_TIMEOUT = 2.0
+
+    # longest STMA line (29 bit ID, 8 bytes, timestamp) with some margin
+    MAX_MONITOR_LINE = 64
+
+    # STPX commands kept in flight on the 'w' node
+    TX_WINDOW     = 4
+
+    # prints the adapter timestamp counter in front of every monitored
+    # frame (timestamps=True), TIMESTAMP_TICK seconds per count over
+    # TIMESTAMP_BITS bits
+    TIMESTAMP_CMD  = b"STTS 1"
+    TIMESTAMP_TICK = 1e-3
+    TIMESTAMP_BITS = 16
+
+    # configuration applied by __initialize_node after ATZ,
+    # None stands for STP <protocol>
+    _NODE_CONFIG = [
+        b"ATE0",
+        b"ATH1",
+        b"ATL1",
+        None,
+        b"STPO",
+        b"STCMM 1",
+        b"ATAT 0",
+        b"ATCAF0",
+        b"ATV0",
+        b"ATR0",
+    ]
+
+    def __init__(self, portdev, baudrate, protocol, role, timeout, save_baud=False,
+                 warm_start=False, use_profiles=False, timestamps=False):
         """
+            baudrate='auto' probes the current UART baud rate of every port
+            and upgrades it (STBR) to the fastest stable one, save_baud=True
+            also writes it to the adapter NVM (STWBR)
+
+            warm_start=True reads back the adapter state and skips ATZ (and
+            every command already applied) when the adapter is still
+            configured from a previous run
+
+            use_profiles=True boots each node from its NVM profile
+            (profiles.NODE_PROFILES), written once and verified by checksum
+
+            timestamps=True turns on the adapter timestamps on the 'r'
+            node: monitored frames get their bus time in host monotonic
+            time (timing.ClockModel) and latencies are kept per stage,
+            see latency_report()
         """
 
         self.__status   = OBDStatus.NOT_CONNECTED
+        from .protocols import UnknownProtocol
         self.__protocol = UnknownProtocol([])
         self.__role = role
         self.__client = ''
         self.__cmd = None
         self.__port = {'r':None, 'w':None}
+        self.__reader = {'r':None, 'w':None}
+        self.__init_report = {'r':[], 'w':[]}
+        self.__tx = None
+        self.__warm_start = warm_start
+        self.__use_profiles = use_profiles
+        self.__cyclic = None
+        self.__timestamps = timestamps
+        self.__delta = None   # netcom.DeltaEncoder of the bridge, wire='delta'
+        self.__clock = ClockModel(self.TIMESTAMP_TICK, self.TIMESTAMP_BITS)
+        self.__latency = {
+            'bus_host'    : LatencyHistogram(),
+            'host_socket' : LatencyHistogram(),
+        }
+        self.__metrics = {}
+        # a node failing during the parallel init only closes its own port
+        self.__initializing = False
+        self.__init_failed = set()
+        self.__init_errors = {}   # node -> exception raised by its init thread
+        self.__baud = {}   # node -> BaudNegotiator, baudrate='auto'
 
         if portdev is None or len(portdev) <2:
             logger.info("Scanning for ports ..")
@@ -88,10 +167,12 @@ class STN2120:
         if role == 'clt_diag':
             #w_timeout = 1
             #timeout   = 1
+            auto_baud = baudrate == 'auto'
             baudrate  = 2000000
         elif role == 'clt_car':
             #w_timeout = 1
             #timeout   = 1
+            auto_baud = baudrate == 'auto'
             baudrate  = 2000000
         else:
             raise AttributeError("Role error, options: clt_diag or clt_car")
@@ -110,9 +191,41 @@ class STN2120:
                                     bytesize = 8,
                                     #writeTimeout=w_timeout,
                                     timeout = timeout) # seconds
-            self.__initialize_node(protocol,item) # self.__port[item]
+            if auto_baud:
+                self.__baud[item] = BaudNegotiator(self.__port[item], self._TRY_BAUDS)
+                self.__baud[item].connect(save_baud)
+            self.__reader[item] = PromptReader(self.__port[item], self.STN_PROMPT)
+            self.__metrics[item] = self.__port_metrics(item)
             i += 1
 
+        # both nodes are initialized at the same time
+        init_threads = [Thread(target=self.__initialize_node_safe, args=(protocol, item))
+                        for item in self.__port]
+        self.__initializing = True
+        for t in init_threads:
+            t.start()
+        for t in init_threads:
+            t.join()
+        self.__initializing = False
+        if self.__init_failed or self.__init_errors:
+            # the board needs both nodes, close the one that succeeded too
+            logger.error("init failed on node(s) %s" %
+                         ", ".join(sorted(self.__init_failed | set(self.__init_errors))))
+            self.close()
+        for item in self.__port:
+            # raised in the caller's thread, as the sequential init did
+            if item in self.__init_errors:
+                raise self.__init_errors[item]
+        for item in self.__init_report:
+            logger.info("init %s: %.3f s %s" % (item,
+                        sum(t for _, t in self.__init_report[item]),
+                        self.__init_report[item]))
+        if timestamps and self.__port['r']:
+            r = self.__step(self.TIMESTAMP_CMD, 'r', self.CMD_TIMEOUT)
+            if not self.__isok(r):
+                logger.warning("%s did not return 'OK', timestamps OFF" % self.TIMESTAMP_CMD.decode())
+                self.__timestamps = False
+
         #self.__port{'read'} = serial.serial_for_url(portdev[0],baudrate, \
         #                            parity   = serial.PARITY_NONE, \
         #                            stopbits = 1, \
@@ -127,32 +240,177 @@ class STN2120:
         #                            timeout = timeout) # seconds
 
 
+    def __port_metrics(self, node):
+        """ counters of one node in metrics.REGISTRY, labelled with its port """
+        labels = {'port': self.__port[node].port, 'node': node}
+        return {
+            'frames'      : REGISTRY.counter('stn2120_frames_total',
+                                'CAN frames read from the adapter', **labels),
+            'bytes'       : REGISTRY.counter('stn2120_bytes_total',
+                                'bytes read from the adapter', **labels),
+            'buffer_full' : REGISTRY.counter('stn2120_buffer_full_total',
+                                'BUFFER FULL events of the monitor', **labels),
+            'deduped'     : REGISTRY.counter('stn2120_frames_deduped_total',
+                                'frames dropped as duplicates', **labels),
+            'echo'        : REGISTRY.counter('stn2120_frames_echo_total',
+                                'own frames seen back on the monitor and not forwarded', **labels),
+            'dropped'     : REGISTRY.counter('stn2120_frames_dropped_total',
+                                'frames from the bridge that could not be written', **labels),
+        }
+
+    def __config_checksum(self, protocol):
+        """
+        fingerprint of the configuration, the config part of the AT@1
+        marker (profiles.format_marker) once it has been applied
+        """
+        config = b";".join(c if c is not None else b"STP" + protocol.encode()
+                           for c in self._NODE_CONFIG)
+        return "%08X" % zlib.crc32(config)
+
+    def __read_marker(self, node):
+        """ (profile tag, config checksum) stored in the AT@1 string of the adapter """
+        r = self.__step(b"AT@1", node, self.CMD_TIMEOUT)
+        return parse_marker(r[-1] if r else "")
+
+    def __write_marker(self, node, current, profile, config):
+        """
+        stores the AT@1 marker (STS@1, an NVM write) only when it differs
+        from `current`, the marker read from the adapter
+        """
+        if (profile, config) == tuple(current):
+            return True
+        r = self.__step(b"STS@1 " + format_marker(profile, config).encode(), node, self.CMD_TIMEOUT)
+        # written before the session commands, the echo can still be ON
+        return self.__isok(r, expectEcho=True)
+
+    def __load_profile(self, protocol, node):
+        """
+        checks the profile tag in the AT@1 marker of the adapter, writes
+        the profile to NVM when it is missing or outdated, then sends the
+        session part of the profile. Returns False on failure.
+        """
+        profile = NODE_PROFILES[node](protocol)
+        try:
+            current = self.__read_marker(node)
+            if current[0] != profile.tag():
+                logger.info("writing profile %r on node %s" % (profile, node))
+                for cmd in profile.write_commands():
+                    r = self.__step(cmd, node, self.CMD_TIMEOUT)
+                    if not self.__isok(r, expectEcho=True):
+                        logger.error("%s did not return 'OK'" % cmd.decode())
+                        return False
+                # the warm start part of the marker is kept
+                if not self.__write_marker(node, current, profile.tag(), current[1]):
+                    logger.error("STS@1 did not return 'OK'")
+                    return False
+                # programmable parameters are loaded on reset
+                self.__reset(node)
+
+            for cmd in profile.session:
+                r = self.__step(cmd, node, self.CMD_TIMEOUT)
+                if not self.__isok(r, expectEcho=True):
+                    logger.error("%s did not return 'OK'" % cmd.decode())
+                    return False
+        except serial.SerialException as e:
+            logger.info("profile %s: %s" % (node, e))
+            return False
+
+        self.__status = OBDStatus.CAR_CONNECTED
+        return True
+
+    def __warm_start_node(self, protocol, node):
+        """
+        reads back the adapter state (echo, STPR, AT@1 marker) and only
+        sends the commands that differ, returns False when a full reset
+        is needed
+        """
+        checksum = self.__config_checksum(protocol)
+        try:
+            r = self.__step(b"STPR", node, self.CMD_TIMEOUT)
+            if not r:
+                return False
+            # echo is back ON after any reset or power cycle
+            echo = r[0] == "STPR"
+            same_protocol = r[-1] == protocol
+            current = self.__read_marker(node)
+            configured = current[1] == checksum
+            # an adapter booting into a profile has echo OFF after a reset
+            # too, its session settings may be gone: they are sent again
+            if not echo and configured and same_protocol and current[0] is None:
+                logger.info("warm start %s: adapter already configured" % node)
+                self.__status = OBDStatus.CAR_CONNECTED
+                return True
+
+            for cmd in self._NODE_CONFIG:
+                if cmd is None:
+                    if same_protocol:
+                        continue
+                    cmd = b"STP" + protocol.encode()
+                elif cmd == b"ATE0" and not echo:
+                    continue
+                r = self.__step(cmd, node, self.CMD_TIMEOUT)
+                if not self.__isok(r, expectEcho=(cmd == b"ATE0")):
+                    logger.info("warm start %s: %s did not return 'OK'" % (node, cmd.decode()))
+                    return False
+            self.__write_marker(node, current, current[0], checksum)
+        except serial.SerialException as e:
+            logger.info("warm start %s: %s" % (node, e))
+            return False
+
+        self.__status = OBDStatus.CAR_CONNECTED
+        return True
+
+    def __initialize_node_safe(self, protocol, node):
+        """ __initialize_node() in an init thread, keeps its exception for the caller """
+        try:
+            self.__initialize_node(protocol, node)
+        except Exception as e:
+            self.__init_errors[node] = e
+            # the port is closed by close() once both threads are done
+            self.__init_failed.add(node)
+
+    def __reset(self, node):
+        """
+            ATZ, through the BaudNegotiator of the node when its baud rate
+            was negotiated: ATZ restarts the adapter at its NVM rate
+        """
+        negotiator = self.__baud.get(node)
+        if negotiator is None:
+            return self.__step(b"ATZ", node, self.RESET_TIMEOUT)
+        t0 = time.monotonic()
+        negotiator.reset(self.RESET_TIMEOUT)
+        self.__init_report[node].append(("ATZ", time.monotonic() - t0))
+
         # ---------------------------- ATZ (reset) ----------------------------
     def __initialize_node(self,protocol=None, node=None):
+        if self.__use_profiles and self.__load_profile(protocol, node):
+            return
+        if self.__warm_start and self.__warm_start_node(protocol, node):
+            return
         try:
-            self.__send(b"ATZ", node, 1 ) # wait 1 second for ELM to initialize
+            self.__reset(node) # returns on the prompt after the reset
             # return data can be junk, so don't bother checking
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
         # -------------------------- ATE0 (echo OFF) --------------------------
 
-        r = self.__send(b"ATE0", node, 0.1)   #
+        r = self.__step(b"ATE0", node, self.CMD_TIMEOUT)   #
         if not self.__isok(r, expectEcho=True):
-            self.__error("ATE0 did not return 'OK'")
+            self.__error("ATE0 did not return 'OK'", node)
             return
         else:
             print (r)
         # ------------------------- ATH1 (headers ON) -------------------------
-        r = self.__send(b"ATH1", node, 0.1 )
+        r = self.__step(b"ATH1", node, self.CMD_TIMEOUT)
         if not self.__isok(r):
-            self.__error("ATH1 did not return 'OK', or echoing is still ON")
+            self.__error("ATH1 did not return 'OK', or echoing is still ON", node)
             return
 
         # ------------------------ ATL1 (linefeeds OFF) -----------------------
-        r = self.__send(b"ATL1", node, 0.1)  #<-------
+        r = self.__step(b"ATL1", node, self.CMD_TIMEOUT)  #<-------
         if not self.__isok(r):
-            self.__error("ATL1 did not return 'OK'")
+            self.__error("ATL1 did not return 'OK'", node)
             return
 
         # by now, we've successfuly communicated with the ELM, but not the car
@@ -168,10 +426,12 @@ class STN2120:
                        )
         else:
             logger.error("Connected to the adapter, but failed to connect to the vehicle")
+            if self.__port[node] is None:
+                return
 
-        r = self.__send(b"STPO", node, 0.1)  #<-------
+        r = self.__step(b"STPO", node, self.CMD_TIMEOUT)  #<-------
         if not self.__isok(r):
-            self.__error("STPO did not return 'OK'")
+            self.__error("STPO did not return 'OK'", node)
             return
         try:
             ########## IMPORTANT ##########################################3
@@ -182,10 +442,10 @@ class STN2120:
             ###     2    Receive all frames, including frames with errors – no CAN ACKs.
             ###-------------- IMPORTAN!! --------------###
             ###  To read the CAN BUS it needs to be set on mode 1
-            print(self.__send(b"STCMM 1", node, 0.1))#
+            print(self.__step(b"STCMM 1", node, self.CMD_TIMEOUT))#
             # return data can be junk, so don't bother checking
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
         try:
         #    ####################################################################
@@ -195,29 +455,33 @@ class STN2120:
         #    ### 2       Adaptive timing on, aggressive mode.This option may increase throughput on
         #    ###         slower connections, at the expense of slightly increasing
         #    ###         the risk of missing frames.
-            print(self.__send(b"ATAT 0",node, 0.1) )#
+            print(self.__step(b"ATAT 0", node, self.CMD_TIMEOUT) )#
             # Set adaptive timing mode
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
         try:
-            self.__send(b"ATCAF0",node, 0.1)
+            self.__step(b"ATCAF0", node, self.CMD_TIMEOUT)
             # Turn CAN Auto Formatting on or off
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
         try:
-            self.__send(b"ATV0", node, 0.1) #
+            self.__step(b"ATV0", node, self.CMD_TIMEOUT) #
             ### Variable DLC (Data Length Code) on/off*
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
         try:
-            self.__send(b"ATR0", node, 0.1)#
+            self.__step(b"ATR0", node, self.CMD_TIMEOUT)#
             #  Turn responses on or off
         except serial.SerialException as e:
-            self.__error(e)
+            self.__error(e, node)
             return
+        if self.__warm_start:
+            # lets the next run find the configuration already applied
+            current = self.__read_marker(node)
+            self.__write_marker(node, current, current[0], self.__config_checksum(protocol))
 
 
     def __write_init (self):
@@ -225,19 +489,19 @@ class STN2120:
         """
         logger.info("====== Init to WRITE =======" )
         try:
-            print(self.__send(b"ATAL",node, 0.1)) # wait 1 second for ELM to initialize
+            print(self.__send(b"ATAL", node, self.CMD_TIMEOUT))
             # Allow long messages.
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"ATCAF0",node, 0.1))
+            print(self.__send(b"ATCAF0", node, self.CMD_TIMEOUT))
             # Turn CAN Auto Formatting on or off
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"ATV0", node, 0.1)) #
+            print(self.__send(b"ATV0", node, self.CMD_TIMEOUT)) #
             ### Variable DLC (Data Length Code) on/off*
         except serial.SerialException as e:
             self.__error(e)
@@ -257,13 +521,13 @@ class STN2120:
         #->    self.__error(e)
         #->    return
         try:
-            print(self.__send(b"ATR1", node, 0.1))#
+            print(self.__send(b"ATR1", node, self.CMD_TIMEOUT))#
             #  Turn responses on or off
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"ATS0", node, 0.1) )#
+            print(self.__send(b"ATS0", node, self.CMD_TIMEOUT) )#
             #  Turn printing of spaces in OBD responses on or off
         except serial.SerialException as e:
             self.__error(e)
@@ -276,27 +540,27 @@ class STN2120:
         #    ### 2       Adaptive timing on, aggressive mode.This option may increase throughput on
         #    ###         slower connections, at the expense of slightly increasing
         #    ###         the risk of missing frames.
-            print(self.__send(b"ATAT0",node, 0.1) )#
+            print(self.__send(b"ATAT0", node, self.CMD_TIMEOUT) )#
             # Set adaptive timing mode
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"STPTO 25",node, 0.1)) #
+            print(self.__send(b"STPTO 25", node, self.CMD_TIMEOUT)) #
             #  Set OBD request timeout. Takes a decimal para-meter in milliseconds
             # (1 to 65535). Default is 200 ms.
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"STPTOT 1",node, 0.1)) #
+            print(self.__send(b"STPTOT 1", node, self.CMD_TIMEOUT)) #
             # Set message transmission timeout
             # (1 to 65535). Default is 200 ms.
         except serial.SerialException as e:
             self.__error(e)
             return
         try:
-            print(self.__send(b"STPTRQ 0", node, 0.1)) #
+            print(self.__send(b"STPTRQ 0", node, self.CMD_TIMEOUT)) #
             # Set the minimum time between the last response
             # and the next request
         except serial.SerialException as e:
@@ -305,6 +569,13 @@ class STN2120:
         logger.info("====== Init 2 WRITE DONE =======" )
 
 
+    @classmethod
+    def protocol_class(cls, protocol):
+        """ protocols class of a protocol number ("1" through "A") """
+        from . import protocols
+        return getattr(protocols, cls._SUPPORTED_PROTOCOLS[protocol])
+
+
     def set_protocol(self, protocol, node=None):
         logger.info("protocol: %s " % protocol)
         if protocol is not None:
@@ -321,15 +592,15 @@ class STN2120:
 
 
     def manual_protocol(self, protocol, node=None):
-        r = self.__send(b"STP" + protocol.encode(), node, 0.1)
+        r = self.__step(b"STP" + protocol.encode(), node, self.CMD_TIMEOUT)
         if not self.__isok(r):
-            self.__error("STP did not return 'OK'")
+            self.__error("STP did not return 'OK'", node)
             return
         #r0100 = self.__send(b"0100")
 
         #if not self.__has_message(r0100, "UNABLE TO CONNECT"):
         #    # success, found the protocol
-        #    self.__protocol = self._SUPPORTED_PROTOCOLS[protocol](r0100)
+        #    self.__protocol = self.protocol_class(protocol)(r0100)
         #    return True
 
         return True #False
@@ -353,10 +624,19 @@ class STN2120:
         return False
 
 
-    def __error(self, msg):
-        """ handles fatal failures, print logger.info info and closes serial """
-        self.close()
+    def __error(self, msg, node=None):
+        """
+            handles fatal failures, print logger.info info and closes serial.
+            During the parallel init only the port of the failing node is
+            closed, the other init thread is still using its own
+        """
         logger.error(str(msg))
+        TRACER.error(str(msg))
+        if self.__initializing and node is not None:
+            self.__init_failed.add(node)
+            self.__close_port(node)
+        else:
+            self.close()
 
     def status(self):
         return self.__status
@@ -377,11 +657,23 @@ class STN2120:
         self.__status   = OBDStatus.NOT_CONNECTED
         self.__protocol = None
 
-        if self.__port is not None:
-            logger.info("closing port")
-            self.__write(b"ATZ")
-            self.__port.close()
-            self.__port = None
+        if self.__cyclic is not None:
+            self.__cyclic.close()
+            self.__cyclic = None
+        if self.__tx is not None:
+            self.__tx.close()
+            self.__tx = None
+
+        for node in self.__port:
+            self.__close_port(node)
+
+    def __close_port(self, node):
+        """ resets the adapter of `node` and closes its port """
+        if self.__port[node] is not None:
+            logger.info("closing port %s" % node)
+            self.__write(b"ATZ", node)
+            self.__port[node].close()
+            self.__port[node] = None
 
 
 
@@ -401,9 +693,17 @@ class STN2120:
 
 
 
-    def read_can_bus (self):
+    def read_can_bus (self, dedupe=None, callback=None):
         """
+        monitors the bus (STMA) and calls callback(line) for every frame,
+        line being the monitor line without its terminator; frames are
+        printed when there is no callback
+
+        dedupe: optional dedupe.FrameDeduplicator, drops repeats of the
+        same (CAN ID, payload) within its time window
         """
+        if callback is None:
+            callback = lambda line: print('frame:', line)
 
         node='r'
         cmd = b'STMA\r'
@@ -412,23 +712,34 @@ class STN2120:
             self.__port[node].flushInput() # dump everything in the input buffer
             self.__port[node].write(cmd)   # turn the string into bytes and write
             self.__port[node].flush()
-        last_frame =''
 
+        metrics = self.__metrics[node]
         while True:
             data = self.__port[node].readline()
-            if last_frame != data:
+            if data:
                 if data ==b'BUFFER FULL\r\n':
+                    metrics['buffer_full'].inc()
+                    if TRACER.enabled:
+                        TRACER.event(trace.BUFFER_FULL, b'', node)
                     self.__port[node].flushInput()
                     self.__port[node].write(cmd)
                     self.__port[node].flush()
                     continue
-                print('frame:', data)
+                metrics['frames'].inc()
+                metrics['bytes'].inc(len(data))
+                if dedupe is not None and not dedupe.check_line(data):
+                    metrics['deduped'].inc()
+                    continue
+                if TRACER.enabled:
+                    TRACER.event(trace.FRAME_RX, data, node)
+                callback(data.rstrip(b'\r\n'))
 
 
         ##   'clt_car'
         ########################################################################
         ########################################################################
         if self.__role == 'clt_car':
+            from .network import netcom
             srv =  netcom.ThreadedServer('192.168.1.82', 5555)
             print("Socket ready to connect and waiting for diagnosis client")
             srv.listen()
@@ -465,13 +776,15 @@ class STN2120:
                     #socket_client(data)
                     #print ("before frame:", data)
                     #print (str(datetime.now().time()), "clt_car:", data)
+                    if TRACER.enabled:
+                        TRACER.event(trace.FRAME_RX, data, 'r')
                     data = b'h:'+ data[:3] + b',d:' + data[4:]
-                    print ("->", data)
                     srv.send_data(data)
         ########################################################################
         ########################################################################
         ###    'clt_diag'
         elif self.__role == 'clt_diag':
+            from .network import netcom
             print("Socket ready to connect and waiting for car client")
             ### READ data from server
             #regex_frame = '^(frame:){1}([A-F0-9]{3}){1}(.*)$'
@@ -505,11 +818,13 @@ class STN2120:
                     if len(split_frames) > 2:
                         for f in split_frames:
                             if not f == b'':
-                                print(f)
+                                if TRACER.enabled:
+                                    TRACER.event(trace.FRAME_TX, f, 'w')
                                 self.__write2_bus(f)
                     else:
                         #print(data[:3],data[4:])
-                        print(data)
+                        if TRACER.enabled:
+                            TRACER.event(trace.FRAME_TX, data, 'w')
                         self.__write2_bus(data)
         ########################################################################
         ########################################################################
@@ -522,7 +837,8 @@ class STN2120:
         #for n in range(100):
 
         for f in frames:
-            print ("--->",f)
+            if TRACER.enabled:
+                TRACER.event(trace.FRAME_TX, f, 'w')
             #self.__write2_bus(frames[f], frames[(f+1)])
             self.__write2_bus(f)
             frames_written.append(f[:-3])
@@ -538,30 +854,48 @@ class STN2120:
         write_thread = Thread(target=self.writeToBus_test).start()
 
 
+    def transmit_engine(self):
+        """
+        pipelined STPX engine of the 'w' node, created on first use.
+        Once running, every command sent to 'w' goes through it.
+        """
+        if self.__tx is None:
+            tx = self.__tx = TransmitEngine(self.__port['w'], self.TX_WINDOW, self.CMD_TIMEOUT)
+            labels = {'port': self.__port['w'].port, 'node': 'w'}
+            REGISTRY.counter_func('stn2120_stpx_acked_total', lambda: tx.acked,
+                                  'STPX frames acknowledged by the adapter', **labels)
+            REGISTRY.counter_func('stn2120_stpx_errors_total', lambda: tx.errors,
+                                  'STPX frames answered with an error', **labels)
+            REGISTRY.counter_func('stn2120_stpx_timeouts_total', lambda: tx.timeouts,
+                                  'STPX frames never answered', **labels)
+            REGISTRY.counter_func('stn2120_stpx_resyncs_total', lambda: tx.resyncs,
+                                  'transmit pipeline resynchronisations after a missed reply', **labels)
+            REGISTRY.gauge('stn2120_stpx_in_flight', lambda: tx.stats()['in_flight'],
+                           'STPX frames waiting for their answer', **labels)
+        return self.__tx
+
+    def metrics(self):
+        """ snapshot of metrics.REGISTRY, values and per second rates """
+        return REGISTRY.snapshot()
+
+    def cyclic_scheduler(self):
+        """
+        scheduler of periodic frames (ECU emulation) on the 'w' node,
+        created on first use
+        """
+        if self.__cyclic is None:
+            self.__cyclic = CyclicScheduler(self.transmit_engine())
+        return self.__cyclic
+
     def __write2_bus(self,frame):  # (self,id_can,data_can)
         """
-        #t1 = time.time()
-        #data_can = data_can.strip()
-        #id_can = b'STPX h:' + id_can + b', d:' + data_can +  b', t:1  \r\n'
-        """
-        frame_pattern = b'^h:[A-F0-9]{1,3},d:([A-F0-9]{2} ){1,8}'
-        if re.fullmatch(frame_pattern, frame):
-            id_can  = b'STPX ' + frame + b' , t:1 \r'  # , t:6
-            #print ("WRITE --> STPX:",id_can )
-            logger.debug("W2B. ")
-            self.__port['w'].flushInput()   # dump everything in the input buffer
-            self.__port['w'].write(id_can)  # turn the string into bytes and write
-            #self.__port.flush()        # wait for the output buffer to finish transmitting
-            # data = self.__port[node].read_until(b'\r\n')
-            #_ = self.__port['w'].read_until(self.STN_PROMPT)
-            for n in range(15):
-                time.sleep(1/1000000)
-
-            logger.debug("W2B DONE")
-            #logger.debug("f res:" + str(_))
-        else:
-            logger.info("Frame dont write to BUS:" + str(frame))
-        return
+        transmits b'h:<ID>,d:<DATA>' with STPX, returns a Future that is
+        resolved when the adapter acknowledges the frame
+        """
+        f = self.transmit_engine().submit(frame)
+        if f.done() and f.exception() is not None:
+            logger.info("Frame dont write to BUS: %r", frame)
+        return f
 
 
     def send_and_parse(self, cmd, node=None):
@@ -579,7 +913,7 @@ class STN2120:
             logger.info("cannot send_and_parse() when unconnected")
             return None
 
-        logger.info("====== send_and_parse: -%s- =======" % self.__role)
+        logger.debug("====== send_and_parse: -%s- =======", self.__role)
 
         lines = self.__send(cmd,node)
         ###-->self.__client.send_data(lines[0])
@@ -592,22 +926,42 @@ class STN2120:
         return lines
 
 
-    def __send(self, cmd, node = None, delay=None):
+    def __send(self, cmd, node = None, timeout=None):
         """
             unprotected send() function
 
             will __write() the given string, no questions asked.
             returns result of __read() (a list of line strings)
-            after an optional delay.
+            as soon as the prompt arrives, or after the optional
+            timeout.
         """
 
+        if node == 'w' and self.__tx is not None:
+            # the reply is read by the transmit engine
+            try:
+                return self.__tx.command(cmd).result(timeout or self.CMD_TIMEOUT)
+            except TransmitError as e:
+                return e.lines
+            except Exception as e:
+                logger.warning("Failed to read port: " + str(e))
+                return []
+
         self.__write(cmd, node)
+        return self.__read(node, timeout)
 
-        if delay is not None:
-            logger.debug("wait: %d seconds" % delay)
-            time.sleep(delay)
+    def __step(self, cmd, node, timeout):
+        """
+            __send() used by the initialization sequence, the time
+            taken by every command is kept in init_report()
+        """
+        t0 = time.monotonic()
+        r = self.__send(cmd, node, timeout)
+        self.__init_report[node].append((cmd.decode(), time.monotonic() - t0))
+        return r
 
-        return self.__read(node)
+    def init_report(self):
+        """ returns {node: [(command, seconds), ...]} of the initialization """
+        return self.__init_report
 
     def __write(self, cmd, node=None):
         """
@@ -617,15 +971,17 @@ class STN2120:
         if self.__port[node]:
             # self.__port[item]
             cmd += b"\r\n" # terminate
-            logger.debug("write: " + repr(cmd))
+            if TRACER.enabled:
+                TRACER.event(trace.COMMAND, cmd, node)
             self.__port[node].flushInput() # dump everything in the input buffer
+            self.__reader[node].reset()
             self.__port[node].write(cmd) # turn the string into bytes and write
             self.__port[node].flush() # wait for the output buffer to finish transmitting
         else:
             logger.info("cannot perform __write() when unconnected")
 
 
-    def __read(self, node=None):
+    def __read(self, node=None, timeout=None):
         """
             "low-level" read function
 
@@ -636,44 +992,9 @@ class STN2120:
             logger.info("cannot perform __read() when unconnected")
             return []
 
-        buffer = bytearray()
-
-        while True:
-            # retrieve as much data as possible
-            #data =  self.__port[node].read( self.__port[node].in_waiting or 1)
-            data =   self.__port[node].readline()
-
-            # if nothing was recieved
-            if not data:
-                logger.warning("Failed to read port")
-                #break
-            #else:
-            #    print("->",data)
-            buffer.extend(data)
-
-
-            # end on chevron (ELM prompt character)
-            if self.STN_PROMPT in buffer:
-                break
-
-        # log, and remove the "bytearray(   ...   )" part
-        #logger.debug("read: " + repr(buffer)[10:-1])
-        #logger.info("read: " + repr(buffer)[10:-1])
-
-        # clean out any null characters
-        buffer = re.sub(b"\x00", b"", buffer)
-
-        # remove the prompt character
-        if buffer.endswith(self.STN_PROMPT):
-            buffer = buffer[:-1]
-
-        # convert bytes into a standard string
-        string = buffer.decode("utf-8", "ignore")
-
-        # splits into lines while removing empty lines and trailing spaces
-        lines = [ s.strip() for s in re.split("[\r\n]", string) if bool(s) ]
-
-        return lines
+        # bulk reads of everything waiting on the port, returns as soon
+        # as the prompt arrives (see reader.PromptReader)
+        return self.__reader[node].read_lines(timeout)
 
     def read_2_file(self):
         """
@@ -706,8 +1027,40 @@ class STN2120:
                 self.__cmd = b'STMA'
                 print("--------------------->", (time.time() -t1) )
 
-    def read_frames_2_queue(self, queue_read):
-        """ """
+    def __stamp(self, data, arrival):
+        """
+        decoder.CanFrame of a timestamped monitor line, with its bus time
+        in host monotonic time, None when the line is not a frame
+        """
+        ts = split_timestamp(data)
+        if ts is None:
+            return None
+        frame = decode_line(data, ts[1])
+        if frame is None:
+            return None
+        frame.timestamp = self.__clock.update(ts[0], arrival)
+        self.__latency['bus_host'].record(arrival - frame.timestamp)
+        return frame
+
+    def latency_report(self):
+        """
+        latency histograms in us (bus -> host, host -> socket) and the
+        drift of the adapter clock. bus -> host is measured from the
+        fastest frame seen, the constant part of the path is not visible
+        in the timestamps
+        """
+        report = dict((k, h.snapshot()) for k, h in self.__latency.items())
+        report['clock_drift_ppm'] = self.__clock.drift_ppm
+        return report
+
+    def read_frames_2_queue(self, queue_read, dedupe=None):
+        """
+        dedupe: optional dedupe.FrameDeduplicator, drops repeats of the
+        same (CAN ID, payload) within its time window
+
+        with timestamps ON the queue gets decoder.CanFrame records (bus
+        time in .timestamp) instead of the raw lines
+        """
 
         node = 'r'
         cmd = b'STMA\r'
@@ -717,21 +1070,147 @@ class STN2120:
             self.__port[node].flushInput() # dump everything in the input buffer
             self.__port[node].write(cmd)   # turn the string into bytes and write
             self.__port[node].flush()
-        last_frame =''
+        metrics = self.__metrics[node]
+        REGISTRY.gauge('stn2120_queue_depth', queue_read.qsize, 'frames waiting in the read queue',
+                       port=self.__port[node].port, node=node)
         while True:
             data = self.__port[node].readline()
             if data:
-                if last_frame != data:
-                    last_frame = data
-                    if data ==b'BUFFER FULL\r\n':
-                        self.__port[node].flushInput()
-                        self.__port[node].write(cmd)
-                        self.__port[node].flush()
+                if data ==b'BUFFER FULL\r\n':
+                    metrics['buffer_full'].inc()
+                    if TRACER.enabled:
+                        TRACER.event(trace.BUFFER_FULL, b'', node)
+                    self.__port[node].flushInput()
+                    self.__port[node].write(cmd)
+                    self.__port[node].flush()
+                    continue
+                metrics['frames'].inc()
+                metrics['bytes'].inc(len(data))
+                if self.__timestamps:
+                    frame = self.__stamp(data, time.monotonic())
+                    if frame is None:
                         continue
-                    queue_read.put_nowait(data)
-                    #print(data)
+                    if dedupe is not None and not dedupe.check_frame(frame):
+                        metrics['deduped'].inc()
+                        continue
+                    queue_read.put_nowait(frame)
+                    continue
+                if dedupe is not None and not dedupe.check_line(data):
+                    metrics['deduped'].inc()
+                    continue
+                queue_read.put_nowait(data)
+                #print(data)
+
 
 
+    def sample_bus_rates(self, seconds=1.0, node='r'):
+        """
+        runs STMA for a few seconds and returns {CAN ID: (frames/s, dlc)}
+        """
+        port = self.__port[node]
+        counts = {}
+        self.__write(b'STMA', node)
+        t_end = time.monotonic() + seconds
+        buffer = bytearray()
+        while time.monotonic() < t_end:
+            buffer += port.read(port.in_waiting or 1)
+            end = buffer.rfind(b'\n')
+            if end < 0:
+                continue
+            for line in buffer[:end].split(b'\n'):
+                fields = line.split()
+                if len(fields) < 1 or fields[0] == b'STMA':
+                    continue
+                try:
+                    can_id = int(fields[0], 16)
+                except ValueError:
+                    continue
+                n, dlc = counts.get(can_id, (0, 0))
+                counts[can_id] = (n + 1, max(dlc, len(fields) - 1))
+            del buffer[:end + 1]
+        # any character stops the monitor
+        self.__send(b'', node, self.CMD_TIMEOUT)
+        return dict((can_id, (n / seconds, dlc)) for can_id, (n, dlc) in counts.items())
+
+    def set_pass_filters(self, ids=(), ranges=(), max_filters=filters.MAX_PASS_FILTERS,
+                         rates=None, width=11, node='r'):
+        """
+        compiles the wanted IDs / (first, last) ranges into STFPA
+        pattern-mask filters, loads them (STFAC + STFPA) and returns the
+        expected UART load before/after, measured on `rates` or on a one
+        second sample of the bus. width: 11 or 29 bit CAN IDs. ValueError
+        (nothing sent) when there is no ID, an ID out of `width` bits or a
+        reversed range
+        """
+        compiled = filters.compile_filters(ids, ranges, max_filters, width)
+        if rates is None:
+            rates = self.sample_bus_rates(node=node)
+        for cmd in filters.filter_commands(compiled, width):
+            r = self.__send(cmd, node, self.CMD_TIMEOUT)
+            if not self.__isok(r):
+                logger.error("%s did not return 'OK'" % cmd.decode())
+        report = filters.uart_report(compiled, rates, width)
+        report['false_positives'] = filters.false_positives(compiled, ids, ranges, width)
+        logger.info("pass filters: " + str(report))
+        return report
+
+    def monitor_to_ring(self, ring, node='r'):
+        """
+        Serial reader thread: runs STMA and copies the monitor output, in
+        bulk reads, into a FrameRing shared by every consumer
+        """
+        cmd = b'STMA\r'
+        port = self.__port[node]
+        if not port:
+            logger.info("cannot perform monitor_to_ring() when unconnected")
+            return
+
+        port.flushInput() # dump everything in the input buffer
+        port.write(cmd)   # turn the string into bytes and write
+        port.flush()
+
+        metrics = self.__metrics[node]
+        REGISTRY.counter_func('stn2120_ring_lost_bytes_total',
+                              lambda: sum(c.lost for c in ring.cursors()),
+                              'bytes skipped by ring consumers that fell behind',
+                              port=port.port, node=node)
+        pending = b''
+        while not ring.closed:
+            data = port.read(port.in_waiting or 1)
+            if not data:
+                continue
+            metrics['bytes'].inc(len(data))
+            metrics['frames'].inc(data.count(b'\n'))
+            # only whole lines go to the ring, the partial last line is kept
+            # and joined to the next read: a BUFFER FULL marker split between
+            # two reads is then seen whole instead of stored as a frame line
+            if pending:
+                data = pending + data
+            idx = data.find(b'BUFFER FULL')
+            if idx >= 0:
+                metrics['buffer_full'].inc()
+                if TRACER.enabled:
+                    TRACER.event(trace.BUFFER_FULL, b'', node)
+                # the line cut by the marker is incomplete, drop it too
+                ring.write(data[:max(data.rfind(b'\r', 0, idx), data.rfind(b'\n', 0, idx)) + 1])
+                logger.warning("monitor BUFFER FULL, restarting STMA")
+                port.flushInput()
+                port.write(cmd)
+                port.flush()
+                pending = b''
+                continue
+            eol = max(data.rfind(b'\r'), data.rfind(b'\n')) + 1
+            if len(data) - eol > self.MAX_MONITOR_LINE:
+                # no terminator in sight, not a monitor line: it is closed
+                # here so that the consumers do not wait for its end
+                ring.write(data + b'\r')
+                pending = b''
+            elif eol == len(data):
+                ring.write(data)
+                pending = b''
+            else:
+                ring.write(data[:eol])
+                pending = data[eol:]
 
     def read_n_write(self):
         """
@@ -755,7 +1234,8 @@ class STN2120:
                 if data1 :
                     data = data1 + data
                 #print("read:",data1,data) if data1 else print("READ:",data)
-                print("f-->",data)
+                if TRACER.enabled:
+                    TRACER.event(trace.FRAME_RX, data, 'r')
                 data1 = b''
             else:
                 data1 = data
@@ -776,6 +1256,7 @@ class STN2120:
         Function to raise Server-Client and starts Threads:
           process_read_from_server
         """
+        from .network import netcom
         if self.__role == 'clt_diag':
 
             srv_diag =  netcom.ThreadedServer('192.168.1.133', 5555)
@@ -807,78 +1288,180 @@ class STN2120:
                         return srv_car
 
 
-    def read_frames_from_bus(self,list_written_frames, srv, last_process_frame ,node):
-        """ """
+    def read_frames_from_bus(self,list_written_frames, srv, echo ,node, wire='binary'):
+        """
+        Forwards the monitored frames to the server, except the echoes of
+        the frames we wrote ourselves (echo: EchoSuppressor)
+
+        wire: 'binary' sends netcom.FrameEncoder records, 'delta' the
+        delta compressed records of netcom.DeltaEncoder, 'text' the former
+        b'fr:<line>' messages
+        """
+        from .network import netcom
         if node is None:
             node = 'r'
+        encoder = None
+        if wire == 'binary':
+            encoder = netcom.FrameEncoder()
+        elif wire == 'delta':
+            encoder = netcom.DeltaEncoder()
+            self.__delta_metrics(encoder)
         if self.__port[node]:
             self.__port[node].flushInput()
             self.__port[node].write(b"STMA\r\n")
             self.__port[node].flush()
 
             #last_frame = ''
+            metrics = self.__metrics[node]
             while True:
                 data = self.__port[node].read_until(b'\r\n')
                 if data:
-                    #print("read_port ----------------------->",data,"  ",time.time())
-                    logger.debug("frame_from_port ---------> " + str(data.decode()))
-
-                    if last_process_frame.lrem(self.__role,0,data[:-2]) > 0:
-                        logger.debug("read_frame omited")
-                        continue
-                    logger.debug("send_frame_2_server ---------> " + data[:-2].decode() )
-                    srv.send_data(b'fr:' + data[:-2], len(data[:-2]))
-
-    def write_frame_to_bus(self, data,list_written_frames,last_process_frame):
+                    arrival = time.monotonic()
+                    metrics['frames'].inc()
+                    metrics['bytes'].inc(len(data))
+                    if TRACER.enabled:
+                        TRACER.event(trace.FRAME_RX, data, node)
+                    frame = None
+                    if self.__timestamps:
+                        frame = self.__stamp(data, arrival)
+                        if frame is not None:
+                            data = frame.line() + b'\r\n'
+
+                    if encoder is None:
+                        if echo.consume(data[:-2]):
+                            metrics['echo'].inc()
+                            if TRACER.enabled:
+                                TRACER.event(trace.ECHO, data, node)
+                            continue
+                        srv.send_data(b'fr:' + data[:-2], len(data[:-2]))
+                    else:
+                        if frame is None:
+                            frame = decode_line(data)
+                            if frame is None:
+                                metrics['dropped'].inc()
+                                continue
+                        if echo.consume(frame):
+                            metrics['echo'].inc()
+                            if TRACER.enabled:
+                                TRACER.event(trace.ECHO, data, node)
+                            continue
+                        record = encoder.encode(frame)
+                        srv.send_data(record, len(record))
+                    self.__latency['host_socket'].record(time.monotonic() - arrival)
+
+    def __delta_metrics(self, encoder):
+        """ bandwidth and CPU of a netcom.DeltaEncoder in metrics.REGISTRY """
+        REGISTRY.counter_func('netcom_delta_full_bytes_total', lambda: encoder.bytes_full,
+                              'bytes the frames would take as full records')
+        REGISTRY.counter_func('netcom_delta_sent_bytes_total', lambda: encoder.bytes_sent,
+                              'bytes sent by the delta encoder')
+        REGISTRY.counter_func('netcom_delta_keyframes_total', lambda: encoder.keyframes,
+                              'full records sent by the delta encoder')
+        REGISTRY.counter_func('netcom_delta_encode_seconds_total', lambda: encoder.encode_time,
+                              'time spent delta encoding')
+        self.__delta = encoder
+
+    def delta_report(self):
+        """ DeltaEncoder.stats() of the bridge, None without wire='delta' """
+        return self.__delta.stats() if self.__delta is not None else None
+
+    def write_frame_to_bus(self, data,list_written_frames,echo):
         """
+        data: monitor line, or CanFrame from the binary wire format
         """
-        _ = last_process_frame.lpush(self.__role, data)
-        logger.debug("write_frame_to_bus lpush->" + str(_))
         #logger.debug("write_frame_to_bus no frame in QUEUE")
-        self.__write2_bus(b'h:'+ data[:3] + b',d:' + data[4:])
+        frame = data if isinstance(data, CanFrame) else decode_line(data)
+        if frame is None:
+            logger.info("Frame dont write to BUS: %r", data)
+            self.__metrics['w']['dropped'].inc()
+            return
+        if TRACER.enabled:
+            TRACER.event(trace.FRAME_TX, frame.line(), 'w')
+        echo.add(frame)
+        self.transmit_engine().submit_frame(frame)
 
 
-    def process_read_from_server(self, list_written_frames, tmp_srv, last_process_frame ):
+    def process_read_from_server(self, list_written_frames, tmp_srv, echo, wire='binary'):
         """
         Thread that reads data FROM SERVER and place it into a Queue
+
+        wire: 'binary' decodes netcom records, whatever the recv() cuts,
+        'text' splits the former b'fr:' messages
         """
-        print("process_read_from_server")
+        from .network import netcom
+        logger.info("process_read_from_server")
+        decoder = netcom.FrameDecoder() if wire in ('binary', 'delta') else None
         while True:
             data = tmp_srv.get_data()
             if data:
-                #print("data_from_server->",data)
-                logger.debug("frame_from_server: " + data.decode() )
-                if data.count(b'fr:') > 1:
+                if TRACER.enabled:
+                    TRACER.event(trace.SOCKET_RX, data)
+                if decoder is not None:
+                    for frame in decoder.feed(data):
+                        self.write_frame_to_bus(frame,list_written_frames,echo)
+                elif data.count(b'fr:') > 1:
                     split_data = data.split(b'fr:')
                     for d in split_data[1:]:
-                        self.write_frame_to_bus(d,list_written_frames,last_process_frame)
+                        self.write_frame_to_bus(d,list_written_frames,echo)
                 else:
-                    self.write_frame_to_bus(data[3:],list_written_frames,last_process_frame)
+                    self.write_frame_to_bus(data[3:],list_written_frames,echo)
 
 
 
-    def _diagnosis(self):
+    def _diagnosis(self, echo=None, wire='binary', batch_frames=64, batch_delay=0.001, hub=None,
+                   transport=None):
         """
+        echo: table of the frames written to the bus, whose echo on the
+        monitor must not be sent back. Defaults to an in-process
+        echo.EchoSuppressor, echo.RedisEchoSuppressor shares it through Redis
+
+        wire: 'binary' (netcom records), 'delta' (netcom records, per CAN ID
+        delta compressed, for slow links) or 'text' (b'fr:' messages); a
+        'binary' end reads 'delta' records too, 'text' must be used on
+        both ends
+
+        batch_frames / batch_delay: frames sent to the socket are coalesced
+        (netcom.BatchSender) until batch_frames are waiting or the oldest
+        has waited batch_delay seconds; batch_delay=0 sends every frame
+        on its own
+
+        hub: (host, port) of a network.hub.BridgeHub, joined with our
+        role instead of connecting car and diagnosis to each other
+        (binary or delta wire format only, ValueError with 'text')
+
+        transport: netcom transport already set up (e.g. netcom.UDPTransport)
+        used instead of a TCP connection
         """
+        if hub is not None and wire == 'text':
+            # the hub decodes netcom records, it would skip every b'fr:' byte
+            raise ValueError("the hub needs wire='binary' or 'delta', not 'text'")
         # QUEUEs to store data to read & write
         list_written_frames = []
-        last_process_frame = redis.Redis(db=0)
-        _ = last_process_frame.delete(self.__role)
-        logger.debug("delete from REDIS " + self.__role + str(_))
+        if echo is None:
+            echo = EchoSuppressor()
 
         logger.debug("connecting remote nodes")
-        srv =  self.connect_remote_nodes()
+        if transport is not None:
+            srv = transport
+        elif hub is not None:
+            from .network import netcom
+            srv = netcom.socket_clients(hub)
+            srv.hello(self.__role)
+        else:
+            srv =  self.connect_remote_nodes()
         if srv:
             print("Queues DONE")
         else:
             raise AttributeError("Nodes not connected ...")
+        if batch_delay:
+            srv.enable_batching(batch_frames, batch_delay)
         ########################################################################
         # Thread:  read FRAMES from bus and send through server
         #
         logger.debug(" starting Thread: read_frames_from_bus")
         thread_read_from_bus = Thread(target=self.read_frames_from_bus,
                                args=(list_written_frames, srv,
-                                     last_process_frame , 'r'))
+                                     echo , 'r', wire))
         thread_read_from_bus.start()
         logger.debug(" Thread read_frames_from_bus: started ")
 
@@ -886,7 +1469,7 @@ class STN2120:
         logger.debug(" starting Thread: process_read_from_server")
         thread_read_from_srv = Thread(target=self.process_read_from_server,
                                       args=(list_written_frames,
-                                            srv,last_process_frame )).start()
+                                            srv,echo, wire )).start()
         logger.debug(" thread process_read_from_server started")
 
 
@@ -914,16 +1497,9 @@ class STN2120:
 
 
     def get_ports_path (self):
-        """    """
-        available    = []
-        possible_ports = []
-
-        if sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            possible_ports += glob.glob("/dev/rfcomm[0-9]*")
-            possible_ports += glob.glob("/dev/ttyUSB[0-9]*")
-
-        for port  in possible_ports:
-            if self.try_port(port):
-                available.append(port)
-
-        return available
+        """
+        probes every candidate port in parallel (STI/STSN), returns
+        [port 'r', port 'w'] keeping the role cached for each board
+        """
+        bauds = [2000000] + [b for b in self._TRY_BAUDS if b != 2000000]
+        return discovery.discover(bauds)
@@ -0,0 +1,184 @@
+########################################################################
+#
+# metrics.py
+#
+# Counters and gauges of the serial / bridge pipeline, Prometheus export
+#
+########################################################################
+
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Counter(object):
+    """
+        monotonic counter, inc() is a plain attribute update (no lock):
+        every counter is meant to be updated by a single thread
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(object):
+    """ value set by the owner, or read from `func` when collected """
+
+    __slots__ = ('value', 'func')
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func  = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self.func is not None:
+            try:
+                return self.func()
+            except Exception:
+                return 0
+        return self.value
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % (k, v) for k, v in sorted(labels.items())))
+
+
+class MetricsRegistry(object):
+    """
+        Named metrics with labels, created on first use and shared by
+        every object asking for the same name and labels:
+
+            frames = REGISTRY.counter('stn2120_frames_total', port='/dev/ttyUSB0')
+            frames.inc()
+
+        counter_func() / gauge() with a function expose values already
+        kept somewhere else (TransmitEngine stats, queue sizes), read only
+        when the metrics are collected.
+    """
+
+    def __init__(self):
+        self.__lock    = threading.Lock()
+        self.__metrics = {}   # key -> (name, kind, metric)
+        self.__help    = {}   # name -> (kind, help)
+        self.__last    = (time.monotonic(), {})
+
+    def __get(self, name, kind, labels, factory, help):
+        key = _key(name, labels)
+        with self.__lock:
+            entry = self.__metrics.get(key)
+            if entry is None:
+                entry = self.__metrics[key] = (name, kind, factory())
+                self.__help.setdefault(name, (kind, help))
+            return entry[2]
+
+    def counter(self, name, help='', **labels):
+        return self.__get(name, 'counter', labels, Counter, help)
+
+    def counter_func(self, name, func, help='', **labels):
+        """ counter whose value is func(), replaces a previous one """
+        g = self.__get(name, 'counter', labels, Gauge, help)
+        g.func = func
+        return g
+
+    def gauge(self, name, func=None, help='', **labels):
+        g = self.__get(name, 'gauge', labels, Gauge, help)
+        if func is not None:
+            g.func = func
+        return g
+
+    def remove(self, name, **labels):
+        with self.__lock:
+            self.__metrics.pop(_key(name, labels), None)
+
+    def collect(self):
+        """ {key: value} of every metric """
+        with self.__lock:
+            entries = list(self.__metrics.items())
+        return dict((key, m.value if isinstance(m, Counter) else m.get())
+                    for key, (name, kind, m) in entries)
+
+    def snapshot(self):
+        """
+            current values, and the per second rate of every counter since
+            the previous snapshot
+        """
+        now = time.monotonic()
+        values = self.collect()
+        t_last, last = self.__last
+        self.__last = (now, values)
+        elapsed = now - t_last
+        with self.__lock:
+            counters = set(key for key, (_, kind, _) in self.__metrics.items() if kind == 'counter')
+        rates = {}
+        if elapsed > 0:
+            for key in counters:
+                if key in values:
+                    rates[key] = (values[key] - last.get(key, 0)) / elapsed
+        return {'metrics': values, 'rates': rates, 'interval': elapsed}
+
+    def render(self):
+        """ Prometheus text exposition format """
+        with self.__lock:
+            entries = sorted(self.__metrics.items(), key=lambda e: (e[1][0], e[0]))
+            help = dict(self.__help)
+        out = []
+        current = None
+        for key, (name, kind, m) in entries:
+            if name != current:
+                current = name
+                if help[name][1]:
+                    out.append("# HELP %s %s" % (name, help[name][1]))
+                out.append("# TYPE %s %s" % (name, kind))
+            value = m.value if isinstance(m, Counter) else m.get()
+            out.append("%s %s" % (key, value))
+        return "\n".join(out) + "\n"
+
+
+# registry used by the library
+REGISTRY = MetricsRegistry()
+
+
+def start_http_server(port=9120, host='127.0.0.1', registry=None):
+    """
+        serves registry.render() on http://host:port/metrics from a daemon
+        thread, returns the server (server.shutdown() stops it)
+    """
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    registry = registry if registry is not None else REGISTRY
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("metrics on http://%s:%d/metrics" % (host, server.server_address[1]))
+    return server
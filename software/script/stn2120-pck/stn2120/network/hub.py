@@ -0,0 +1,243 @@
+########################################################################
+#
+# hub.py
+#
+# asyncio hub routing bridge frames between many car / diag / observer clients
+#
+########################################################################
+
+import asyncio
+import socket
+import logging
+import argparse
+
+from ..metrics import REGISTRY
+from .netcom import PORT, FrameEncoder, FrameDecoder, parse_hello
+
+logger = logging.getLogger(__name__)
+
+# role of the sender -> roles its frames are delivered to
+ROUTES = {
+    'clt_car'  : ('clt_diag', 'observer'),
+    'clt_diag' : ('clt_car', 'observer'),
+    'observer' : (),
+}
+
+
+class Subscription(object):
+    """ CAN IDs and ID ranges (both ends included) a client receives, all when empty """
+
+    __slots__ = ('ids', 'ranges')
+
+    def __init__(self, ids=(), ranges=()):
+        self.ids    = frozenset(ids)
+        self.ranges = tuple(ranges)
+
+    def __bool__(self):
+        return bool(self.ids or self.ranges)
+
+    def matches(self, can_id):
+        if can_id in self.ids:
+            return True
+        for lo, hi in self.ranges:
+            if lo <= can_id <= hi:
+                return True
+        return False
+
+
+class HubClient(object):
+    """
+        One connection of the hub. Frames for it go to a bounded queue
+        drained by its own writer task: when the client does not keep up
+        the queue fills and new frames for it are dropped (and counted),
+        the hub and the other clients never wait for it.
+    """
+
+    def __init__(self, role, subscription, reader, writer, queue_size):
+        self.role         = role
+        self.subscription = subscription
+        self.reader       = reader
+        self.writer       = writer
+        self.peer         = writer.get_extra_info('peername')
+        self.queue        = asyncio.Queue(queue_size)
+        self.encoder      = FrameEncoder()
+        self.received = 0
+        self.sent     = 0
+        self.dropped  = 0
+        self.filtered = 0
+
+    def deliver(self, frame):
+        """ True when `frame` is queued, False when dropped, None when not subscribed """
+        if self.subscription and not self.subscription.matches(frame.can_id):
+            self.filtered += 1
+            return None
+        try:
+            self.queue.put_nowait(self.encoder.encode(frame))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        return True
+
+    async def write_loop(self, max_batch=64):
+        queue = self.queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            self.writer.write(b''.join(batch))
+            self.sent += len(batch)
+            await self.writer.drain()
+
+    def stats(self):
+        return {
+            'role'     : self.role,
+            'peer'     : "%s:%s" % self.peer[:2] if self.peer else '',
+            'received' : self.received,
+            'sent'     : self.sent,
+            'dropped'  : self.dropped,
+            'filtered' : self.filtered,
+            'queued'   : self.queue.qsize(),
+        }
+
+
+class BridgeHub(object):
+    """
+        TCP hub of the bridge: any number of clt_car, clt_diag and observer
+        clients (netcom.socket_clients + hello(), see netcom.hello_line),
+        all in one event loop.
+
+        Frames (netcom binary records) of a clt_car client are delivered
+        to every clt_diag and observer client, those of a clt_diag client
+        to every clt_car and observer, observers only receive. A client
+        that subscribed to CAN IDs only gets those. Every client has its
+        own bounded send queue of `queue_size` frames.
+
+            hub = BridgeHub('0.0.0.0', 5555)
+            loop.run_until_complete(hub.start())
+            loop.run_forever()
+    """
+
+    READ_SIZE = 4096
+
+    def __init__(self, host='0.0.0.0', port=PORT, queue_size=1024, hello_timeout=5.0):
+        self.host          = host
+        self.port          = port
+        self.queue_size    = queue_size
+        self.hello_timeout = hello_timeout
+        self.server  = None
+        self.clients = dict((role, set()) for role in ROUTES)
+        self.__metrics = {}
+        for role in ROUTES:
+            self.__metrics[role] = {
+                'in'      : REGISTRY.counter('hub_frames_in_total', 'frames received from the clients', role=role),
+                'out'     : REGISTRY.counter('hub_frames_out_total', 'frames queued to the clients', role=role),
+                'dropped' : REGISTRY.counter('hub_frames_dropped_total', 'frames dropped, client send queue full', role=role),
+            }
+            REGISTRY.gauge('hub_clients', lambda role=role: len(self.clients[role]),
+                           'connected clients', role=role)
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.__on_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("hub listening on %s:%d" % (self.host, self.port))
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for clients in self.clients.values():
+            for client in list(clients):
+                client.writer.close()
+
+    async def __on_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            line = await asyncio.wait_for(reader.readuntil(b'\n'), self.hello_timeout)
+            role, ids, ranges = parse_hello(line)
+            if role not in ROUTES:
+                raise ValueError("unknown role %r" % role)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError) as e:
+            logger.warning("hub: %s rejected: %r" % (peer, e))
+            writer.close()
+            return
+
+        client = HubClient(role, Subscription(ids, ranges), reader, writer, self.queue_size)
+        self.clients[role].add(client)
+        logger.info("hub: %s joined as %s" % (peer, role))
+        writer_task = asyncio.ensure_future(client.write_loop())
+        try:
+            await self.__read_loop(client)
+        except (ConnectionError, OSError) as e:
+            logger.info("hub: %s: %s" % (peer, e))
+        finally:
+            self.clients[role].discard(client)
+            writer_task.cancel()
+            writer.close()
+            logger.info("hub: %s (%s) left, %r" % (peer, role, client.stats()))
+
+    async def __read_loop(self, client):
+        decoder = FrameDecoder()
+        metrics = self.__metrics
+        targets = ROUTES[client.role]
+        while True:
+            # small reads, and the writers run between them: a burst is
+            # never larger than the client queues (READ_SIZE / 16 records)
+            data = await client.reader.read(self.READ_SIZE)
+            if not data:
+                return
+            frames = decoder.feed(data)
+            if not frames:
+                continue
+            client.received += len(frames)
+            metrics[client.role]['in'].inc(len(frames))
+            for role in targets:
+                for target in self.clients[role]:
+                    for frame in frames:
+                        queued = target.deliver(frame)
+                        if queued:
+                            metrics[role]['out'].inc()
+                        elif queued is False:
+                            metrics[role]['dropped'].inc()
+            await asyncio.sleep(0)
+
+    def stats(self):
+        """ stats of every connected client """
+        return [ c.stats() for clients in self.clients.values() for c in clients ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="STN2120 bridge hub")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--queue', type=int, default=1024,
+                        help="frames queued per client before dropping")
+    parser.add_argument('--stats', type=float, default=0,
+                        help="log the client stats every STATS seconds")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    hub = BridgeHub(args.host, args.port, args.queue)
+    loop.run_until_complete(hub.start())
+
+    def report():
+        logger.info("hub: %r" % hub.stats())
+        loop.call_later(args.stats, report)
+    if args.stats:
+        loop.call_later(args.stats, report)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.close()
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
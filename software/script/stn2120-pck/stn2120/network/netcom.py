@@ -1,18 +1,554 @@
 
 from datetime import datetime
+import sys
+import types
 import socket
 import threading
+import time
 import re
 from queue import Queue
+from collections import deque
 
+import struct
+
+from ..decoder import CanFrame, EXTENDED, PADDED
+from ..metrics import REGISTRY
+from .. import trace
+from ..trace import TRACER
 
 import logging
 logger = logging.getLogger(__name__)
 
-HOST_NAME = socket.gethostname()  #'10.117.246.138'
-HOST      = socket.gethostbyname(HOST_NAME)
 PORT      = 5555
 
+_host = None
+
+def default_host():
+    """
+    address of this host used by ThreadedServer when no host is given,
+    resolved on first use (gethostbyname may block on DNS)
+    """
+    global _host
+    if _host is None:
+        _host = socket.gethostbyname(socket.gethostname())  #'10.117.246.138'
+    return _host
+
+class _NetcomModule(types.ModuleType):
+    # HOST / HOST_NAME used to be resolved at import time, they are now
+    # resolved on access (a module __getattr__ needs python 3.7)
+
+    @property
+    def HOST(self):
+        return default_host()
+
+    @property
+    def HOST_NAME(self):
+        return socket.gethostname()
+
+sys.modules[__name__].__class__ = _NetcomModule
+
+def _socket_metrics(side, peer):
+    """ send / recv counters of one socket in metrics.REGISTRY """
+    labels = {'side': side, 'peer': "%s:%s" % peer[:2]}
+    return {
+        'bytes_sent' : REGISTRY.counter('netcom_bytes_sent_total', 'bytes sent to the socket', **labels),
+        'bytes_recv' : REGISTRY.counter('netcom_bytes_received_total', 'bytes received from the socket', **labels),
+        'sends'      : REGISTRY.counter('netcom_sends_total', 'send() calls', **labels),
+        'recvs'      : REGISTRY.counter('netcom_recvs_total', 'recv() calls returning data', **labels),
+        'frames'     : REGISTRY.counter('netcom_frames_sent_total', 'send_data() messages', **labels),
+    }
+
+
+_IOV_MAX = 512   # buffers per sendmsg(), below every platform's IOV_MAX
+
+def _send_all(sock, buffers, metrics):
+    """
+    writes every buffer, resuming after partial sends: sendmsg() scatter /
+    gather where available, sendall() of the joined buffers otherwise
+    """
+    if not hasattr(sock, 'sendmsg'):
+        data = b''.join(buffers)
+        sock.sendall(data)
+        metrics['sends'].inc()
+        metrics['bytes_sent'].inc(len(data))
+        return
+    i = 0
+    while i < len(buffers):
+        sent = sock.sendmsg(buffers[i:i + _IOV_MAX])
+        metrics['sends'].inc()
+        metrics['bytes_sent'].inc(sent)
+        # skip what was sent, the first buffer left may be cut
+        while sent:
+            n = len(buffers[i])
+            if sent >= n:
+                sent -= n
+                i += 1
+            else:
+                buffers[i] = memoryview(buffers[i])[sent:]
+                sent = 0
+
+
+def _nodelay(sock):
+    """ frames are small and latency bound: no Nagle delay """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+class BatchSender(object):
+    """
+        Coalesces the messages sent on a socket: send() only queues, a
+        writer thread sends the queued messages in one sendmsg() as soon as
+        `max_frames` are waiting or the oldest one has waited `max_delay`
+        seconds. A larger window means fewer syscalls and more latency.
+
+        A socket error in the writer is raised by the next send().
+    """
+
+    def __init__(self, sock, metrics, max_frames=64, max_delay=0.001):
+        self.sock       = sock
+        self.metrics    = metrics
+        self.max_frames = max_frames
+        self.max_delay  = max_delay
+        self.__cond    = threading.Condition()
+        self.__pending = []
+        self.__oldest  = None   # monotonic time the oldest pending message was queued
+        self.__busy    = False
+        self.__closed  = False
+        self.__error   = None
+        self.batches = 0
+        self.frames  = 0
+        self.__thread = threading.Thread(target=self.__run, name='netcom-batch', daemon=True)
+        self.__thread.start()
+
+    def send(self, data):
+        with self.__cond:
+            if self.__error is not None:
+                raise self.__error
+            if self.__closed:
+                raise OSError("BatchSender closed")
+            self.__pending.append(data)
+            if len(self.__pending) == 1:
+                self.__oldest = time.monotonic()
+                self.__cond.notify_all()
+            elif len(self.__pending) >= self.max_frames:
+                self.__cond.notify_all()
+
+    def __next_batch(self):
+        """ waits for a full batch or the deadline, None once closed """
+        cond = self.__cond
+        with cond:
+            while not self.__pending:
+                if self.__closed:
+                    return None
+                cond.wait()
+            deadline = self.__oldest + self.max_delay
+            while len(self.__pending) < self.max_frames and not self.__closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+            batch = self.__pending[:self.max_frames]
+            del self.__pending[:self.max_frames]
+            if self.__pending:
+                self.__oldest = time.monotonic()
+            self.__busy = True
+            return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            try:
+                _send_all(self.sock, batch, self.metrics)
+                self.batches += 1
+                self.frames  += len(batch)
+            except OSError as e:
+                logger.warning("BatchSender: %s" % e)
+                with self.__cond:
+                    self.__error = e
+                    self.__closed = True
+                    self.__pending = []
+            with self.__cond:
+                self.__busy = False
+                self.__cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ waits until everything queued was written, False on timeout """
+        with self.__cond:
+            self.__cond.notify_all()
+            return self.__cond.wait_for(lambda: not self.__pending and not self.__busy, timeout)
+
+    def close(self, timeout=1.0):
+        """ writes what is queued and stops the writer thread """
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+        self.__thread.join(timeout)
+
+    def stats(self):
+        return {
+            'batches'    : self.batches,
+            'frames'     : self.frames,
+            'per_batch'  : self.frames / self.batches if self.batches else 0.0,
+            'pending'    : len(self.__pending),
+        }
+
+
+########################################################################
+# Binary wire format of the bridge
+#
+# Every frame is one length prefixed record: a fixed 16 byte header
+# (little endian) followed by the dlc payload bytes.
+#
+#   magic     B   0xA0 | WIRE_VERSION, lets the decoder resync after
+#                 anything that is not a record (never an ASCII byte)
+#   length    B   record length in bytes, header included
+#   flags     B   decoder.EXTENDED / PADDED, WIRE_TIMESTAMP
+#   dlc       B
+#   can_id    I
+#   seq       I   per sender, +1 every record (mod 2**32)
+#   timestamp I   bus time in host monotonic microseconds (mod 2**32) of
+#                 the sender, see timing.ClockModel
+#   data      dlc bytes
+#
+# A newer version may only make records longer: readers decode the fields
+# they know and skip the rest of the record thanks to `length`, records of
+# an unknown version are skipped whole.
+#
+# DeltaEncoder also sends delta records, relative to the last payload sent
+# for the same CAN ID:
+#
+#   magic     B   0xC0 | WIRE_VERSION
+#   length    B
+#   bitmap    B   bit i set: payload byte i changed
+#   info      B   dlc | decoder flags << 4
+#   seq       B   low byte of the record sequence number
+#   can_id    H (11 bit) or I (EXTENDED)
+#   changed   the new value of every changed byte, in order
+#
+# bitmap 0 is the "unchanged" marker (7 bytes for an 11 bit frame).
+# Delta records carry no timestamp.
+########################################################################
+
+WIRE_MAGIC     = 0xA0
+DELTA_MAGIC    = 0xC0
+WIRE_VERSION   = 1
+WIRE_TIMESTAMP = 0x80   # timestamp field is valid
+
+_HEADER = struct.Struct('<BBBBIII')
+HEADER_SIZE = _HEADER.size  # 16
+
+_DELTA    = struct.Struct('<BBBBB')
+_DELTA_11 = struct.Struct('<BBBBBH')
+_DELTA_29 = struct.Struct('<BBBBBI')
+
+# popcount of every bitmap
+_BITS = [ bin(i).count('1') for i in range(256) ]
+
+
+class FrameEncoder(object):
+    """ CanFrames -> binary records, numbered from 0 """
+
+    def __init__(self):
+        self.seq = 0
+
+    def encode(self, frame):
+        flags = frame.flags & (EXTENDED | PADDED)
+        timestamp = frame.timestamp
+        if timestamp is None:
+            timestamp = 0
+        else:
+            flags |= WIRE_TIMESTAMP
+            timestamp = int(timestamp * 1e6) & 0xFFFFFFFF
+        dlc = frame.dlc
+        record = _HEADER.pack(WIRE_MAGIC | WIRE_VERSION, HEADER_SIZE + dlc, flags, dlc,
+                              frame.can_id, self.seq, timestamp) + frame.data[:dlc]
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        return record
+
+
+class DeltaEncoder(FrameEncoder):
+    """
+        FrameEncoder sending, for a CAN ID already sent, only the payload
+        bytes that changed since (delta record with a bitmap) or a 7 byte
+        "unchanged" marker.
+
+        A full record (keyframe) is sent the first time an ID is seen, when
+        its dlc or flags change and at least every `keyframe_interval`
+        seconds per ID, so that a receiver joining late, or that lost a
+        record over UDP, is in sync again after one interval.
+
+        stats() reports the bytes full records would have taken, the
+        bytes actually sent and the time spent encoding.
+    """
+
+    def __init__(self, keyframe_interval=1.0, clock=time.monotonic):
+        FrameEncoder.__init__(self)
+        self.keyframe_interval = keyframe_interval
+        self.clock = clock
+        self.__last = {}  # key -> [payload, dlc, flags, next keyframe time]
+        self.frames    = 0
+        self.keyframes = 0
+        self.unchanged = 0
+        self.bytes_full = 0
+        self.bytes_sent = 0
+        self.encode_time = 0.0
+
+    def encode(self, frame):
+        t0 = time.perf_counter()
+        flags = frame.flags & (EXTENDED | PADDED)
+        key = frame.can_id | flags << 29
+        dlc = frame.dlc
+        data = frame.data
+        now = self.clock()
+        last = self.__last.get(key)
+        if last is None or last[1] != dlc or last[2] != flags or now >= last[3]:
+            record = FrameEncoder.encode(self, frame)
+            self.__last[key] = [data, dlc, flags, now + self.keyframe_interval]
+            self.keyframes += 1
+        else:
+            old = last[0]
+            if data == old:
+                bitmap = 0
+                changed = b''
+                self.unchanged += 1
+            else:
+                bitmap = 0
+                changed = bytearray()
+                for i in range(dlc):
+                    if data[i] != old[i]:
+                        bitmap |= 1 << i
+                        changed.append(data[i])
+                last[0] = data
+            head = _DELTA_29 if flags & EXTENDED else _DELTA_11
+            record = head.pack(DELTA_MAGIC | WIRE_VERSION, head.size + len(changed), bitmap,
+                               dlc | flags << 4, self.seq & 0xFF, frame.can_id) + changed
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+        self.frames += 1
+        self.bytes_full += HEADER_SIZE + dlc
+        self.bytes_sent += len(record)
+        self.encode_time += time.perf_counter() - t0
+        return record
+
+    def stats(self):
+        return {
+            'frames'         : self.frames,
+            'keyframes'      : self.keyframes,
+            'unchanged'      : self.unchanged,
+            'bytes_full'     : self.bytes_full,
+            'bytes_sent'     : self.bytes_sent,
+            'saved'          : 1.0 - self.bytes_sent / self.bytes_full if self.bytes_full else 0.0,
+            'encode_us_frame': 1e6 * self.encode_time / self.frames if self.frames else 0.0,
+        }
+
+
+class FrameDecoder(object):
+    """
+        Streaming decoder of binary records: feed() takes whatever recv()
+        returned, records cut across reads are kept until completed.
+
+        Bytes that are not a record (e.g. the connection greetings) are
+        skipped up to the next magic byte. Sequence gaps are counted in
+        `lost`, records of an unknown version in `unsupported`. Decoded
+        timestamps are in seconds, modulo 2**32 us.
+
+        Delta records (DeltaEncoder) are applied to the last payload of
+        their CAN ID; before the first keyframe of an ID they cannot be
+        decoded and are counted in `unsynced`. A sequence gap forgets every
+        payload (the lost records may have changed any of them), so deltas
+        are `unsynced` again until the next keyframe of their ID. Records
+        older than the last one (reordered by the link) are counted in
+        `late`: a late keyframe is still decoded but not kept as the
+        reference of the deltas, a late delta is dropped.
+    """
+
+    def __init__(self):
+        self.__buffer  = bytearray()
+        self.__seq     = None
+        self.__last    = {}   # key -> last payload, for delta records
+        self.records     = 0
+        self.lost        = 0
+        self.skipped     = 0   # bytes
+        self.unsupported = 0
+        self.unsynced    = 0
+        self.late        = 0
+
+    def __resync(self, buf, off, end):
+        """ offset of the next possible record after `off` """
+        for i in range(off + 1, end):
+            if buf[i] & 0xF0 in (WIRE_MAGIC, DELTA_MAGIC):
+                return i
+        return end
+
+    def __delta_valid(self, buf, off, length):
+        """ False when the delta record header at `off` is not consistent """
+        if len(buf) - off < _DELTA.size:
+            return True   # checked once the header is complete
+        bitmap, info = buf[off + 2], buf[off + 3]
+        head = _DELTA_29 if info & (EXTENDED << 4) else _DELTA_11
+        return length == head.size + _BITS[bitmap] and bitmap >> (info & 0x0F) == 0
+
+    def __apply_delta(self, buf, off, frames):
+        """ decodes the delta record at `off` into `frames` """
+        _, _, bitmap, info, seq = _DELTA.unpack_from(buf, off)
+        flags = info >> 4
+        head = _DELTA_29 if flags & EXTENDED else _DELTA_11
+        can_id = head.unpack_from(buf, off)[5]
+        pos = off + head.size
+        # only the low byte of the sequence number is sent
+        if self.__seq is not None:
+            gap = (seq - self.__seq) & 0xFF
+            if gap >= 0x80:
+                # its gap was handled when the next record came, the
+                # payloads kept since then are still right
+                self.late += 1
+                return
+            if gap:
+                self.lost += gap
+                self.__last.clear()
+            self.__seq = (self.__seq + gap + 1) & 0xFFFFFFFF
+        key = can_id | flags << 29
+        payload = self.__last.get(key)
+        if payload is None:
+            self.unsynced += 1
+            return
+        if bitmap:
+            payload = bytearray(payload)
+            for i in range(8):
+                if bitmap >> i & 1:
+                    payload[i] = buf[pos]
+                    pos += 1
+            payload = bytes(payload)
+            self.__last[key] = payload
+        self.records += 1
+        frames.append(CanFrame(can_id, info & 0x0F, payload, flags))
+
+    def feed(self, data):
+        """ list of the CanFrames completed by `data` """
+        buf = self.__buffer
+        buf += data
+        frames = []
+        end = len(buf)
+        off = 0
+        last = self.__last
+        full  = WIRE_MAGIC | WIRE_VERSION
+        delta = DELTA_MAGIC | WIRE_VERSION
+        while end - off >= 2:
+            magic = buf[off]
+            length = buf[off + 1]
+            if magic == full:
+                valid = HEADER_SIZE <= length <= HEADER_SIZE + 8
+            elif magic == delta:
+                valid = self.__delta_valid(buf, off, length)
+            else:
+                valid = magic & 0xF0 in (WIRE_MAGIC, DELTA_MAGIC) and length >= 2
+            if not valid:
+                nxt = self.__resync(buf, off, end)
+                self.skipped += nxt - off
+                off = nxt
+                continue
+            if end - off < length or end - off < _DELTA.size:
+                break
+            if magic == delta:
+                self.__apply_delta(buf, off, frames)
+                off += length
+                continue
+            if magic != full:
+                self.unsupported += 1
+                off += length
+                continue
+
+            _, _, flags, dlc, can_id, seq, timestamp = _HEADER.unpack_from(buf, off)
+            if dlc > length - HEADER_SIZE:
+                nxt = self.__resync(buf, off, end)
+                self.skipped += nxt - off
+                off = nxt
+                continue
+            data = bytes(buf[off + HEADER_SIZE:off + HEADER_SIZE + dlc])
+            off += length
+            current = True
+            if self.__seq is not None and seq != self.__seq:
+                gap = (seq - self.__seq) & 0xFFFFFFFF
+                if gap >= 0x80000000:
+                    self.late += 1
+                    current = False
+                else:
+                    self.lost += gap
+                    last.clear()
+            if current:
+                self.__seq = (seq + 1) & 0xFFFFFFFF
+            self.records += 1
+            if dlc < 8:
+                data += bytes(8 - dlc)
+            frame_flags = flags & (EXTENDED | PADDED)
+            if current:
+                last[can_id | frame_flags << 29] = data
+            frames.append(CanFrame(can_id, dlc, data, frame_flags,
+                                   timestamp / 1e6 if flags & WIRE_TIMESTAMP else None))
+        del buf[:off]
+        return frames
+
+    def stats(self):
+        return {
+            'records'     : self.records,
+            'lost'        : self.lost,
+            'skipped'     : self.skipped,
+            'unsupported' : self.unsupported,
+            'unsynced'    : self.unsynced,
+            'late'        : self.late,
+            'pending'     : len(self.__buffer),
+        }
+
+
+########################################################################
+# Hub hello (see hub.BridgeHub)
+#
+# A client of the hub sends one text line before the records:
+#
+#   HELLO role=<clt_car|clt_diag|observer> [ids=7E8,7DF,700-7FF]
+#
+# ids are hex CAN IDs or ID ranges the client wants to receive, all of
+# them when not given. Anything before HELLO on the line is ignored (the
+# socket_clients greeting).
+########################################################################
+
+HUB_HELLO = b'HELLO'
+
+
+def hello_line(role, ids=(), ranges=()):
+    """ hello line of a hub client """
+    fields = [HUB_HELLO, b'role=' + role.encode()]
+    spec = [ b'%X' % i for i in ids ] + [ b'%X-%X' % r for r in ranges ]
+    if spec:
+        fields.append(b'ids=' + b','.join(spec))
+    return b' '.join(fields) + b'\n'
+
+
+def parse_hello(line):
+    """ (role, ids, ranges) of a hello line, ValueError when it is not one """
+    start = line.rfind(HUB_HELLO)
+    if start < 0:
+        raise ValueError("no hello: %r" % line[:64])
+    role, ids, ranges = None, [], []
+    for field in line[start:].split()[1:]:
+        key, _, value = field.partition(b'=')
+        if key == b'role':
+            role = value.decode()
+        elif key == b'ids':
+            for item in value.split(b','):
+                lo, _, hi = item.partition(b'-')
+                if hi:
+                    ranges.append((int(lo, 16), int(hi, 16)))
+                else:
+                    ids.append(int(lo, 16))
+    if role is None:
+        raise ValueError("hello without role: %r" % line[:64])
+    return role, ids, ranges
+
+
 class socket_clients():
     """Cliente TCP para enviar y recibir tramas CAN encapsuladas.
 
@@ -38,38 +574,59 @@ class socket_clients():
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         #self.client.connect('192.168.1.82', PORT)
         self.client.connect(connection_data)
+        _nodelay(self.client)
+        self.metrics = _socket_metrics('client', connection_data)
+        self.sender = None
         logger.info("==socket_client, connected==" )
-        self.client.send(b'server socket connected')
+        self.client.sendall(b'server socket connected')
         print("initialization done")
 
 
-    def send_data(self, data, frame_length):
+    def hello(self, role, ids=(), ranges=()):
+        """Se presenta ante un ``hub.BridgeHub`` antes de enviar tramas.
+
+        Args:
+            role (str): ``'clt_car'``, ``'clt_diag'`` u ``'observer'``.
+            ids (Iterable[int]): IDs CAN que se desean recibir.
+            ranges (Iterable[tuple[int, int]]): Rangos de IDs CAN (ambos
+                incluidos). Sin ``ids`` ni ``ranges`` se reciben todas.
+        """
+        self.client.sendall(hello_line(role, ids, ranges))
+
+
+    def enable_batching(self, max_frames=64, max_delay=0.001):
+        """Agrupa los envíos posteriores en lotes (ver :class:`BatchSender`).
+
+        Args:
+            max_frames (int): Número de tramas que provoca el envío del lote.
+            max_delay (float): Espera máxima en segundos de la trama más
+                antigua del lote.
+        """
+        self.sender = BatchSender(self.client, self.metrics, max_frames, max_delay)
+
+
+    def send_data(self, data, frame_length=None):
         """Envía una trama CAN hacia el servidor TCP.
 
         Args:
             data (bytes): Payload binario que contiene la trama CAN formateada.
-            frame_length (int): Longitud esperada de la trama. El método
-                intentará enviar el payload completo repitiendo ``send`` hasta
-                alcanzar este tamaño.
+            frame_length (int | None): Ignorado, se envía ``data`` completo
+                (se mantiene por compatibilidad).
 
         Side Effects:
-            Registra información de depuración en los logs.
+            Con ``enable_batching`` la trama se encola y se envía en el
+            siguiente lote; sin él se envía en el momento con ``sendall``.
         """
         #cmd += b"\r\n" # terminate
         #logger.info("==  socket_client, client %s:%s ======" % (self.client.getpeername(),self.client.getsockname()) )
-        ###---->self.client.send(data)
-        logger.debug("socket_client.send_data:" + str(data))
+        if TRACER.enabled:
+            TRACER.event(trace.SOCKET_TX, data)
         if data:
-            size_sent = 0
-            while size_sent < frame_length:
-                tmp_sent = self.client.send(data)
-                size_sent += tmp_sent
-                if size_sent == 0:
-                    logger.debug("Error: socket_client Sent frame size 0")
-                    break
-                #size_sent += tmp_sent
-
-
+            self.metrics['frames'].inc()
+            if self.sender is not None:
+                self.sender.send(data)
+            else:
+                _send_all(self.client, [data], self.metrics)
 
 
 
@@ -82,6 +639,9 @@ class socket_clients():
         """
         try:
             data = self.client.recv(1024)
+            if data:
+                self.metrics['recvs'].inc()
+                self.metrics['bytes_recv'].inc(len(data))
             return data
         except:
             logger.debug("socket_client.GET_DATA: NO DATA")
@@ -90,6 +650,8 @@ class socket_clients():
 
     def close_client(self):
         """Cierra la conexión TCP mantenida por el cliente."""
+        if self.sender is not None:
+            self.sender.close()
         self.client.close()
 
 
@@ -107,7 +669,7 @@ class ThreadedServer(object):
             self.host = host
             self.port = port
         else:
-            self.host = HOST
+            self.host = default_host()
             self.port = PORT
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -115,6 +677,7 @@ class ThreadedServer(object):
         ####
         self.client = None
         self.address = None
+        self.sender = None
         ####
         self.clients = {}
 
@@ -123,33 +686,41 @@ class ThreadedServer(object):
         """Espera una conexión entrante y establece la sesión principal."""
         self.sock.listen(5)
         self.client, self.address = self.sock.accept()
+        _nodelay(self.client)
+        self.metrics = _socket_metrics('server', self.address)
         print ("address", self.address)
         self.client.settimeout(600)
-        self.client.send(b'server thread connected')
+        self.client.sendall(b'server thread connected')
 
 
+    def enable_batching(self, max_frames=64, max_delay=0.001):
+        """Agrupa los envíos al cliente aceptado en lotes (ver
+        :class:`BatchSender` y ``socket_clients.enable_batching``)."""
+        self.sender = BatchSender(self.client, self.metrics, max_frames, max_delay)
 
-    def send_data(self, msj, frame_length):
+
+
+    def send_data(self, msj, frame_length=None):
         #if msj:
         #    #print(str(datetime.now().time())," ", msj)
         #    self.client.send(msj)
-
+        if TRACER.enabled:
+            TRACER.event(trace.SOCKET_TX, msj)
         if msj:
-            size_sent = 0
-            while size_sent < frame_length:
-                tmp_sent = self.client.send(msj)
-                size_sent += tmp_sent
-                if size_sent == 0:
-                    logger.debug("Error: ThreadedServer Sent frame size 0")
-                    break
-
-
+            self.metrics['frames'].inc()
+            if self.sender is not None:
+                self.sender.send(msj)
+            else:
+                _send_all(self.client, [msj], self.metrics)
 
 
 
     def get_data(self):
         try:
             data = self.client.recv(1024)
+            if data:
+                self.metrics['recvs'].inc()
+                self.metrics['bytes_recv'].inc(len(data))
             return data
         except:
             logger.debug("ThreadedServer.GET_DATA: NO DATA")
@@ -210,3 +781,220 @@ class ThreadedServer(object):
             except:
                 client.close()
                 return False
+
+
+
+########################################################################
+# UDP transport
+#
+# Every datagram starts with an 8 byte header (little endian), then the
+# messages given to send_data() (binary records or b'fr:' text):
+#
+#   magic     B   0xB0 | UDP_VERSION
+#   flags     B   0
+#   reserved  H
+#   seq       I   per sender, +1 every datagram (mod 2**32)
+########################################################################
+
+UDP_MAGIC    = 0xB0
+UDP_VERSION  = 1
+UDP_PORT     = 5556
+MAX_DATAGRAM = 1400   # payload bytes, below the usual ethernet MTU
+
+_DATAGRAM = struct.Struct('<BBHI')
+
+
+class UDPTransport(object):
+    """Transporte UDP (unicast o multicast) con la interfaz de ``socket_clients``.
+
+    Pensado para el espejo en vivo del bus: un datagrama perdido no retiene
+    a los siguientes como ocurre con TCP. Cada datagrama lleva un número de
+    secuencia; el receptor cuenta los que llegan fuera de orden
+    (``reordered``) y los perdidos (``lost``): un datagrama que falta se da
+    por perdido cuando llegan ``REORDER_WINDOW`` datagramas posteriores, así
+    ``lost`` y su métrica solo aumentan.
+
+    Si ``remote`` es una dirección multicast los datagramas llegan a todos los
+    equipos de la LAN unidos a ese grupo (``group``), por ejemplo varios
+    puestos de diagnóstico. Sin ``remote`` se responde a la dirección del
+    último datagrama recibido.
+    """
+
+    # later datagrams received before a missing one is counted as lost
+    REORDER_WINDOW = 64
+
+    def __init__(self, remote=None, bind=None, group=None, ttl=1,
+                 interface='0.0.0.0', drop_late=False):
+        """Crea el socket UDP.
+
+        Args:
+            remote (tuple[str, int] | None): Destino ``(host, puerto)`` de
+                ``send_data``; unicast o un grupo multicast.
+            bind (tuple[str, int] | None): Dirección local en la que se
+                reciben los datagramas de ``get_data``.
+            group (str | None): Grupo multicast al que se une el socket para
+                recibir.
+            ttl (int): TTL de los datagramas multicast (1: solo la LAN).
+            interface (str): Dirección IP de la interfaz multicast.
+            drop_late (bool): Descarta los datagramas que llegan después de
+                uno posterior en lugar de entregarlos.
+        """
+        self.remote    = remote
+        self.drop_late = drop_late
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if bind is not None:
+            self.client.bind(bind)
+        if group is not None:
+            mreq = socket.inet_aton(group) + socket.inet_aton(interface)
+            self.client.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        if remote is not None and _is_multicast(remote[0]):
+            self.client.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+            self.client.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                   socket.inet_aton(interface))
+        peer = remote or bind or ('0.0.0.0', 0)
+        self.metrics = _socket_metrics('udp', peer)
+        labels = {'side': 'udp', 'peer': "%s:%s" % peer[:2]}
+        self.metrics['lost'] = REGISTRY.counter(
+            'netcom_datagrams_lost_total', 'datagrams missing from the sequence', **labels)
+        self.metrics['reordered'] = REGISTRY.counter(
+            'netcom_datagrams_reordered_total', 'datagrams received after a later one', **labels)
+        self.sender = None
+        self.__seq      = 0
+        self.__expected = None
+        self.__missing  = deque()   # seq numbers still awaited, oldest first
+        self.lost      = 0
+        self.reordered = 0
+        self.invalid   = 0
+
+
+    def enable_batching(self, max_frames=64, max_delay=0.001):
+        """Agrupa los envíos en datagramas de hasta ``MAX_DATAGRAM`` bytes
+        (ver :class:`BatchSender`)."""
+        self.sender = BatchSender(self, self.metrics, max_frames, max_delay)
+
+
+    def sendmsg(self, buffers):
+        """ sends `buffers` in as few datagrams as possible, used by BatchSender """
+        total = 0
+        datagram = []
+        size = 0
+        for b in buffers:
+            if datagram and size + len(b) > MAX_DATAGRAM:
+                self.__send_datagram(datagram)
+                datagram, size = [], 0
+            datagram.append(b)
+            size += len(b)
+            total += len(b)
+        if datagram:
+            self.__send_datagram(datagram)
+        return total
+
+
+    def __send_datagram(self, buffers):
+        if self.remote is None:
+            return
+        header = _DATAGRAM.pack(UDP_MAGIC | UDP_VERSION, 0, 0, self.__seq)
+        self.__seq = (self.__seq + 1) & 0xFFFFFFFF
+        self.client.sendto(header + b''.join(buffers), self.remote)
+
+
+    def send_data(self, data, frame_length=None):
+        """Envía ``data`` en un datagrama (o en el siguiente lote)."""
+        if TRACER.enabled:
+            TRACER.event(trace.SOCKET_TX, data)
+        if data:
+            self.metrics['frames'].inc()
+            if self.sender is not None:
+                self.sender.send(data)
+            else:
+                self.__send_datagram([data])
+                self.metrics['sends'].inc()
+                self.metrics['bytes_sent'].inc(len(data))
+
+
+    def get_data(self):
+        """Espera el siguiente datagrama y devuelve su contenido.
+
+        Returns:
+            bytes | None: Mensajes del datagrama; ``b''`` si el datagrama no
+            es válido o llega tarde con ``drop_late``, ``None`` si falla la
+            lectura.
+        """
+        try:
+            data, address = self.client.recvfrom(65535)
+        except OSError:
+            logger.debug("UDPTransport.GET_DATA: NO DATA")
+            return None
+        self.metrics['recvs'].inc()
+        self.metrics['bytes_recv'].inc(len(data))
+        if len(data) < _DATAGRAM.size or data[0] != UDP_MAGIC | UDP_VERSION:
+            self.invalid += 1
+            return b''
+        if self.remote is None:
+            self.remote = address
+        seq = _DATAGRAM.unpack_from(data)[3]
+        if not self.__sequence(seq):
+            return b''
+        return data[_DATAGRAM.size:]
+
+
+    def __lose(self, n):
+        self.lost += n
+        self.metrics['lost'].inc(n)
+
+    def __sequence(self, seq):
+        """ updates the loss / reorder counters, False to drop the datagram """
+        expected = self.__expected
+        window = self.REORDER_WINDOW
+        missing = self.__missing
+        if expected is not None and seq != expected:
+            ahead = (seq - expected) & 0xFFFFFFFF
+            if ahead >= 0x80000000:
+                # older than expected, no longer missing
+                self.reordered += 1
+                self.metrics['reordered'].inc()
+                try:
+                    missing.remove(seq)
+                except ValueError:
+                    pass   # duplicate, or already counted as lost
+                return not self.drop_late
+            # datagrams in between are missing, lost unless they arrive
+            # within the window
+            if ahead > window:
+                self.__lose(ahead - window)
+                expected = (seq - window) & 0xFFFFFFFF
+                ahead = window
+            missing.extend((expected + i) & 0xFFFFFFFF for i in range(ahead))
+        self.__expected = (seq + 1) & 0xFFFFFFFF
+        late = 0
+        while missing and (seq - missing[0]) & 0xFFFFFFFF > window:
+            missing.popleft()
+            late += 1
+        if late:
+            self.__lose(late)
+        return True
+
+
+    def stats(self):
+        return {
+            'sent'      : self.__seq,
+            'lost'      : self.lost,
+            'missing'   : len(self.__missing),
+            'reordered' : self.reordered,
+            'invalid'   : self.invalid,
+        }
+
+
+    def close_client(self):
+        """Cierra el socket UDP."""
+        if self.sender is not None:
+            self.sender.close()
+        self.client.close()
+
+
+def _is_multicast(host):
+    try:
+        return 224 <= int(host.split('.')[0]) <= 239
+    except ValueError:
+        return False
@@ -0,0 +1,115 @@
+########################################################################
+#
+# profiles.py
+#
+# Role configuration profiles stored in the adapter NVM
+#
+########################################################################
+
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# AT@1 string (STS@1) of an adapter configured by this package:
+# b'stn2120:<profile name>:<profile checksum>:<session config checksum>',
+# '-' for a part not set. Both the profiles and the warm start read it
+# and each one only changes its own part.
+MARKER_PREFIX = "stn2120"
+
+
+def format_marker(profile=None, config=None):
+    """ AT@1 string of the profile tag (Profile.tag()) and config checksum """
+    return "%s:%s:%s" % (MARKER_PREFIX, profile or "-:-", config or "-")
+
+
+def parse_marker(text):
+    """ (profile tag, config checksum) of an AT@1 string, None for a missing part """
+    parts = text.strip().split(":") if text else []
+    if len(parts) != 4 or parts[0] != MARKER_PREFIX:
+        return None, None
+    profile = "%s:%s" % (parts[1], parts[2]) if parts[1] != "-" else None
+    config  = parts[3] if parts[3] != "-" else None
+    return profile, config
+
+
+class Profile(object):
+    """
+        Configuration of one node role.
+
+        `nvm` commands are written to the adapter once (programmable
+        parameters, baud rate, ...) and survive resets, `session` commands
+        are the settings the firmware cannot keep and are sent on every
+        connection. The tag of the profile (name and checksum) is part of
+        the AT@1 marker (see format_marker()), so a connection only has to
+        read it back to know the adapter already boots into this profile.
+    """
+
+    def __init__(self, name, nvm, session=()):
+        self.name    = name
+        self.nvm     = list(nvm)
+        self.session = list(session)
+
+    def checksum(self):
+        data = self.name.encode() + b"|" + b";".join(self.nvm) + b"|" + b";".join(self.session)
+        return zlib.crc32(data)
+
+    def tag(self):
+        """ profile part of the AT@1 marker """
+        return "%s:%08X" % (self.name, self.checksum())
+
+    def write_commands(self):
+        """ commands storing the profile, the marker is written by the caller """
+        return list(self.nvm)
+
+    def __repr__(self):
+        return "Profile(%s, %08X)" % (self.name, self.checksum())
+
+
+# ATPP <pp> SV <value> + ATPP <pp> ON: power up default of a setting
+def _pp(pp, value):
+    return [b"ATPP %02X SV %02X" % (pp, value), b"ATPP %02X ON" % pp]
+
+_COMMON_NVM = (
+      _pp(0x09, 0xFF)   # ATE0  echo OFF
+    + _pp(0x01, 0x00)   # ATH1  headers ON
+    + _pp(0x24, 0xFF)   # ATCAF0 CAN auto formatting OFF
+    # PP 0D is the carriage return character, an earlier version of this
+    # profile set it to NUL: back to the firmware default
+    + [b"ATPP 0D OFF"]
+)
+
+
+def _session(protocol):
+    """ the settings of STN2120._NODE_CONFIG the NVM cannot hold """
+    return [
+        b"ATL1",   # no programmable parameter for the linefeeds
+        b"STP" + protocol.encode(),
+        b"STPO",
+        b"STCMM 1",
+        b"ATAT 0",
+        b"ATV0",
+        b"ATR0",
+    ]
+
+
+def monitor_profile(protocol):
+    """ 'r' node: STMA monitoring, normal node with CAN ACKs """
+    return Profile("monitor", _COMMON_NVM, _session(protocol))
+
+
+def writer_profile(protocol):
+    """ 'w' node: STPX transmissions, same session as the normal init """
+    return Profile("writer", _COMMON_NVM + _pp(0x02, 0x00), _session(protocol) + [ # ATAL long messages
+        b"STPTO 25",
+        b"STPTOT 1",
+        b"STPTRQ 0",
+    ])
+
+
+# node -> profile factory
+NODE_PROFILES = {
+    'r' : monitor_profile,
+    'w' : writer_profile,
+}
@@ -0,0 +1,114 @@
+########################################################################
+#
+# reader.py
+#
+# Bulk, prompt aware reader used by STN2120.__read()
+#
+########################################################################
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def split_lines(raw):
+    """
+        yields a memoryview for every non empty [\r\n] delimited line
+        found in the given bytes/bytearray, without copying the data
+    """
+    view = memoryview(raw)
+    start = 0
+    end = len(raw)
+    while start < end:
+        # find the nearest line terminator, either CR or LF
+        cr = raw.find(b'\r', start, end)
+        lf = raw.find(b'\n', start, end)
+        if cr < 0:
+            stop = lf
+        elif lf < 0:
+            stop = cr
+        else:
+            stop = min(cr, lf)
+        if stop < 0:
+            stop = end
+        if stop > start:
+            yield view[start:stop]
+        start = stop + 1
+
+
+class PromptReader(object):
+    """
+        Accumulates the output of the adapter until the prompt character
+        is seen.
+
+        Instead of looping over readline() (which always waits for the
+        port timeout on the last line, since the prompt has no line
+        terminator) every available byte is pulled at once and only the
+        newly arrived bytes are scanned for the prompt.
+    """
+
+    def __init__(self, port, prompt=b'>', timeout=1.0):
+        self.port    = port
+        self.prompt  = prompt
+        self.timeout = timeout
+        self.__buffer = bytearray()
+
+    def reset(self):
+        """ drops everything received after the last prompt """
+        del self.__buffer[:]
+
+    def read_until_prompt(self, timeout=None):
+        """
+            returns the bytes received up to (not including) the prompt,
+            or None if the prompt did not arrive before the timeout.
+            Bytes received after the prompt are kept for the next call.
+        """
+        port    = self.port
+        buffer  = self.__buffer
+        prompt  = self.prompt
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        scanned = 0
+        while True:
+            idx = buffer.find(prompt, scanned)
+            if idx >= 0:
+                break
+            scanned = len(buffer)
+
+            if time.monotonic() >= deadline:
+                logger.warning("Failed to read port: prompt not received")
+                return None
+
+            waiting = port.in_waiting
+            if waiting:
+                buffer += port.read(waiting)
+            else:
+                # block until the next byte arrives (bounded by port.timeout)
+                buffer += port.read(1)
+
+        response = buffer[:idx]
+        del buffer[:idx + 1]
+        return response
+
+    def read_lines(self, timeout=None):
+        """
+            returns a list of [\r\n] delimited strings, without empty lines,
+            trailing spaces or null characters
+        """
+        response = self.read_until_prompt(timeout)
+        if not response:
+            return []
+
+        has_nulls = response.find(b'\x00') >= 0
+        lines = []
+        for line in split_lines(response):
+            s = str(line, "utf-8", "ignore")
+            if has_nulls:
+                s = s.replace('\x00', '')
+            s = s.strip()
+            if s:
+                lines.append(s)
+        return lines
@@ -0,0 +1,198 @@
+########################################################################
+#
+# ringbuffer.py
+#
+# Single producer / multi consumer byte ring for STMA monitor output
+#
+########################################################################
+
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FrameRing(object):
+    """
+        Preallocated byte ring filled by a single serial reader thread.
+
+        The producer copies whole serial reads into the ring and publishes
+        the new total with a single attribute store, consumers never take
+        a lock to read. Every consumer owns a RingCursor, a consumer that
+        falls more than `size` bytes behind is resynchronised to the oldest
+        line still available and the overrun is counted on its cursor.
+    """
+
+    def __init__(self, size=1 << 20):
+        self.size     = size
+        self.__buf    = bytearray(size)
+        self.__view   = memoryview(self.__buf)
+        self.__cond   = threading.Condition()
+        self.__cursors = {}
+        # total number of bytes ever written, only the producer updates it
+        self.written  = 0
+        self.closed   = False
+
+    def write(self, data):
+        """ copies a chunk of monitor output into the ring (producer only) """
+        n = len(data)
+        if not n:
+            return
+        size = self.size
+        if n > size:
+            # only the newest bytes fit, consumers will see the overrun
+            self.written += n - size
+            data = data[n - size:]
+            n = size
+        start = self.written % size
+        first = min(n, size - start)
+        self.__view[start:start + first] = data[:first]
+        if first < n:
+            self.__view[:n - first] = data[first:]
+        self.written += n
+
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def close(self):
+        """ wakes up every consumer, used when the producer stops """
+        self.closed = True
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def wait(self, position, timeout=None):
+        """ blocks until there is data past `position` or the ring is closed """
+        if self.written > position or self.closed:
+            return True
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.written > position or self.closed, timeout)
+
+    def reader(self, name, from_start=False):
+        """ returns a new RingCursor, positioned at the newest data by default """
+        cursor = RingCursor(self, name, 0 if from_start else self.written)
+        self.__cursors[name] = cursor
+        return cursor
+
+    def remove_reader(self, name):
+        self.__cursors.pop(name, None)
+
+    def cursors(self):
+        """ the consumers currently attached """
+        return list(self.__cursors.values())
+
+    def overruns(self):
+        """ returns {consumer name: overrun count} """
+        return dict((name, c.overruns) for name, c in self.__cursors.items())
+
+    def lag(self):
+        """ returns {consumer name: bytes not yet consumed} """
+        return dict((name, self.written - c.position) for name, c in self.__cursors.items())
+
+    def _region(self, start, stop):
+        """
+            returns (buffer, view, i, j) so that buffer[i:j] holds the bytes
+            in [start, stop), the region is only copied when it wraps around
+            the end of the ring
+        """
+        size = self.size
+        i = start % size
+        j = i + (stop - start)
+        if j <= size:
+            return self.__buf, self.__view, i, j
+        data = self.__view[i:].tobytes() + self.__view[:j - size].tobytes()
+        return data, memoryview(data), 0, len(data)
+
+
+class RingCursor(object):
+    """ read position of one consumer (bridge, recorder, printer, ...) """
+
+    def __init__(self, ring, name, position):
+        self.ring      = ring
+        self.name      = name
+        self.position  = position
+        self.overruns  = 0
+        self.lost      = 0   # bytes skipped because of overruns
+        self.scanned   = position   # end of the data read() has looked at
+
+    def __check_overrun(self):
+        ring = self.ring
+        behind = ring.written - self.position
+        if behind <= ring.size:
+            return False
+        self.overruns += 1
+        self.lost += behind - ring.size
+        self.position = ring.written - ring.size
+        logger.warning("ring consumer %s overrun, %d bytes lost" % (self.name, behind - ring.size))
+        return True
+
+    def read(self):
+        """
+            returns every complete line available, as memoryviews over the
+            ring (empty lines removed, terminators stripped).
+
+            The views are only valid until the producer writes another
+            `ring.size` bytes, copy them (bytes(line)) to keep them longer.
+        """
+        ring = self.ring
+        resync = self.__check_overrun()
+        stop = ring.written
+        self.scanned = stop
+        if stop == self.position:
+            return []
+
+        begin = self.position
+        buf, view, i, j = ring._region(begin, stop)
+        origin = i
+        if resync:
+            # the first line was cut by the overrun, drop it
+            cut = _find_eol(buf, i, j)
+            if cut < 0:
+                self.position = stop
+                return []
+            i = cut + 1
+
+        lines = []
+        while i < j:
+            eol = _find_eol(buf, i, j)
+            if eol < 0:
+                break
+            if eol > i:
+                lines.append(view[i:eol])
+            i = eol + 1
+        self.position += i - origin
+
+        # the producer may have lapped us while we were splitting
+        if ring.written - begin > ring.size:
+            self.overruns += 1
+            self.lost += self.position - begin
+            return []
+        return lines
+
+    def frames(self, timeout=None):
+        """
+            generator of lines, blocks waiting for data until the ring is
+            closed and drained; an unterminated last line is then dropped
+        """
+        ring = self.ring
+        while True:
+            # past what was already scanned: an unterminated line does not
+            # make it return until more data arrives
+            if not ring.wait(self.scanned, timeout):
+                continue
+            closed = ring.closed
+            lines = self.read()
+            for line in lines:
+                yield line
+            if closed and ring.written == self.scanned:
+                return
+
+
+def _find_eol(buf, start, end):
+    """ position of the next CR or LF in buf[start:end], -1 if none """
+    cr = buf.find(b'\r', start, end)
+    lf = buf.find(b'\n', start, end)
+    if cr < 0:
+        return lf
+    if lf < 0:
+        return cr
+    return min(cr, lf)
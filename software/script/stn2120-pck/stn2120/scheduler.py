@@ -0,0 +1,218 @@
+########################################################################
+#
+# scheduler.py
+#
+# Deadline based scheduler for cyclic CAN frames (ECU emulation)
+#
+########################################################################
+
+import heapq
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def format_frame(can_id, data, extended=None):
+    """
+        b'h:<ID>,d:<DATA> ' as expected by TransmitEngine.submit(), the
+        header has 8 digits for 29 bit IDs (extended, or None for any ID
+        above 0x7FF). Raises ValueError on a frame STPX cannot send.
+    """
+    if extended is None:
+        extended = can_id > 0x7FF
+    if not 0 <= can_id <= (0x1FFFFFFF if extended else 0x7FF):
+        raise ValueError("CAN ID %X out of range" % can_id)
+    if not 1 <= len(data) <= 8:
+        raise ValueError("CAN ID %X: %d data bytes, 1 to 8 expected" % (can_id, len(data)))
+    header = b'h:%08X,d:' if extended else b'h:%03X,d:'
+    return header % can_id + b''.join(b'%02X ' % b for b in data)
+
+
+class PeriodicFrame(object):
+    """
+        one cyclic frame and the period/jitter achieved on it, only the
+        cycles acknowledged by the adapter count as sent
+    """
+
+    def __init__(self, can_id, data, period, extended=None):
+        if extended is None:
+            extended = can_id > 0x7FF
+        self.can_id   = can_id
+        self.extended = extended
+        self.frame    = format_frame(can_id, data, extended)
+        self.period   = period
+        self.gen      = 0       # bumped on update/remove, stale heap entries are skipped
+        self.sent     = 0
+        self.failed   = 0       # cycles answered with an error or never answered
+        self.rejected = 0       # cycles refused before transmission
+        self.skipped  = 0       # cycles dropped because the scheduler fell behind
+        self.late     = 0       # cycles sent later than max_jitter
+        self.__last   = None
+        self.__sum_dt = 0.0
+        self.__sum_jitter = 0.0
+        self.max_jitter = 0.0
+
+    def record(self, due, now):
+        jitter = now - due
+        if self.__last is not None:
+            self.__sum_dt += now - self.__last
+        self.__last = now
+        self.__sum_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+        self.sent += 1
+        return jitter
+
+    def stats(self):
+        intervals = self.sent - 1
+        return {
+            'period_ms'      : 1000 * self.period,
+            'achieved_ms'    : 1000 * self.__sum_dt / intervals if intervals > 0 else None,
+            'jitter_avg_ms'  : 1000 * self.__sum_jitter / self.sent if self.sent else None,
+            'jitter_max_ms'  : 1000 * self.max_jitter,
+            'sent'           : self.sent,
+            'failed'         : self.failed,
+            'rejected'       : self.rejected,
+            'late'           : self.late,
+            'skipped'        : self.skipped,
+        }
+
+
+class CyclicScheduler(object):
+    """
+        Sends periodic frames through a TransmitEngine.
+
+        Next due times are kept in a heap and always advanced by exactly one
+        period from the previous deadline, so periods do not drift. At most
+        `max_burst` frames are sent per wakeup; a frame later than
+        `max_jitter` seconds is counted as late and, when a whole period
+        was missed, the missed cycles are skipped instead of sent in a burst.
+        A cycle is counted (and its jitter kept) once the adapter
+        acknowledges it, failed and rejected cycles are counted per ID.
+        Frames are keyed by (CAN ID, extended): 0x412 and 0x00000412 are
+        two different frames.
+    """
+
+    def __init__(self, engine, max_burst=8, max_jitter=0.005):
+        self.engine     = engine
+        self.max_burst  = max_burst
+        self.max_jitter = max_jitter
+
+        self.__frames  = {}
+        self.__heap    = []
+        self.__seq     = 0
+        self.__cond    = threading.Condition()
+        self.__running = True
+        self.__thread  = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __push(self, due, entry):
+        self.__seq += 1
+        heapq.heappush(self.__heap, (due, self.__seq, entry.gen, entry))
+
+    @staticmethod
+    def __key(can_id, extended):
+        return (can_id, can_id > 0x7FF if extended is None else bool(extended))
+
+    def add(self, can_id, data, period_ms, extended=None):
+        """
+            starts sending `data` on `can_id` every `period_ms` milliseconds,
+            `can_id` is a 29 bit ID when extended (by default when above
+            0x7FF). Raises ValueError on a frame that cannot be sent.
+        """
+        key = self.__key(can_id, extended)
+        with self.__cond:
+            if key in self.__frames:
+                raise KeyError(("CAN ID %08X" if key[1] else "CAN ID %03X")
+                               % can_id + " already scheduled")
+            entry = PeriodicFrame(can_id, data, period_ms / 1000.0, key[1])
+            self.__frames[key] = entry
+            self.__push(time.monotonic(), entry)
+            self.__cond.notify()
+
+    def update(self, can_id, data=None, period_ms=None, extended=None):
+        """ changes the payload and/or the period of a scheduled frame """
+        with self.__cond:
+            entry = self.__frames[self.__key(can_id, extended)]
+            if data is not None:
+                entry.frame = format_frame(can_id, data, entry.extended)
+            if period_ms is not None and period_ms / 1000.0 != entry.period:
+                entry.period = period_ms / 1000.0
+                entry.gen += 1
+                self.__push(time.monotonic(), entry)
+                self.__cond.notify()
+
+    def remove(self, can_id, extended=None):
+        with self.__cond:
+            entry = self.__frames.pop(self.__key(can_id, extended))
+            entry.gen += 1
+
+    def stats(self):
+        """
+            returns {(CAN ID, extended): achieved period, jitter,
+            sent/failed/rejected/late/skipped}
+        """
+        with self.__cond:
+            return dict((key, e.stats()) for key, e in self.__frames.items())
+
+    def __run(self):
+        heap = self.__heap
+        while True:
+            due_frames = []
+            with self.__cond:
+                while self.__running:
+                    # drop entries invalidated by update()/remove()
+                    while heap and heap[0][2] != heap[0][3].gen:
+                        heapq.heappop(heap)
+                    if not heap:
+                        self.__cond.wait()
+                        continue
+                    delay = heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.__cond.wait(delay)
+                if not self.__running:
+                    return
+
+                now = time.monotonic()
+                while heap and len(due_frames) < self.max_burst and heap[0][0] <= now:
+                    due, _, gen, entry = heapq.heappop(heap)
+                    if gen != entry.gen:
+                        continue
+                    due_frames.append((due, entry, entry.frame))
+                    next_due = due + entry.period
+                    if next_due <= now:
+                        # a whole period was missed, skip to the next deadline
+                        missed = int((now - due) / entry.period)
+                        entry.skipped += missed
+                        next_due = due + (missed + 1) * entry.period
+                    self.__push(next_due, entry)
+
+            for due, entry, frame in due_frames:
+                t_sent = time.monotonic()
+                self.engine.submit(frame).add_done_callback(
+                    lambda f, due=due, entry=entry, t_sent=t_sent: self.__done(f, due, entry, t_sent))
+
+    def __done(self, future, due, entry, t_sent):
+        """
+            counts a cycle once the engine resolved its Future, runs on the
+            engine's reader thread so the counters are updated under the
+            scheduler lock, as stats() reads them
+        """
+        error = future.exception()
+        with self.__cond:
+            if error is None:
+                if entry.record(due, t_sent) > self.max_jitter:
+                    entry.late += 1
+            elif isinstance(error, ValueError):
+                entry.rejected += 1
+            else:
+                entry.failed += 1
+
+    def close(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify()
+        self.__thread.join(1)
@@ -6,18 +6,16 @@ import logging
 
 
 from  .ic_config   import STN2120
+from .ringbuffer import FrameRing
+from .dedupe import FrameDeduplicator
+from . import metrics
+from threading import Thread
 from .utils import scan_serial, OBDStatus
+from .trace import TRACER
 
 
-import os
-
-
-logging.basicConfig(
-                     filename='stn2120.log'
-                    ,format='%(asctime)s %(levelname)-8s %(message)s'
-                    #,datefmt='%H:%M:%S'
-                    ,level=logging.DEBUG)
-#                  level=os.environ.get("LOGLEVEL", "INFO")
+# logging is configured by the application, the library only adds a
+# NullHandler (see stn2120/__init__.py) and never writes stn2120.log itself
 logger = logging.getLogger(__name__)
 
 class Board(object):
@@ -31,15 +29,20 @@ class Board(object):
     vehículo (``clt_car``).
     """
 
-    def __init__(self, portdev=None, baudrate=None, protocol=None, role=None, timeout=0.1):
+    def __init__(self, portdev=None, baudrate=None, protocol=None, role=None, timeout=0.1,
+                 save_baud=False, warm_start=False, use_profiles=False, timestamps=False):
         """Inicializa una conexión con la placa STN2120.
 
         Args:
             portdev (list[str] | None): Lista de dispositivos serie disponibles
                 donde se intentará abrir la conexión (p. ej. ``['/dev/ttyUSB0']``).
                 Si es ``None`` se realizará el escaneo automático.
-            baudrate (int | None): Velocidad del puerto serie en baudios. Si es
-                ``None`` se delega la selección al objeto :class:`STN2120`.
+            baudrate (int | str | None): Velocidad del puerto serie en baudios.
+                Si es ``None`` se delega la selección al objeto
+                :class:`STN2120`. Con ``'auto'`` se detecta la velocidad
+                actual de cada placa y se sube (``STBR``) a la más alta que
+                supera una prueba de integridad y rendimiento; la velocidad
+                elegida se guarda en caché por número de serie.
             protocol (str | None): Identificador del protocolo OBD-II (por
                 ejemplo ``"31"``). Puede dejarse en ``None`` para usar el
                 predeterminado del firmware.
@@ -50,6 +53,21 @@ class Board(object):
                 dispositivo.
             timeout (float): Tiempo máximo de espera (en segundos) para las
                 operaciones de lectura/escritura en el puerto serie.
+            save_baud (bool): Con ``baudrate='auto'``, guarda además la
+                velocidad elegida en la NVM de la placa (``STWBR``).
+            warm_start (bool): Si es ``True`` se lee el estado actual de la
+                placa (eco, ``STPR``, marca de configuración en ``AT@1``) y
+                sólo se envían los comandos que difieren, sin ``ATZ``. Se
+                recurre al reset completo únicamente si falla la lectura.
+            use_profiles (bool): Si es ``True`` cada nodo arranca desde su
+                perfil guardado en NVM (``'r'`` monitor, ``'w'`` escritura,
+                ver :mod:`stn2120.profiles`). El perfil se escribe una sola
+                vez y se verifica por checksum (``AT@1``) en cada conexión.
+            timestamps (bool): Si es ``True`` se activan las marcas de tiempo
+                del adaptador en el nodo ``'r'``; cada trama monitorizada
+                recibe su instante en el bus (en tiempo monotónico del host)
+                y se registran histogramas de latencia, ver
+                :meth:`latency_report`.
 
         Raises:
             AttributeError: Si ``role`` no se especifica o no pertenece a los
@@ -74,16 +92,19 @@ class Board(object):
                 print ("portdev must be list type: ['/dev/ttyUSB0',]")
                 return
 
-        self.__connect(portdev, baudrate, protocol)
+        self.__connect(portdev, baudrate, protocol, save_baud, warm_start, use_profiles,
+                       timestamps)
 
         #self.send_cmd()
 
-    def __connect(self, portdev, baudrate, protocol):
+    def __connect(self, portdev, baudrate, protocol, save_baud=False, warm_start=False,
+                  use_profiles=False, timestamps=False):
         """Establece la conexión física con la placa STN2120."""
         ### portdev = '/dev/ttyUSB0'
         ### baudrate = 2000000
         ### protocol = "31"
-        self.device = STN2120(portdev, baudrate, protocol, self.role, self.timeout)
+        self.device = STN2120(portdev, baudrate, protocol, self.role, self.timeout, save_baud,
+                              warm_start, use_profiles, timestamps)
         print("self.device ports", self.status())
         if self.status() == 'STN2120 Not Connected':
             logger.warning("error connecting devices")
@@ -130,31 +151,96 @@ class Board(object):
         messages = self.device.send_and_parse( cmd.encode('utf-8'), node)
         print("Result: ", messages)
 
-    def start_diagnosis(self):
+    def start_diagnosis(self, echo=None, wire='binary', batch_frames=64, batch_delay=0.001,
+                        hub=None, transport=None):
         """Inicia la rutina de diagnóstico continuo del dispositivo.
 
+        Args:
+            echo (EchoSuppressor | None): Tabla de tramas escritas en el bus
+                cuyo eco no se reenvía. Por defecto se usa un
+                ``echo.EchoSuppressor`` en memoria; ``echo.RedisEchoSuppressor``
+                la comparte a través de Redis.
+            wire (str): Formato de las tramas en el puente TCP: ``'binary'``
+                (registros de longitud fija de ``netcom``), ``'delta'``
+                (registros con compresión delta por ID CAN, para enlaces
+                lentos; ver ``delta_report``) o ``'text'`` (mensajes
+                ``b'fr:'`` anteriores). Un extremo ``'binary'`` lee también
+                ``'delta'``; ``'text'`` debe usarse en ambos extremos.
+            batch_frames (int): Tramas por lote enviado al socket.
+            batch_delay (float): Espera máxima en segundos de una trama
+                antes de enviar su lote; ``0`` envía cada trama por separado.
+                Una ventana mayor reduce las llamadas al sistema a cambio de
+                latencia.
+            hub (tuple[str, int] | None): Dirección de un
+                ``network.hub.BridgeHub``. Si se indica, el nodo se une al hub
+                con su rol en lugar de conectarse directamente al otro extremo.
+                Requiere ``wire='binary'`` o ``'delta'``.
+            transport (object | None): Transporte ya configurado con la
+                interfaz ``send_data``/``get_data`` (por ejemplo
+                ``netcom.UDPTransport`` para el espejo en vivo por UDP o
+                multicast) en lugar de la conexión TCP.
+
+        Raises:
+            ValueError: Si se indica ``hub`` con ``wire='text'``.
+
         Side Effects:
             Cambia el modo de operación del STN2120 para ejecutar
             ``_diagnosis`` y escribe la acción en el log.
         """
         logger.debug("Starting  DIAGNOSIS stn2120 ...")
-        self.device._diagnosis()
+        self.device._diagnosis(echo, wire, batch_frames, batch_delay, hub,
+                              transport)
 
 
 
-    def read_can_bus(self):
+    def read_can_bus(self, dedupe_window=None, callback=None):
         """Lee tramas entrantes del bus CAN.
 
+        Args:
+            dedupe_window (float | None): Si se indica, descarta las tramas
+                con el mismo ID CAN y los mismos datos recibidas dentro de
+                esa ventana (en segundos). ``None`` reenvía todas.
+            callback (callable | None): Función llamada con cada trama, la
+                línea del monitor en ``bytes`` sin el fin de línea (p. ej.
+                ``b'7E8 06 41 00 BE 3F A8 13'``); se puede decodificar con
+                :func:`stn2120.decoder.decode_line`. Se ejecuta en el hilo
+                lector, debe ser rápida. ``None`` imprime cada trama en
+                consola.
+
         Returns:
-            None: La información leída se almacena temporalmente en el objeto
-            ``STN2120``; este método no expone un valor de retorno.
+            None: El método bloquea mientras monitoriza el bus (``STMA``) y
+            entrega las tramas a ``callback``.
 
         Side Effects:
             Registra en el log la operación de lectura y delega en
             :meth:`STN2120.read_can_bus` la obtención de las tramas.
         """
         logger.info ("reading 2 can bus ...")
-        message = self.device.read_can_bus()
+        dedupe = FrameDeduplicator(dedupe_window) if dedupe_window else None
+        self.device.read_can_bus(dedupe, callback)
+
+
+    def start_monitor(self, size=1 << 20):
+        """Arranca la monitorización (STMA) sobre un buffer circular compartido.
+
+        Un único hilo lee el puerto ``'r'`` en bloques y llena un
+        :class:`FrameRing` preasignado. Cada consumidor (bridge, grabador,
+        impresión por consola, ...) obtiene su propio cursor con
+        ``ring.reader(nombre)`` y lee las tramas sin copias ni bloqueos por
+        trama.
+
+        Args:
+            size (int): Tamaño del buffer circular en bytes.
+
+        Returns:
+            FrameRing: Buffer compartido. ``ring.overruns()`` informa de los
+            desbordamientos por consumidor y ``ring.close()`` detiene el hilo
+            lector.
+        """
+        logger.info ("monitor 2 ring buffer ...")
+        ring = FrameRing(size)
+        Thread(target=self.device.monitor_to_ring, args=(ring,), daemon=True).start()
+        return ring
 
 
     def write_can_bus(self):
@@ -208,6 +294,154 @@ class Board(object):
             self.device = None
 
 
+    def set_can_filter(self, ids=(), ranges=(), max_filters=10, rates=None):
+        """Carga filtros hardware (STFPA) que sólo dejan pasar los IDs pedidos.
+
+        Calcula el conjunto mínimo de pares patrón/máscara que acepta todos
+        los IDs y rangos indicados, admitiendo algunos falsos positivos para
+        no superar ``max_filters``, y lo carga con ``STFAC`` + ``STFPA``.
+
+        Args:
+            ids (iterable[int]): IDs CAN de interés.
+            ranges (iterable[tuple[int, int]]): Rangos ``(primero, último)``.
+            max_filters (int): Número de filtros de paso disponibles.
+            rates (dict | None): ``{id: tramas/s}`` medido en el bus. Si es
+                ``None`` se muestrea el bus durante un segundo.
+
+        Returns:
+            dict: Filtros cargados, falsos positivos y carga esperada de la
+            UART (bytes/s) antes y después del filtrado.
+        """
+        return self.device.set_pass_filters(ids, ranges, max_filters, rates)
+
+
+    def cyclic_scheduler(self):
+        """Devuelve el planificador de tramas periódicas del nodo ``'w'``.
+
+        Permite emular ECUs que envían varios IDs con periodos de 10 a
+        1000 ms::
+
+            sched = board.cyclic_scheduler()
+            sched.add(0x412, b'\x10\x00\x00\x06', period_ms=100)
+            sched.update(0x412, period_ms=50)
+            sched.remove(0x412)
+            sched.stats()   # periodo conseguido y jitter por (ID, extendido)
+
+        Returns:
+            CyclicScheduler: Planificador asociado al motor de transmisión.
+        """
+        return self.device.cyclic_scheduler()
+
+
+    def transmit_stats(self):
+        """Devuelve el rendimiento real de transmisión STPX del nodo ``'w'``.
+
+        Returns:
+            dict: Tramas enviadas, confirmadas (``OK``), errores, timeouts,
+            tramas en vuelo, tramas/s y latencia media de confirmación.
+        """
+        if self.device is None:
+            return {}
+        return self.device.transmit_engine().stats()
+
+
+    def init_report(self):
+        """Devuelve la duración de cada comando de la inicialización.
+
+        Returns:
+            dict: ``{nodo: [(comando, segundos), ...]}`` para los puertos
+            ``'r'`` y ``'w'``, que se inicializan en paralelo.
+        """
+        if self.device is None:
+            return {}
+        return self.device.init_report()
+
+    def stats(self):
+        """Devuelve una instantánea de las métricas de la librería.
+
+        Returns:
+            dict: ``{'metrics': {...}, 'rates': {...}, 'interval': float}``.
+            ``metrics`` contiene el valor actual de cada métrica (tramas y
+            bytes por puerto, eventos ``BUFFER FULL``, tramas duplicadas,
+            eco y descartadas, profundidad de colas, ``STPX`` confirmados y
+            con error, volumen enviado/recibido por socket) y ``rates`` el
+            ritmo por segundo de cada contador desde la instantánea anterior
+            (``interval`` segundos).
+        """
+        return metrics.REGISTRY.snapshot()
+
+    def serve_metrics(self, port=9120, host='127.0.0.1'):
+        """Publica las métricas en formato de texto de Prometheus.
+
+        Args:
+            port (int): Puerto HTTP local (``0`` elige uno libre).
+            host (str): Dirección en la que escucha el servidor.
+
+        Returns:
+            HTTPServer: Servidor que atiende ``/metrics`` desde un hilo
+            propio; ``server.shutdown()`` lo detiene.
+        """
+        return metrics.start_http_server(port, host)
+
+    def enable_trace(self, records=16384, dump_path=None):
+        """Activa la traza binaria de las rutas críticas.
+
+        Cada trama leída/escrita, eco suprimido, ``BUFFER FULL``, comando y
+        envío/recepción por socket se guarda como registro binario en un
+        buffer circular en memoria, sin formatear cadenas. Desactivada, la
+        traza sólo cuesta una comprobación por trama.
+
+        Args:
+            records (int): Número de eventos que guarda el buffer circular.
+            dump_path (str | None): Si se indica, el buffer se vuelca a este
+                fichero cuando se produce un error (STPX rechazado o sin
+                respuesta, fallo de inicialización).
+        """
+        TRACER.enable(records, dump_path)
+
+    def dump_trace(self, path):
+        """Vuelca la traza actual a ``path``.
+
+        El fichero se lee con :func:`stn2120.trace.load` y se convierte en
+        texto con :func:`stn2120.trace.format_events`.
+
+        Returns:
+            int: Número de eventos escritos.
+        """
+        return TRACER.dump(path)
+
+    def latency_report(self):
+        """Devuelve los histogramas de latencia por etapa.
+
+        Requiere ``timestamps=True``.
+
+        Returns:
+            dict: ``{'bus_host': {...}, 'host_socket': {...},
+            'clock_drift_ppm': float}``; cada histograma incluye ``count``,
+            ``min``, ``mean``, ``p50``, ``p90``, ``p99``, ``p999`` y ``max``
+            en microsegundos.
+        """
+        if self.device is None:
+            return {}
+        return self.device.latency_report()
+
+
+    def delta_report(self):
+        """Devuelve el ahorro de ancho de banda de la compresión delta.
+
+        Requiere ``start_diagnosis(wire='delta')``.
+
+        Returns:
+            dict | None: ``frames``, ``keyframes``, ``unchanged``,
+            ``bytes_full`` (bytes como registros completos), ``bytes_sent``,
+            ``saved`` (fracción ahorrada) y ``encode_us_frame`` (coste de CPU
+            por trama en microsegundos); ``None`` sin compresión delta.
+        """
+        if self.device is None:
+            return None
+        return self.device.delta_report()
+
+
     def status(self):
         """Devuelve el estado de conexión actual del STN2120."""
         if self.device is None:
@@ -0,0 +1,208 @@
+########################################################################
+#
+# timing.py
+#
+# Adapter timestamps -> host monotonic time, and latency histograms
+#
+########################################################################
+
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+_SPACE = 0x20
+
+
+def split_timestamp(buf, start=0):
+    """
+        (raw timestamp, offset of the frame) of a monitor line printed with
+        timestamps ON, the timestamp being the first hex field. None when
+        the line does not start with one.
+    """
+    end = len(buf)
+    while start < end and buf[start] == _SPACE:
+        start += 1
+    i = start
+    while i < end and buf[i] != _SPACE:
+        i += 1
+    if i == start or i == end:
+        return None
+    try:
+        return int(bytes(buf[start:i]), 16), i + 1
+    except ValueError:
+        return None
+
+
+class ClockModel(object):
+    """
+        Maps the adapter timestamp counter (`bits` wide, `tick` seconds
+        per count) to host monotonic time.
+
+        host = offset + rate * device. Arrivals are late by a variable
+        delay, so only the least delayed frame of every `interval` seconds
+        is kept (the lower envelope of the arrivals); `rate`, the drift of
+        the adapter clock, is a least squares fit over the last `window`
+        of those points and `offset` puts the line on the envelope, so
+        mapped times are never later than the arrival of the frame.
+        Counter wraps are unwrapped, also across gaps longer than a wrap,
+        with the host time elapsed in between.
+    """
+
+    def __init__(self, tick=1e-3, bits=16, interval=1.0, window=64):
+        self.tick     = tick
+        self.wrap     = 1 << bits
+        self.interval = interval
+        self.rate   = 1.0
+        self.offset = None
+        self.__points    = deque(maxlen=window)
+        self.__best      = None  # least delayed (device, host) of the interval
+        self.__t_bucket  = None
+        self.__last_raw  = None
+        self.__last_host = None
+        self.__epoch     = 0
+
+    def unwrap(self, raw, host=None):
+        """ device time in seconds of the raw counter value """
+        if self.__last_raw is not None:
+            elapsed = raw - self.__last_raw
+            if host is not None and self.__last_host is not None:
+                # wraps missed while no frame was seen
+                expected = (host - self.__last_host) / (self.tick * self.rate)
+                self.__epoch += self.wrap * int(round((expected - elapsed) / self.wrap))
+            elif elapsed < 0:
+                self.__epoch += self.wrap
+        self.__last_raw  = raw
+        self.__last_host = host
+        return (self.__epoch + raw) * self.tick
+
+    def __fit(self):
+        points = self.__points
+        d0, h0 = points[0]
+        n = len(points)
+        sd = sh = sdd = sdh = 0.0
+        for d, h in points:
+            d -= d0
+            h -= h0
+            sd += d
+            sh += h
+            sdd += d * d
+            sdh += d * h
+        den = n * sdd - sd * sd
+        if den > 0:
+            self.rate = (n * sdh - sd * sh) / den
+        rate = self.rate
+        self.offset = min(h - rate * d for d, h in points)
+
+    def update(self, raw, host):
+        """ records a frame arrival, returns its bus time in host monotonic time """
+        d = self.unwrap(raw, host)
+        if self.__t_bucket is None:
+            self.__t_bucket = host
+        elif host - self.__t_bucket >= self.interval:
+            self.__points.append(self.__best)
+            self.__best = None
+            self.__t_bucket = host
+            if len(self.__points) > 2:
+                self.__fit()
+        if self.__best is None or host - d < self.__best[1] - self.__best[0]:
+            self.__best = (d, host)
+
+        lag = host - self.rate * d
+        if self.offset is None or lag < self.offset:
+            self.offset = lag
+        return self.offset + self.rate * d
+
+    @property
+    def drift_ppm(self):
+        """ how much faster (> 0) the adapter clock runs than the host """
+        return (1.0 / self.rate - 1.0) * 1e6
+
+
+class LatencyHistogram(object):
+    """
+        HDR style histogram of latencies: log-linear buckets of whole
+        microseconds, exact below 128 us and within 1/64 (1.6 %) above,
+        so memory and record() cost do not depend on the number of
+        samples.
+    """
+
+    SUB_BITS = 7
+    SUB_COUNT = 1 << SUB_BITS     # 128
+    HALF      = SUB_COUNT >> 1    # 64
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * self.SUB_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def __index(self, v):
+        if v < self.SUB_COUNT:
+            return v
+        shift = v.bit_length() - self.SUB_BITS
+        return self.SUB_COUNT + (shift - 1) * self.HALF + (v >> shift) - self.HALF
+
+    def __value(self, index):
+        """ middle of the bucket, in us """
+        if index < self.SUB_COUNT:
+            return index
+        shift = (index - self.SUB_COUNT) // self.HALF + 1
+        sub = (index - self.SUB_COUNT) % self.HALF + self.HALF
+        return (sub << shift) + (1 << shift) // 2
+
+    def record(self, seconds):
+        v = int(seconds * 1e6)
+        if v < 0:
+            v = 0
+        i = self.__index(v)
+        counts = self.counts
+        if i >= len(counts):
+            counts.extend([0] * (i + 1 - len(counts)))
+        counts[i] += 1
+        self.count += 1
+        self.total += v
+        if self.min is None or v < self.min:
+            self.min = v
+        if v > self.max:
+            self.max = v
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """ latency in us below which p % of the samples are """
+        if not self.count:
+            return 0
+        rank = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return min(self.__value(i), self.max)
+        return self.max
+
+    def snapshot(self):
+        """ summary in microseconds """
+        return {
+            'count' : self.count,
+            'min'   : self.min or 0,
+            'mean'  : self.total / self.count if self.count else 0.0,
+            'p50'   : self.percentile(50),
+            'p90'   : self.percentile(90),
+            'p99'   : self.percentile(99),
+            'p999'  : self.percentile(99.9),
+            'max'   : self.max,
+        }
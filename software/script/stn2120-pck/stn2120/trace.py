@@ -0,0 +1,154 @@
+########################################################################
+#
+# trace.py
+#
+# Binary event tracing of the hot paths into an in-memory ring
+#
+########################################################################
+
+import time
+import struct
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+# event kinds
+FRAME_RX    = 1   # frame read from the monitor
+FRAME_TX    = 2   # frame handed to STPX
+ECHO        = 3   # own frame seen back on the monitor, not forwarded
+BUFFER_FULL = 4
+SOCKET_TX   = 5
+SOCKET_RX   = 6
+COMMAND     = 7   # AT/ST command written to a node
+ERROR       = 8
+
+NAMES = {
+    FRAME_RX    : 'frame_rx',
+    FRAME_TX    : 'frame_tx',
+    ECHO        : 'echo',
+    BUFFER_FULL : 'buffer_full',
+    SOCKET_TX   : 'socket_tx',
+    SOCKET_RX   : 'socket_rx',
+    COMMAND     : 'command',
+    ERROR       : 'error',
+}
+
+# record: monotonic ns, kind, node, payload length, payload (truncated)
+_HEADER = struct.Struct('<QBBH')
+RECORD  = 64
+PAYLOAD = RECORD - _HEADER.size
+
+_MAGIC = b'STNTRC1\n'
+
+_now_ns = getattr(time, 'monotonic_ns', lambda: int(time.monotonic() * 1e9))
+
+
+class Tracer(object):
+    """
+        Fixed size ring of binary trace events.
+
+        Disabled, a trace point costs one attribute test:
+
+            if TRACER.enabled:
+                TRACER.event(FRAME_RX, data, 'r')
+
+        Enabled, event() packs the record in place in a preallocated
+        buffer, no string is formatted. The ring is decoded only when it
+        is dumped: on demand, or by error() when a dump_path is set.
+    """
+
+    def __init__(self):
+        self.enabled   = False
+        self.dump_path = None
+        self.__buffer  = None
+        self.__records = 0
+        self.__seq     = itertools.count()
+        self.__next    = 0
+
+    def enable(self, records=16384, dump_path=None):
+        self.__buffer  = bytearray(records * RECORD)
+        self.__records = records
+        self.__seq     = itertools.count()
+        self.__next    = 0
+        self.dump_path = dump_path
+        self.enabled   = True
+
+    def disable(self):
+        self.enabled = False
+
+    def event(self, kind, payload=b'', node=None):
+        # next() on itertools.count is atomic, every thread gets its own slot
+        n = next(self.__seq)
+        self.__next = n + 1
+        off = (n % self.__records) * RECORD
+        size = min(len(payload), PAYLOAD)
+        _HEADER.pack_into(self.__buffer, off, _now_ns(), kind,
+                          ord(node) if node else 0, size)
+        self.__buffer[off + _HEADER.size:off + _HEADER.size + size] = payload[:size]
+
+    def error(self, what, node=None):
+        """ records an ERROR event and dumps the ring to dump_path """
+        if not self.enabled:
+            return
+        if isinstance(what, str):
+            what = what.encode('utf-8', 'replace')
+        self.event(ERROR, what, node)
+        if self.dump_path:
+            try:
+                self.dump(self.dump_path)
+            except OSError as e:
+                logger.warning("trace dump failed: %s" % e)
+
+    def raw(self):
+        """ the records in the ring, oldest first """
+        if self.__buffer is None:
+            return b''
+        n = self.__next
+        if n <= self.__records:
+            return bytes(self.__buffer[:n * RECORD])
+        split = (n % self.__records) * RECORD
+        return bytes(self.__buffer[split:] + self.__buffer[:split])
+
+    def events(self):
+        """ yields (monotonic ns, kind name, node, payload), oldest first """
+        return decode(self.raw())
+
+    def dump(self, path):
+        """ writes the ring to `path`, read it back with load() """
+        data = self.raw()
+        with open(path, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(data)
+        logger.info("trace: %d events dumped to %s" % (len(data) // RECORD, path))
+        return len(data) // RECORD
+
+
+def decode(data):
+    for off in range(0, len(data) - RECORD + 1, RECORD):
+        t, kind, node, size = _HEADER.unpack_from(data, off)
+        payload = data[off + _HEADER.size:off + _HEADER.size + size]
+        yield t, NAMES.get(kind, str(kind)), chr(node) if node else '', bytes(payload)
+
+
+def load(path):
+    """ events of a dump written by Tracer.dump() """
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a trace dump" % path)
+        return list(decode(f.read()))
+
+
+def format_events(events):
+    """ one text line per event, times relative to the first one """
+    lines = []
+    t0 = None
+    for t, kind, node, payload in events:
+        if t0 is None:
+            t0 = t
+        lines.append("%12.6f %-11s %1s %r" % ((t - t0) / 1e9, kind, node, payload))
+    return "\n".join(lines)
+
+
+# tracer used by the library, disabled until enable() is called
+TRACER = Tracer()
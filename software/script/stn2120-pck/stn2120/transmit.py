@@ -0,0 +1,273 @@
+########################################################################
+#
+# transmit.py
+#
+# Pipelined STPX transmit engine for the 'w' node
+#
+########################################################################
+
+import re
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+
+from .reader import split_lines
+from . import trace
+from .trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+# b'h:7DF,d:02 01 00 ' frames as produced by the bridge, 29 bit IDs
+# with 8 digits (b'h:18DAF110,d:...')
+FRAME_PATTERN = re.compile(b'^h:([A-F0-9]{1,3}|[A-F0-9]{8}),d:([A-F0-9]{2} ){1,8}')
+
+
+class TransmitError(Exception):
+    """ the adapter answered a command with something other than OK """
+
+    def __init__(self, frame, lines):
+        Exception.__init__(self, "%r: %r" % (frame, lines))
+        self.frame = frame
+        self.lines = lines
+
+
+class TransmitEngine(object):
+    """
+        Keeps up to `window` commands in flight on a serial port and
+        matches every prompt terminated reply with the command that caused
+        it (the adapter answers in order).
+
+        submit() returns a concurrent.futures.Future per frame, resolved
+        with the reply lines when the adapter answers OK, or with a
+        TransmitError / TimeoutError otherwise. window=1 gives plain
+        stop-and-wait. The Futures are running once returned and cannot be
+        cancelled: the command is already on the wire, its reply still
+        takes its place in the pipeline.
+
+        When a command gets no reply within `timeout` its late reply could
+        be matched with the next command, so the pipeline is resynchronised:
+        every command in flight is failed (their outcome is unknown), the
+        RESYNC_CMD marker is sent and replies are discarded until the
+        marker's own reply comes back.
+    """
+
+    STN_PROMPT = b'>'
+
+    # read only command answered with the device ID, not used elsewhere
+    RESYNC_CMD = b'STDI'
+
+    # seconds between two checks of a closed engine while waiting for a slot
+    SLOT_POLL = 0.1
+
+    def __init__(self, port, window=4, timeout=1.0):
+        self.port    = port
+        self.window  = window
+        self.timeout = timeout
+
+        self.__slots   = threading.BoundedSemaphore(window)
+        self.__lock    = threading.Lock()
+        self.__pending = deque() # (future, command, time sent)
+        self.__running = True
+        self.__resync  = None    # time the marker was sent while resynchronising
+        self.__marker  = None    # reply lines of RESYNC_CMD
+
+        self.submitted   = 0
+        self.acked       = 0
+        self.errors      = 0
+        self.timeouts    = 0
+        self.resyncs     = 0
+        self.unconfirmed = 0     # in flight when resynchronising, outcome unknown
+        self.discarded   = 0     # replies dropped while resynchronising
+        self.__latency = 0.0
+        self.__t_first = None
+        self.__t_last  = None
+
+        self.__thread = threading.Thread(target=self.__read_replies, daemon=True)
+        self.__thread.start()
+        try:
+            self.command(self.RESYNC_CMD).result(timeout)
+        except TransmitError as e:
+            # any reply but OK is a TransmitError
+            self.__marker = e.lines
+        except Exception as e:
+            logger.warning("%s: %r, resynchronising on any reply but OK" %
+                           (self.RESYNC_CMD.decode(), e))
+        # the marker exchange is not a transmission
+        self.submitted = self.acked = self.errors = 0
+        self.__latency = 0.0
+        self.__t_first = self.__t_last = None
+
+    def submit(self, frame):
+        """ transmits b'h:<ID>,d:<DATA>' with STPX, returns its Future """
+        if not FRAME_PATTERN.fullmatch(frame):
+            f = Future()
+            f.set_exception(ValueError("Frame dont write to BUS: %r" % frame))
+            return f
+        return self.command(b'STPX ' + frame + b' , t:1 ', frame)
+
+    def submit_frame(self, frame):
+        """ transmits a decoder.CanFrame, already validated by the decoder """
+        return self.command(b'STPX ' + frame.stpx() + b' , t:1 ', frame)
+
+    def command(self, cmd, frame=None):
+        """ sends any command through the pipeline, returns its Future """
+        acquired = False
+        while not acquired and self.__running:
+            acquired = self.__slots.acquire(timeout=self.SLOT_POLL)
+        f = Future()
+        with self.__lock:
+            if not self.__running:
+                if acquired:
+                    self.__slots.release()
+                f.set_exception(RuntimeError("transmit engine closed"))
+                return f
+            now = time.monotonic()
+            if self.__t_first is None:
+                self.__t_first = now
+            # cancel() returns False from now on, set_result() cannot fail
+            f.set_running_or_notify_cancel()
+            self.__pending.append((f, frame if frame is not None else cmd, now))
+            self.submitted += 1
+            self.port.write(cmd + b'\r')
+        if TRACER.enabled:
+            TRACER.event(trace.COMMAND, cmd, 'w')
+        return f
+
+    def __is_marker(self, lines):
+        if self.__marker is not None:
+            return lines == self.__marker
+        return bool(lines) and lines != ['OK']
+
+    def __complete(self, raw):
+        lines = [ bytes(l).strip().decode("utf-8", "ignore") for l in split_lines(raw) ]
+        lines = [ l for l in lines if l ]
+        with self.__lock:
+            if self.__resync is not None:
+                # reply of a command failed by the resync, or the marker's
+                if self.__is_marker(lines):
+                    self.__resync = None
+                    logger.info("transmit pipeline resynchronised, %d replies discarded" %
+                                self.discarded)
+                else:
+                    self.discarded += 1
+                return
+            if not self.__pending:
+                logger.debug("reply without command: %r" % bytes(raw))
+                return
+            f, frame, t_sent = self.__pending.popleft()
+        self.__slots.release()
+
+        now = time.monotonic()
+        self.__t_last = now
+        if not lines or lines == ['OK']:
+            self.acked += 1
+            self.__latency += now - t_sent
+            f.set_result(lines)
+        else:
+            self.errors += 1
+            error = TransmitError(frame, lines)
+            TRACER.error(str(error), 'w')
+            f.set_exception(error)
+
+    def __expire(self):
+        """
+            resynchronises the pipeline when the oldest command (or the
+            resync marker itself) was never answered
+        """
+        now = time.monotonic()
+        with self.__lock:
+            if self.__resync is not None:
+                t_sent = self.__resync
+            elif self.__pending:
+                t_sent = self.__pending[0][2]
+            else:
+                return
+            if now - t_sent < self.timeout:
+                return
+            pending = list(self.__pending)
+            self.__pending.clear()
+            self.port.write(self.RESYNC_CMD + b'\r')
+            self.__resync = now
+            self.resyncs += 1
+        for _ in pending:
+            self.__slots.release()
+        if not pending:
+            logger.warning("no reply for %s, sent again" % self.RESYNC_CMD.decode())
+            return
+
+        f, frame, _ = pending[0]
+        self.timeouts += 1
+        logger.warning("no reply for %r, resynchronising" % frame)
+        TRACER.error("no reply for %r" % frame, 'w')
+        f.set_exception(TimeoutError("no reply for %r" % frame))
+        for f, frame, _ in pending[1:]:
+            self.unconfirmed += 1
+            f.set_exception(TimeoutError("reply of %r lost in a resync" % frame))
+
+    def __read_replies(self):
+        port = self.port
+        buffer = bytearray()
+        scanned = 0
+        while self.__running:
+            try:
+                data = port.read(port.in_waiting or 1)
+            except Exception as e:
+                logger.error(str(e))
+                self.__stop("transmit engine stopped: %s" % e)
+                break
+            if not data:
+                self.__expire()
+                continue
+            buffer += data
+            while True:
+                idx = buffer.find(self.STN_PROMPT, scanned)
+                if idx < 0:
+                    scanned = len(buffer)
+                    break
+                self.__complete(buffer[:idx])
+                del buffer[:idx + 1]
+                scanned = 0
+            self.__expire()
+
+    def drain(self, timeout=None):
+        """ waits until every command in flight has been answered """
+        with self.__lock:
+            pending = [ f for f, _, _ in self.__pending ]
+        for f in pending:
+            try:
+                f.exception(timeout)
+            except Exception:
+                pass
+
+    def stats(self):
+        """ real transmit throughput, measured on the acknowledgements """
+        elapsed = 0.0
+        if self.__t_first is not None and self.__t_last is not None:
+            elapsed = self.__t_last - self.__t_first
+        return {
+            'submitted'   : self.submitted,
+            'acked'       : self.acked,
+            'errors'      : self.errors,
+            'timeouts'    : self.timeouts,
+            'resyncs'     : self.resyncs,
+            'unconfirmed' : self.unconfirmed,
+            'in_flight'   : len(self.__pending),
+            'frames_s'    : self.acked / elapsed if elapsed > 0 else 0.0,
+            'latency_ms'  : 1000 * self.__latency / self.acked if self.acked else 0.0,
+        }
+
+    def __stop(self, reason):
+        """ fails every command in flight and gives their slots back """
+        with self.__lock:
+            self.__running = False
+            pending = list(self.__pending)
+            self.__pending.clear()
+        for f, frame, _ in pending:
+            self.__slots.release()
+            f.set_exception(RuntimeError(reason))
+
+    def close(self):
+        self.__stop("transmit engine closed")
+        self.__thread.join(1)
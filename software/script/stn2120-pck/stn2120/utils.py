@@ -36,6 +36,7 @@ import string
 import glob
 import sys
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -160,10 +161,8 @@ def try_port(portStr):
     return False
 
 
-def scan_serial():
-    """scan for available ports. return a list of serial names"""
-    available = []
-
+def possible_ports():
+    """ serial device names where an adapter could be connected """
     possible_ports = []
 
     if sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
@@ -182,8 +181,17 @@ def scan_serial():
 
     # possible_ports += glob.glob('/dev/pts/[0-9]*') # for obdsim
 
-    for port in possible_ports:
-        if try_port(port):
-            available.append(port)
+    return possible_ports
+
+
+def scan_serial():
+    """scan for available ports. return a list of serial names"""
+    ports = possible_ports()
+    if not ports:
+        return []
+
+    # every port is tried at the same time
+    with ThreadPoolExecutor(max_workers=min(16, len(ports))) as pool:
+        results = list(pool.map(try_port, ports))
 
-    return available
+    return [ port for port, ok in zip(ports, results) if ok ]